@@ -0,0 +1,611 @@
+"""
+Офлайн-бенчмарк бота без живого Telegram.
+
+Генерирует синтетическую shop.db (по умолчанию 100k пользователей, 1M заказов,
+10k товаров, 50k промокодов), прогоняет через Application фейковые апдейты
+(коллбэки, текст, команды) с заглушкой Bot API и выводит p50/p99 и
+пропускную способность для каждого сценария. С --alloc каждый сценарий
+дополнительно прогоняется под tracemalloc и выводится пик памяти на операцию.
+
+Примеры:
+    python benchmark.py                          # полный объем данных
+    python benchmark.py --scale 0.01             # быстрый прогон
+    python benchmark.py --flows shop,profile --iterations 500
+    python benchmark.py --json after.json --compare before.json
+    python benchmark.py --flows main_menu,shop,category --alloc   # плюс пик памяти
+    python benchmark.py --flows buy_product --api-latency-ms 50   # с задержкой сети до Telegram
+    python benchmark.py --scale 0.01 --check-pages   # страницы истории на 100k заказов
+
+Данные генерируются детерминированно (--seed) и кешируются в --workdir,
+поэтому результаты разных коммитов сравнимы между собой.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent
+
+ADMIN_ID = 1
+ADMIN_USERNAME = "kanvylsia"
+USER_ID_BASE = 1_000_000
+BUYER_ID = USER_ID_BASE          # пользователь с большим балансом для покупок
+HEAVY_ID = USER_ID_BASE + 1      # пользователь с большим количеством заказов
+REFERRER_ID = USER_ID_BASE + 2   # пользователь с большим количеством рефералов
+WHALE_ID = USER_ID_BASE + 3      # владелец каждого десятого заказа (100k при полном объеме)
+FLOODER_ID = 999                 # жмет кнопки без остановки; единственный, кого видит фильтр флуда
+PAGES_ID = USER_ID_BASE - 1      # получает 100k заказов в --check-pages при любом объеме данных
+PAGES_ORDERS = 100_000
+# Меняется вместе с генератором, чтобы не подхватить устаревший кеш
+DATASET_VERSION = 6
+BENCH_PROMO = "BENCHPROMO"
+
+FULL_SIZES = {
+    'users': 100_000,
+    'orders': 1_000_000,
+    'products': 10_000,
+    'promocodes': 50_000,
+    'deposit_requests': 50_000,
+}
+
+
+# ============ ГЕНЕРАЦИЯ ДАННЫХ ============
+def _ts(dt: datetime) -> int:
+    return int(dt.timestamp())
+
+
+def generate_dataset(db_path: str, scale: float, seed: int, today: datetime):
+    """Заполняет уже созданную схему shop.db синтетическими данными"""
+    rng = random.Random(seed)
+    sizes = {key: max(int(value * scale), 20) for key, value in FULL_SIZES.items()}
+    year_ago = today - timedelta(days=365)
+
+    def random_date() -> datetime:
+        return year_ago + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA journal_mode = MEMORY")
+
+    # Товары
+    products = []
+    for i in range(1, sizes['products'] + 1):
+        price = rng.choice([50, 100, 150, 200, 300, 500, 1000, 2500])
+        stock = -1 if rng.random() < 0.8 else rng.randint(0, 500)
+        products.append((i, f"Товар {i}", f"Описание товара {i}", price,
+                         rng.randint(1, 9), stock, 1 if rng.random() < 0.95 else 0,
+                         _ts(random_date()), i))
+    conn.executemany("""
+        INSERT INTO products (id, name, description, price, category_id, stock, is_active, created_at, position)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, products)
+    prices = {row[0]: (row[1], row[3]) for row in products}
+
+    # Пользователи
+    referrals = Counter()
+    invited = []
+    users = [(ADMIN_ID, ADMIN_USERNAME, "Admin", 0, "ADMIN0", None, _ts(year_ago), _ts(today))]
+    for i in range(sizes['users']):
+        user_id = USER_ID_BASE + i
+        # Покупатель приглашен, чтобы покупки шли с процентом рефереру
+        referred_by = REFERRER_ID if user_id == BUYER_ID else None
+        if i > REFERRER_ID - USER_ID_BASE:
+            roll = rng.random()
+            if roll < 0.05:
+                referred_by = REFERRER_ID
+            elif roll < 0.3:
+                referred_by = USER_ID_BASE + rng.randrange(i)
+        if referred_by:
+            referrals[referred_by] += 1
+        balance = 10 ** 9 if user_id == BUYER_ID else rng.randint(0, 5000)
+        join_date = random_date()
+        if referred_by == REFERRER_ID:
+            invited.append((_ts(join_date), user_id))
+        users.append((user_id, f"user{i}", f"Пользователь {i}", balance,
+                      f"R{i:07d}", referred_by, _ts(join_date), _ts(join_date)))
+    conn.executemany("""
+        INSERT INTO users (user_id, username, first_name, balance, referral_code, referred_by, join_date, last_active)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, users)
+    conn.executemany("UPDATE users SET total_referrals = ? WHERE user_id = ?",
+                     [(count, user_id) for user_id, count in referrals.items()])
+    invited.sort(reverse=True)
+    sizes['referral_cursor'] = invited[len(invited) * 9 // 10][1]
+
+    # Заказы
+    spent = defaultdict(int)
+    counts = Counter()
+    whale_orders = []
+    last_user = USER_ID_BASE + sizes['users'] - 1
+
+    def orders():
+        for i in range(sizes['orders']):
+            if i % 10 == 0:
+                user_id = WHALE_ID
+            else:
+                user_id = HEAVY_ID if rng.random() < 0.02 else rng.randint(USER_ID_BASE, last_user)
+            product_id = rng.randint(1, sizes['products'])
+            name, price = prices[product_id]
+            status = 'completed' if rng.random() < 0.95 else 'cancelled'
+            created_at = _ts(random_date())
+            spent[user_id] += price
+            counts[user_id] += 1
+            if user_id == WHALE_ID:
+                whale_orders.append((created_at, i + 1))
+            yield (user_id, product_id, name, price, status, created_at)
+
+    conn.executemany("""
+        INSERT INTO orders (user_id, product_id, product_name, amount, status, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, orders())
+    conn.executemany("UPDATE users SET total_spent = ?, orders_count = ? WHERE user_id = ?",
+                     [(amount, counts[user_id], user_id) for user_id, amount in spent.items()])
+    # Курсор страницы из последних 10% истории - для проверки, что глубина не влияет на время
+    whale_orders.sort(reverse=True)
+    sizes['whale_cursor'] = whale_orders[len(whale_orders) * 9 // 10][1]
+
+    # Промокоды
+    def promocodes():
+        yield (BENCH_PROMO, 1, 0, 0, None, _ts(today))
+        for i in range(sizes['promocodes']):
+            expires_at = _ts(today + timedelta(days=rng.randint(-30, 60))) if rng.random() < 0.5 else None
+            max_uses = rng.choice([0, 1, 5, 10, 100])
+            yield (f"PROMO{i:07d}", rng.choice([50, 100, 200, 500]), max_uses,
+                   rng.randint(0, max_uses or 10), expires_at, _ts(random_date()))
+
+    conn.executemany("""
+        INSERT INTO promocodes (code, amount, max_uses, used_count, expires_at, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, promocodes())
+
+    # Заявки на пополнение, ожидающие админа; каждая вторая выставлена через провайдера
+    conn.executemany("""
+        INSERT INTO deposit_requests (user_id, amount, created_at, provider, payment_id) VALUES (?, ?, ?, ?, ?)
+    """, (
+        (rng.randint(USER_ID_BASE, last_user), rng.choice([100, 500, 1000, 5000]), _ts(random_date()),
+         *(('mock', f"bench-{i}") if i % 2 else (None, None)))
+        for i in range(sizes['deposit_requests'])
+    ))
+
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return sizes
+
+
+# ============ ЗАГЛУШКА BOT API ============
+def make_stub_request_class(latency_ms: float = 0.0):
+    from telegram.request import BaseRequest
+
+    class StubRequest(BaseRequest):
+        """Отвечает на любые вызовы Bot API без сети и считает их"""
+
+        def __init__(self):
+            self.calls = Counter()
+            self._message_id = 0
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None,
+                             write_timeout=None, connect_timeout=None, pool_timeout=None):
+            endpoint = url.rsplit('/', 1)[-1]
+            self.calls[endpoint] += 1
+            if latency_ms:
+                await asyncio.sleep(latency_ms / 1000)
+
+            if endpoint == 'getMe':
+                result = {'id': 999, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+            elif endpoint in ('sendMessage', 'editMessageText', 'sendPhoto', 'sendDocument'):
+                self._message_id += 1
+                result = {'message_id': self._message_id, 'date': int(time.time()),
+                          'chat': {'id': 1, 'type': 'private'}, 'text': ''}
+            else:
+                result = True
+            return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    return StubRequest
+
+
+# ============ ФЕЙКОВЫЕ АПДЕЙТЫ ============
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+
+    def _user(self, user_id: int) -> dict:
+        username = ADMIN_USERNAME if user_id == ADMIN_ID else f"user{user_id - USER_ID_BASE}"
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'username': username}
+
+    def _message(self, user_id: int, text: str, message_id: int = None) -> dict:
+        message = {'message_id': message_id or self.update_id, 'date': int(time.time()),
+                   'chat': {'id': user_id, 'type': 'private'},
+                   'from': self._user(user_id), 'text': text}
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return message
+
+    def callback(self, user_id: int, data: str, message_id: int = None):
+        """message_id задает сообщение с кнопками; по умолчанию у каждого апдейта свое"""
+        from telegram import Update
+        self.update_id += 1
+        return Update.de_json({
+            'update_id': self.update_id,
+            'callback_query': {
+                'id': str(self.update_id),
+                'from': self._user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': self._message(user_id, 'menu', message_id),
+            },
+        }, self.bot)
+
+    def text(self, user_id: int, text: str):
+        from telegram import Update
+        self.update_id += 1
+        return Update.de_json({'update_id': self.update_id, 'message': self._message(user_id, text)}, self.bot)
+
+
+def build_flows(f: UpdateFactory, sizes: dict) -> dict:
+    """Сценарии: имя -> функция(i) -> список апдейтов одной итерации"""
+    rng = random.Random(7)
+    last_user = USER_ID_BASE + sizes['users'] - 1
+
+    def any_user():
+        return rng.randint(WHALE_ID + 1, last_user)
+
+    def any_product():
+        return rng.randint(1, sizes['products'])
+
+    def promo(i):
+        user_id = any_user()
+        return [f.callback(user_id, 'promo'), f.text(user_id, BENCH_PROMO)]
+
+    return {
+        'start': lambda i: [f.text(any_user(), '/start')],
+        'main_menu': lambda i: [f.callback(any_user(), 'main_menu')],
+        'shop': lambda i: [f.callback(any_user(), 'shop')],
+        'category': lambda i: [f.callback(any_user(), f'category_{rng.randint(1, 9)}')],
+        'view_product': lambda i: [f.callback(any_user(), f'view_product_{any_product()}')],
+        'buy_product': lambda i: [f.callback(BUYER_ID, f'buy_product_{any_product()}')],
+        'balance': lambda i: [f.callback(any_user(), 'balance')],
+        'profile': lambda i: [f.callback(any_user(), 'profile')],
+        'profile_heavy': lambda i: [f.callback(HEAVY_ID, 'profile')],
+        'my_orders': lambda i: [f.callback(any_user(), 'my_orders')],
+        'my_orders_heavy': lambda i: [f.callback(HEAVY_ID, 'my_orders')],
+        'my_orders_whale': lambda i: [f.callback(WHALE_ID, 'my_orders')],
+        'my_orders_whale_deep': lambda i: [f.callback(WHALE_ID, f"my_orders_after_{sizes['whale_cursor']}")],
+        'balance_history': lambda i: [f.callback(any_user(), 'balance_history')],
+        'balance_history_heavy': lambda i: [f.callback(HEAVY_ID, 'balance_history')],
+        'referrals': lambda i: [f.callback(REFERRER_ID, 'referrals')],
+        'my_referrals': lambda i: [f.callback(REFERRER_ID, 'my_referrals')],
+        'my_referrals_deep': lambda i: [f.callback(REFERRER_ID, f"my_referrals_after_{sizes['referral_cursor']}")],
+        'promo': promo,
+        'deposit_custom': lambda i: [f.callback(BUYER_ID, 'deposit_custom'), f.text(BUYER_ID, '750')],
+        'deposit_request': lambda i: [f.callback(any_user(), 'confirm_payment_500')],
+        'admin_deposits': lambda i: [f.callback(ADMIN_ID, 'admin_deposits')],
+        # Каждая итерация подтверждает свою страницу из 10 заявок
+        'admin_deposits_approve': lambda i: [f.callback(ADMIN_ID, f'dep_ok_{i * 10 + 1}_{i * 10 + 10}_0')],
+        'custom_promo_wizard': lambda i: [
+            f.callback(ADMIN_ID, 'create_custom_name_promo'),
+            f.text(ADMIN_ID, f'WZ{i:08d}'),
+            f.text(ADMIN_ID, '100'),
+            f.text(ADMIN_ID, '10'),
+            f.text(ADMIN_ID, '7'),
+        ],
+        'text_fallback': lambda i: [f.text(any_user(), 'привет')],
+        'admin_panel': lambda i: [f.callback(ADMIN_ID, 'admin_panel')],
+        'admin_command': lambda i: [f.text(ADMIN_ID, '/admin')],
+        'admin_stats': lambda i: [f.callback(ADMIN_ID, 'admin_stats')],
+        # Кнопка "Обновить" на одном и том же сообщении: содержимое не меняется
+        'admin_stats_refresh': lambda i: [f.callback(ADMIN_ID, 'admin_stats', message_id=1)],
+        'admin_users_refresh': lambda i: [f.callback(ADMIN_ID, 'admin_users', message_id=2)],
+        'my_orders_refresh': lambda i: [f.callback(HEAVY_ID, 'my_orders', message_id=3)],
+        'admin_users': lambda i: [f.callback(ADMIN_ID, 'admin_users')],
+        'admin_products': lambda i: [f.callback(ADMIN_ID, 'admin_products')],
+        'admin_promocodes': lambda i: [f.callback(ADMIN_ID, 'admin_promocodes')],
+        'stats_command': lambda i: [f.text(ADMIN_ID, '/stats')],
+        'user_command': lambda i: [f.text(ADMIN_ID, f'/user {HEAVY_ID}')],
+        'reconcile': lambda i: [f.text(ADMIN_ID, '/reconcile')],
+        'chart_sales_30': lambda i: [f.callback(ADMIN_ID, 'chart_sales_30')],
+        'chart_users_30': lambda i: [f.callback(ADMIN_ID, 'chart_users_30')],
+        # Цена отклонения: после первых нажатий фильтр отбрасывает апдейты до обработчиков
+        'flood': lambda i: [f.callback(FLOODER_ID, 'shop')],
+    }
+
+
+# ============ ПРОГОН ============
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def measure_allocations(application, make_updates, iterations: int) -> float:
+    """Средний пик памяти за операцию в байтах: все временные объекты рендера и ответа"""
+    peaks = []
+    tracemalloc.start()
+    try:
+        for i in range(iterations):
+            updates = make_updates(i)
+            tracemalloc.reset_peak()
+            start, _ = tracemalloc.get_traced_memory()
+            for update in updates:
+                await application.process_update(update)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - start)
+    finally:
+        tracemalloc.stop()
+    return statistics.fmean(peaks)
+
+
+async def run_flows(main, flow_names, iterations: int, warmup: int, alloc_iterations: int = 0,
+                    api_latency_ms: float = 0.0):
+    from telegram.ext import ApplicationBuilder
+
+    stub = make_stub_request_class(api_latency_ms)()
+    bot = main.ShopBot(main.TOKEN, request=stub, get_updates_request=stub)
+    application = ApplicationBuilder().bot(bot).updater(None).build()
+    main.setup_handlers(application)
+    await application.initialize()
+    # Уведомления (чеки, зачисления) уходят фоновой очередью; у заглушки нет лимита Telegram
+    main.notifier.interval = 0
+    notifier_task = asyncio.create_task(main.notifier.run(bot))
+
+    errors = ErrorCounter()
+    logging.getLogger(main.__name__).addHandler(errors)
+
+    factory = UpdateFactory(bot)
+    flows = build_flows(factory, main.BENCH_SIZES)
+    results = {}
+
+    try:
+        for name in flow_names:
+            make_updates = flows[name]
+            # Остальные сценарии шлют сотни апдейтов в секунду от одного пользователя
+            main.flood_guard.enabled = name == 'flood'
+            for i in range(warmup):
+                for update in make_updates(-i - 1):
+                    await application.process_update(update)
+
+            errors.count = 0
+            calls_before = sum(stub.calls.values())
+            latencies = []
+            started = time.perf_counter()
+            for i in range(iterations):
+                updates = make_updates(i)
+                t0 = time.perf_counter()
+                for update in updates:
+                    await application.process_update(update)
+                latencies.append((time.perf_counter() - t0) * 1000)
+            total = time.perf_counter() - started
+            await main.notifier.drain(timeout=30)
+
+            results[name] = {
+                'iterations': iterations,
+                'p50_ms': round(percentile(latencies, 50), 3),
+                'p99_ms': round(percentile(latencies, 99), 3),
+                'mean_ms': round(statistics.fmean(latencies), 3),
+                'ops_per_sec': round(iterations / total, 1) if total else 0.0,
+                'api_calls_per_op': round((sum(stub.calls.values()) - calls_before) / iterations, 2),
+                'errors': errors.count,
+            }
+            if alloc_iterations:
+                peak = await measure_allocations(application, make_updates, alloc_iterations)
+                results[name]['peak_kib_per_op'] = round(peak / 1024, 1)
+            print(format_row(name, results[name]), flush=True)
+    finally:
+        notifier_task.cancel()
+        await application.shutdown()
+
+    return results
+
+
+def format_row(name: str, r: dict, baseline: dict = None) -> str:
+    row = (f"{name:<22} {r['p50_ms']:>10.3f} {r['p99_ms']:>10.3f} "
+           f"{r['ops_per_sec']:>10.1f} {r['api_calls_per_op']:>6.2f} {r['errors']:>6}")
+    if 'peak_kib_per_op' in r:
+        row += f" {r['peak_kib_per_op']:>9.1f}"
+    if baseline:
+        delta = (r['p50_ms'] - baseline['p50_ms']) / baseline['p50_ms'] * 100 if baseline['p50_ms'] else 0.0
+        row += f" {delta:>+8.1f}%"
+    return row
+
+
+def git_revision() -> str:
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                             capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--', 'main.py'], cwd=REPO_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return f"{rev}{'-dirty' if dirty else ''}" or "unknown"
+    except OSError:
+        return "unknown"
+
+
+# ============ ПРОВЕРКА СТРАНИЦ ИСТОРИИ ============
+def check_order_pages(main, iterations: int = 200) -> bool:
+    """Первая и глубокая страницы истории на 100k заказов: поиск по индексу и равное время"""
+    rng = random.Random(PAGES_ID)
+    start = int(time.time()) - 86400
+    with sqlite3.connect(main.db.db_file) as conn:
+        conn.execute("INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, 'pages', 'Pages')",
+                     (PAGES_ID,))
+        # Часть заказов делит секунду создания, чтобы курсор опирался и на id
+        conn.executemany("""
+            INSERT INTO orders (user_id, product_id, product_name, amount, status, created_at)
+            VALUES (?, 1, 'Товар', 100, 'completed', ?)
+        """, ((PAGES_ID, start + rng.randint(0, PAGES_ORDERS // 4)) for _ in range(PAGES_ORDERS)))
+        conn.commit()
+        ids = [row[0] for row in conn.execute(
+            "SELECT id FROM orders WHERE user_id = ? ORDER BY created_at DESC, id DESC", (PAGES_ID,))]
+        plans = {}
+
+        # Запросы снимаются с самого get_orders_page, чтобы проверялся тот SQL, что работает в боте
+        def explain(query, params=()):
+            plans.setdefault(len(plans), [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)])
+            return fetchall(query, params)
+
+        fetchall = main.db.fetchall
+        main.db.fetchall = explain
+        try:
+            first = main.db.get_orders_page(PAGES_ID)[0]
+            deep = main.db.get_orders_page(PAGES_ID, ids[len(ids) * 9 // 10])[0]
+        finally:
+            main.db.fetchall = fetchall
+
+    ok = True
+    expected = ids[:main.ORDERS_PAGE_SIZE], ids[len(ids) * 9 // 10 + 1:][:main.ORDERS_PAGE_SIZE]
+    if ([row['id'] for row in first], [row['id'] for row in deep]) != expected:
+        print("❌ Страницы истории не совпадают с порядком (created_at, id)")
+        ok = False
+    for name, plan in zip(('первая', 'глубокая'), plans.values()):
+        searched = any(step.startswith('SEARCH orders USING') and 'idx_orders_user_' in step for step in plan)
+        sorted_ = any(step.startswith('USE TEMP B-TREE') for step in plan)
+        print(f"{'✅' if searched and not sorted_ else '❌'} План ({name} страница): {' | '.join(plan)}")
+        ok = ok and searched and not sorted_
+
+    timings = {}
+    for name, after_id in (('первая', None), ('глубокая', ids[len(ids) * 9 // 10])):
+        samples = []
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            main.db.get_orders_page(PAGES_ID, after_id)
+            samples.append((time.perf_counter() - t0) * 1000)
+        timings[name] = statistics.median(samples)
+    # Запас на шум таймера: глубокая страница не дороже первой в разы
+    flat = timings['глубокая'] <= timings['первая'] * 3 + 0.5
+    print(f"{'✅' if flat else '❌'} Время на {PAGES_ORDERS} заказах, p50: "
+          f"первая {timings['первая']:.3f} мс, глубокая {timings['глубокая']:.3f} мс")
+    return ok and flat
+
+
+def prepare_workdir(args) -> Path:
+    """Готовит рабочую директорию с копией синтетической базы и импортирует main"""
+    workdir = Path(args.workdir).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    cache = workdir / f"dataset_v{DATASET_VERSION}_s{args.scale:g}_seed{args.seed}_{today:%Y%m%d}.db"
+    meta_file = cache.with_suffix('.json')
+
+    os.chdir(workdir)
+    db_file = workdir / 'shop.db'
+    # Журнал WAL прошлого прогона (остается, если процессы бота были убиты) испортил бы свежую копию
+    for path in (db_file, workdir / 'shop.db-wal', workdir / 'shop.db-shm'):
+        if path.exists():
+            path.unlink()
+
+    fresh = args.regenerate or not cache.exists()
+    if not fresh:
+        shutil.copyfile(cache, db_file)
+
+    os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+    sys.path.insert(0, str(REPO_DIR))
+    import main  # создает схему (или мигрирует скопированную базу)
+
+    if fresh:
+        print(f"⏳ Генерация данных (scale={args.scale:g}, seed={args.seed})...", flush=True)
+        t0 = time.perf_counter()
+        sizes = generate_dataset(str(db_file), args.scale, args.seed, today)
+        main.db.rebuild_referral_tree()
+        print(f"✅ Данные сгенерированы за {time.perf_counter() - t0:.1f} с: {sizes}", flush=True)
+        shutil.copyfile(db_file, cache)
+        meta_file.write_text(json.dumps(sizes))
+    # В работающем боте индексы больших таблиц достраивает фоновая задача
+    main.db.build_indexes()
+    main.BENCH_SIZES = json.loads(meta_file.read_text())
+    return main
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота")
+    parser.add_argument('--scale', type=float, default=1.0, help="доля от полного объема данных")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--iterations', type=int, default=100, help="итераций на сценарий")
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--flows', default='', help="список сценариев через запятую")
+    parser.add_argument('--workdir', default=str(REPO_DIR / 'bench_data'))
+    parser.add_argument('--regenerate', action='store_true', help="пересоздать кеш данных")
+    parser.add_argument('--output', default=str(REPO_DIR / 'bench_output.txt'))
+    parser.add_argument('--json', help="сохранить результаты в JSON")
+    parser.add_argument('--compare', help="JSON с результатами другого коммита")
+    parser.add_argument('--api-latency-ms', type=float, default=0.0,
+                        help="задержка ответа заглушки Bot API (сеть до Telegram)")
+    parser.add_argument('--alloc', type=int, nargs='?', const=20, default=0, metavar='N',
+                        help="замерить выделения памяти за N итераций под tracemalloc (по умолчанию 20)")
+    parser.add_argument('--check-pages', action='store_true',
+                        help="проверить планы и время страниц истории на 100k заказов и выйти")
+    args = parser.parse_args()
+
+    main = prepare_workdir(args)
+    # Логи бота не должны влиять на замеры
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.check_pages:
+        sys.exit(0 if check_order_pages(main) else 1)
+
+    available = list(build_flows(UpdateFactory(None), main.BENCH_SIZES))
+    flow_names = [name.strip() for name in args.flows.split(',') if name.strip()] or available
+    unknown = set(flow_names) - set(available)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}; доступны: {', '.join(available)}")
+
+    baseline = {}
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())['results']
+
+    header = f"{'flow':<22} {'p50 ms':>10} {'p99 ms':>10} {'ops/s':>10} {'api':>6} {'errors':>6}"
+    if args.alloc:
+        header += f" {'peak KiB':>9}"
+    print(header + (f" {'Δp50':>9}" if baseline else ""))
+    results = asyncio.run(run_flows(main, flow_names, args.iterations, args.warmup, args.alloc,
+                                   args.api_latency_ms))
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'scale': args.scale,
+        'seed': args.seed,
+        'sizes': main.BENCH_SIZES,
+        'results': results,
+    }
+    lines = [f"revision {report['revision']} | scale {args.scale:g} | seed {args.seed} | {report['timestamp']}",
+             header + (f" {'Δp50':>9}" if baseline else "")]
+    lines += [format_row(name, r, baseline.get(name)) for name, r in results.items()]
+    Path(args.output).write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    if baseline:
+        print('\n'.join(lines[2:]))
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding='utf-8')
+    print(f"📄 Отчет: {args.output}")
+
+
+if __name__ == "__main__":
+    main_cli()
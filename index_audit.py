@@ -0,0 +1,184 @@
+"""
+Аудит индексов: находит SQL-запросы main.py, которые читают таблицу целиком.
+
+Все строковые литералы main.py, похожие на SQL, прогоняются через
+EXPLAIN QUERY PLAN на синтетической базе бенчмарка (та же генерация и тот же
+кеш, что у benchmark.py). В отчет попадают полные проходы по таблицам
+(SCAN без индекса) и сортировки во временном B-дереве. Запросы, для которых
+полный проход ожидаем (отчеты по всей базе, сверка, перестроение дерева),
+перечислены в EXPECTED_SCANS и выводятся отдельно.
+
+SQL, собранный f-строкой, не проверяется - такие запросы только перечисляются.
+
+Примеры:
+    python index_audit.py                  # база benchmark.py --scale 0.01
+    python index_audit.py --scale 1        # план на полном объеме данных
+    python index_audit.py --all            # показать планы всех запросов
+    python index_audit.py --strict         # код возврата 1 при неожиданных проходах
+                                           # или устаревших исключениях EXPECTED_SCANS
+"""
+import argparse
+import ast
+import re
+import sys
+from pathlib import Path
+
+import benchmark
+
+MAIN_FILE = benchmark.REPO_DIR / 'main.py'
+
+SQL_START = re.compile(r'^\s*(SELECT|WITH|UPDATE|DELETE|INSERT|REPLACE)\b', re.IGNORECASE)
+
+# Функции, которым полный проход нужен по смыслу: они читают или пересчитывают всю таблицу
+EXPECTED_SCANS = {
+    'baseline_schema': "миграция, разовый пересчет",
+    '_fill_referral_tree': "перестроение дерева рефералов",
+    '_fill_referral_levels': "пересчет счетчиков по всему дереву рефералов",
+    '_post_opening_balances': "разовый перенос балансов в журнал",
+    'reconcile_ledger': "сверка всех балансов с журналом",
+    'get_stats': "итоги по всей базе",
+    'build_top_products_chart': "итоги по всем заказам",
+    'build_weekdays_chart': "итоги по всем заказам",
+    'release_expired_holds': "удаление по времени",
+    'build_sales_chart': "группировка по дням внутри диапазона по индексу",
+    'build_users_chart': "группировка по дням внутри диапазона по индексу",
+    'show_admin_promo_stats': "итоги по всем промокодам",
+    'show_admin_categories': "сортировка справочника категорий, товары считаются по индексу",
+    'testers_command': "редкая команда админа",
+    'get_bot_data': "загрузка состояний мастеров при старте",
+    'load_catalog': "снимок всего каталога после правки",
+}
+
+# Справочники из десятков строк: проход по ним дешевле поиска по индексу
+SMALL_TABLES = {'categories', 'admins', 'settings', 'sqlite_master'}
+
+
+# ============ ПОИСК ЗАПРОСОВ ============
+class QueryCollector(ast.NodeVisitor):
+    """Собирает SQL-литералы вместе с функцией и строкой, где они написаны"""
+
+    def __init__(self):
+        self.function = '<module>'
+        self.queries = []
+        self.dynamic = []
+
+    def visit_FunctionDef(self, node):
+        outer, self.function = self.function, node.name
+        self.generic_visit(node)
+        self.function = outer
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Constant(self, node):
+        # Одно слово (INSERT, UPDATE в тексте триггера) - кусок запроса, а не запрос
+        if isinstance(node.value, str) and SQL_START.match(node.value) and len(node.value.split()) > 1:
+            self.queries.append((self.function, node.lineno, node.value))
+
+    def visit_JoinedStr(self, node):
+        text = ''.join(
+            part.value if isinstance(part, ast.Constant) else '{}' for part in node.values
+        )
+        if SQL_START.match(text):
+            self.dynamic.append((self.function, node.lineno, text))
+        # Внутренние литералы f-строки - куски текста, а не отдельные запросы
+
+
+def collect_queries(path: Path):
+    collector = QueryCollector()
+    collector.visit(ast.parse(path.read_text(encoding='utf-8')))
+    return collector.queries, collector.dynamic
+
+
+# ============ ПЛАНЫ ============
+def explain(conn, sql: str):
+    """Строки плана запроса; параметры подставляются как NULL"""
+    params = [None] * sql.count('?')
+    return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def problems(plan):
+    """Полные проходы и сортировки из плана"""
+    tables = {detail.split()[1] for detail in plan if detail.startswith(('SCAN ', 'SEARCH '))}
+    if tables and tables <= SMALL_TABLES | {'CONSTANT'}:
+        return []
+    found = []
+    for detail in plan:
+        if detail.startswith('SCAN ') and ' USING ' not in detail:
+            if detail.split()[1] not in SMALL_TABLES | {'CONSTANT'}:
+                found.append(detail)
+        elif detail.startswith('USE TEMP B-TREE'):
+            found.append(detail)
+    return found
+
+
+def short_sql(sql: str, width: int = 110) -> str:
+    text = ' '.join(sql.split())
+    return text if len(text) <= width else text[:width - 3] + '...'
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Поиск полных проходов по таблицам в запросах main.py")
+    parser.add_argument('--scale', type=float, default=0.01, help="объем синтетических данных")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workdir', default=str(benchmark.REPO_DIR / 'bench_data'))
+    parser.add_argument('--regenerate', action='store_true', help="пересоздать кеш данных")
+    parser.add_argument('--all', action='store_true', help="показать планы всех запросов")
+    parser.add_argument('--strict', action='store_true',
+                        help="код возврата 1 при неожиданных проходах и устаревших исключениях")
+    args = parser.parse_args()
+
+    main = benchmark.prepare_workdir(args)
+
+    queries, dynamic = collect_queries(MAIN_FILE)
+    # Исключение для функции, которой нет, молча разрешило бы проходы будущей функции с тем же именем
+    stale = sorted(set(EXPECTED_SCANS) - {function for function, _, _ in queries + dynamic})
+    conn = main.sqlite3.connect(main.DB_FILE)
+    unexpected, expected, errors = [], [], []
+    try:
+        for function, lineno, sql in queries:
+            try:
+                plan = explain(conn, sql)
+            except main.sqlite3.Error as e:
+                errors.append((function, lineno, sql, str(e)))
+                continue
+            found = problems(plan)
+            if found:
+                (expected if function in EXPECTED_SCANS else unexpected).append((function, lineno, sql, found))
+            elif args.all:
+                print(f"✅ {function}:{lineno}  {short_sql(sql)}")
+                for detail in plan:
+                    print(f"      {detail}")
+    finally:
+        conn.close()
+
+    print(f"\nЗапросов проверено: {len(queries)}, с полным проходом или сортировкой: "
+          f"{len(unexpected) + len(expected)}, f-строк пропущено: {len(dynamic)}\n")
+    for title, rows in (("❌ Неожиданные", unexpected), ("ℹ️ Ожидаемые", expected)):
+        if not rows:
+            continue
+        print(title)
+        for function, lineno, sql, found in rows:
+            reason = f" ({EXPECTED_SCANS[function]})" if function in EXPECTED_SCANS else ""
+            print(f"  {function}:{lineno}{reason}\n      {short_sql(sql)}")
+            for detail in found:
+                print(f"      -> {detail}")
+        print()
+    if errors:
+        print("⚠️ Не удалось построить план")
+        for function, lineno, sql, error in errors:
+            print(f"  {function}:{lineno}: {error}\n      {short_sql(sql)}")
+        print()
+    if dynamic:
+        print("f-строки (план не строился)")
+        for function, lineno, sql in dynamic:
+            print(f"  {function}:{lineno}  {short_sql(sql, 90)}")
+
+    if stale:
+        print(f"\n⚠️ EXPECTED_SCANS: в main.py нет функций с SQL: {', '.join(stale)}")
+
+    if args.strict and (unexpected or stale):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_cli()
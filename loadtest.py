@@ -0,0 +1,495 @@
+"""
+Нагрузочный тест бота от начала до конца.
+
+Поднимает локальный фейковый Telegram Bot API (aiohttp), запускает main.py
+отдельным процессом с BOT_API_URL на этот сервер (настоящий polling через
+getUpdates, либо --webhook: апдейты POST-ятся на встроенный webhook-сервер
+бота с секретным токеном) и прогоняет через него тысячи одновременных
+покупателей.
+Сценарии смешивают просмотр каталога, покупки, промокоды и профиль.
+
+В конце выводятся устойчивая пропускная способность (апдейтов/с), доля
+ошибок, хвостовые задержки по сценариям и признаки конкуренции за
+блокировки SQLite: ошибки "database is locked" и медленные запросы из
+slow_queries*.log бота (в многопроцессном режиме у каждого обработчика свой файл).
+
+Примеры:
+    python loadtest.py --users 2000 --actions 10
+    python loadtest.py --users 500 --duration 60 --scale 0.05
+    python loadtest.py --webhook --users 1000
+    python loadtest.py --users 500 --drop 50   # + распродажа 50 штук, проверка на перепродажу
+"""
+import argparse
+import asyncio
+import json
+import logging
+import socket
+import os
+import random
+import signal
+import sqlite3
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from aiohttp import ClientSession, web
+
+import benchmark
+
+TOKEN = "123456:LOADTEST"
+WEBHOOK_SECRET = "loadtest-secret"
+
+# Вес сценариев в смеси нагрузки
+FLOW_WEIGHTS = {
+    'browse': 5,
+    'buy': 2,
+    'promo': 1,
+    'profile': 2,
+}
+
+
+# ============ ФЕЙКОВЫЙ BOT API ============
+class FakeBotAPI:
+    """Минимальный Bot API: выдает апдейты через getUpdates и принимает ответы бота"""
+
+    def __init__(self, webhook_url: str = None, latency_ms: float = 0):
+        self.webhook_url = webhook_url
+        self.latency = latency_ms / 1000
+        self.session = None
+        self.delivery_errors = 0
+        self.updates = asyncio.Queue()
+        self.update_id = 0
+        self.message_id = 0
+        self.waiters = {}
+        self.calls = Counter()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    def next_update_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    async def deliver(self, update: dict):
+        if not self.webhook_url:
+            await self.updates.put(update)
+            return
+        headers = {'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}
+        async with self.session.post(self.webhook_url, json=update, headers=headers) as response:
+            if response.status != 200:
+                self.delivery_errors += 1
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id] = future
+        return future
+
+    def _resolve(self, chat_id):
+        future = self.waiters.pop(chat_id, None)
+        if future and not future.done():
+            future.set_result(time.perf_counter())
+
+    def _message(self, chat_id, text='') -> dict:
+        self.message_id += 1
+        return {'message_id': self.message_id, 'date': int(time.time()),
+                'chat': {'id': int(chat_id or 0), 'type': 'private'}, 'text': text}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        params = await request.post()
+        if self.latency and method != 'getUpdates':
+            # Имитация сетевой задержки до api.telegram.org
+            await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            result = {'id': 999, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+        elif method == 'getUpdates':
+            result = await self._get_updates(float(params.get('timeout', 0)), int(params.get('limit', 100)))
+        elif method in ('sendMessage', 'editMessageText', 'sendPhoto', 'sendDocument'):
+            chat_id = params.get('chat_id')
+            result = self._message(chat_id, params.get('text', ''))
+            if chat_id:
+                self._resolve(int(chat_id))
+        elif method == 'answerCallbackQuery':
+            # Пустой answer() только гасит часики; ответом считаем alert с текстом
+            if params.get('text'):
+                self._resolve(int(params['callback_query_id'].split(':')[0]))
+            result = True
+        else:
+            result = True
+
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _get_updates(self, timeout: float, limit: int) -> list:
+        batch = []
+        try:
+            batch.append(await asyncio.wait_for(self.updates.get(), timeout=max(timeout, 0.01)))
+        except asyncio.TimeoutError:
+            return batch
+        while len(batch) < limit and not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return batch
+
+
+# ============ СИМУЛЯЦИЯ ПОКУПАТЕЛЕЙ ============
+class Shopper:
+    def __init__(self, api: FakeBotAPI, stats: 'Stats', user_id: int, sizes: dict, args, rng: random.Random):
+        self.api = api
+        self.stats = stats
+        self.user_id = user_id
+        self.sizes = sizes
+        self.args = args
+        self.rng = rng
+        self.seq = 0
+
+    def _user(self) -> dict:
+        return {'id': self.user_id, 'is_bot': False, 'first_name': 'Shopper',
+                'username': f"user{self.user_id - benchmark.USER_ID_BASE}"}
+
+    def _message(self, text: str) -> dict:
+        message = {'message_id': self.seq, 'date': int(time.time()),
+                   'chat': {'id': self.user_id, 'type': 'private'},
+                   'from': self._user(), 'text': text}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return message
+
+    async def send(self, flow: str, kind: str, payload: str):
+        self.seq += 1
+        if kind == 'callback':
+            update = {'update_id': self.api.next_update_id(),
+                      'callback_query': {'id': f"{self.user_id}:{self.seq}", 'from': self._user(),
+                                         'chat_instance': str(self.user_id), 'data': payload,
+                                         'message': self._message('menu')}}
+        else:
+            update = {'update_id': self.api.next_update_id(), 'message': self._message(payload)}
+
+        reply = self.api.expect_reply(self.user_id)
+        sent_at = time.perf_counter()
+        await self.api.deliver(update)
+        try:
+            replied_at = await asyncio.wait_for(reply, timeout=self.args.step_timeout)
+            self.stats.record(flow, (replied_at - sent_at) * 1000)
+        except asyncio.TimeoutError:
+            self.api.waiters.pop(self.user_id, None)
+            self.stats.timeout(flow)
+
+    async def think(self):
+        if self.args.think_ms:
+            await asyncio.sleep(self.rng.uniform(0, self.args.think_ms) / 1000)
+
+    async def run(self, deadline: float):
+        await asyncio.sleep(self.rng.uniform(0, self.args.ramp))
+        await self.send('start', 'text', '/start')
+
+        flows = list(FLOW_WEIGHTS)
+        weights = list(FLOW_WEIGHTS.values())
+        actions = 0
+        while actions < self.args.actions and time.perf_counter() < deadline:
+            flow = self.rng.choices(flows, weights)[0]
+            product_id = self.rng.randint(1, self.sizes['products'])
+
+            if flow == 'browse':
+                await self.send(flow, 'callback', 'shop')
+                await self.think()
+                await self.send(flow, 'callback', f"category_{self.rng.randint(1, 9)}")
+                await self.think()
+                await self.send(flow, 'callback', f"view_product_{product_id}")
+            elif flow == 'buy':
+                await self.send(flow, 'callback', f"view_product_{product_id}")
+                await self.think()
+                await self.send(flow, 'callback', f"buy_product_{product_id}")
+            elif flow == 'promo':
+                await self.send(flow, 'callback', 'promo')
+                await self.think()
+                await self.send(flow, 'text', benchmark.BENCH_PROMO)
+            else:
+                await self.send(flow, 'callback', 'profile')
+                await self.think()
+                await self.send(flow, 'callback', 'my_orders')
+
+            actions += 1
+            await self.think()
+
+
+async def run_drop(shoppers: list, db_path: Path, units: int) -> dict:
+    """Распродажа: все покупатели одновременно открывают и покупают товар с остатком units"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    product_id = conn.execute("SELECT id FROM products WHERE is_active = 1 ORDER BY id LIMIT 1").fetchone()[0]
+    with conn:
+        conn.execute("DELETE FROM stock_holds WHERE product_id = ?", (product_id,))
+        conn.execute("UPDATE products SET stock = ?, price = 1 WHERE id = ?", (units, product_id))
+        conn.executemany("UPDATE users SET balance = balance + 1 WHERE user_id = ?",
+                         [(shopper.user_id,) for shopper in shoppers])
+    orders_before = conn.execute("SELECT COUNT(*) FROM orders WHERE product_id = ?", (product_id,)).fetchone()[0]
+
+    async def buy(shopper: Shopper):
+        await shopper.send('drop', 'callback', f"view_product_{product_id}")
+        await shopper.send('drop', 'callback', f"buy_product_{product_id}")
+
+    await asyncio.gather(*(buy(shopper) for shopper in shoppers))
+
+    sold = conn.execute("SELECT COUNT(*) FROM orders WHERE product_id = ?", (product_id,)).fetchone()[0] - orders_before
+    stock = conn.execute("SELECT stock FROM products WHERE id = ?", (product_id,)).fetchone()[0]
+    holds = conn.execute("SELECT COUNT(*) FROM stock_holds WHERE product_id = ?", (product_id,)).fetchone()[0]
+    conn.close()
+    return {'product_id': product_id, 'units': units, 'buyers': len(shoppers),
+            'sold': sold, 'stock': stock, 'holds': holds}
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.timeouts = Counter()
+        self.first_reply = None
+        self.last_reply = None
+
+    def record(self, flow: str, latency_ms: float):
+        now = time.perf_counter()
+        self.first_reply = self.first_reply or now
+        self.last_reply = now
+        self.latencies[flow].append(latency_ms)
+
+    def timeout(self, flow: str):
+        self.timeouts[flow] += 1
+
+
+def summarize(values: list) -> dict:
+    if not values:
+        return {'count': 0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    return {
+        'count': len(values),
+        'p50': benchmark.percentile(values, 50),
+        'p95': benchmark.percentile(values, 95),
+        'p99': benchmark.percentile(values, 99),
+        'max': max(values),
+    }
+
+
+# ============ ПРОЦЕСС БОТА ============
+async def pipe_lines(stream, counters: Counter, echo: bool):
+    """Читает stderr бота и считает ошибки и признаки блокировок"""
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        text = line.decode('utf-8', errors='replace')
+        if ' - ERROR - ' in text:
+            counters['errors'] += 1
+            if echo and counters['errors'] <= 5:
+                sys.stderr.write(f"[bot] {text}")
+        lowered = text.lower()
+        if 'database is locked' in lowered or 'database table is locked' in lowered:
+            counters['lock_errors'] += 1
+
+
+async def start_bot(workdir: Path, api_url: str, extra_env: dict) -> asyncio.subprocess.Process:
+    env = dict(os.environ)
+    env.update({'BOT_TOKEN': TOKEN, 'BOT_API_URL': api_url, 'PYTHONUNBUFFERED': '1'})
+    env.update(extra_env)
+    return await asyncio.create_subprocess_exec(
+        sys.executable, str(benchmark.REPO_DIR / 'main.py'),
+        cwd=str(workdir), env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+    )
+
+
+async def stop_bot(process: asyncio.subprocess.Process):
+    if process.returncode is None:
+        process.send_signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(process.wait(), timeout=15)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def bot_ready(api: FakeBotAPI, webhook_url: str) -> bool:
+    if not webhook_url:
+        return api.calls['getUpdates'] > 0
+    try:
+        async with api.session.get(webhook_url.rsplit('/', 1)[0] + '/healthz') as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+async def check_webhook_secret(session: ClientSession, webhook_url: str):
+    """Апдейт с неверным секретом должен отклоняться"""
+    update = {'update_id': 0, 'message': {'message_id': 0, 'date': 0, 'chat': {'id': 1, 'type': 'private'}}}
+    for headers in ({}, {'X-Telegram-Bot-Api-Secret-Token': 'wrong'}):
+        async with session.post(webhook_url, json=update, headers=headers) as response:
+            if response.status != 403:
+                raise SystemExit(f"❌ Webhook принял апдейт без верного секрета (HTTP {response.status})")
+    print("🔐 Webhook отклоняет апдейты без верного секретного токена", flush=True)
+
+
+def slow_log_offsets(main, workdir: Path) -> dict:
+    """Размеры файлов отчета о медленных запросах (у каждого процесса бота свой) до теста"""
+    pattern = main.SLOW_QUERY_LOG.replace('.log', '*.log')
+    return {path: path.stat().st_size for path in workdir.glob(pattern)}
+
+
+def slow_query_report(main, workdir: Path, offsets: dict) -> list:
+    """Медленные запросы, записанные ботом за время теста"""
+    entries = []
+    for path in sorted(workdir.glob(main.SLOW_QUERY_LOG.replace('.log', '*.log'))):
+        with open(path, encoding='utf-8') as f:
+            f.seek(offsets.get(path, 0))
+            for line in f:
+                try:
+                    entries.append(json.loads(line.split(' - ', 1)[1]))
+                except (IndexError, ValueError):
+                    continue
+    return entries
+
+
+async def run(args):
+    workdir = Path(args.workdir).resolve()
+    main = benchmark.prepare_workdir(argparse.Namespace(
+        workdir=str(workdir), scale=args.scale, seed=args.seed, regenerate=args.regenerate))
+    sizes = main.BENCH_SIZES
+    logging.getLogger().setLevel(logging.WARNING)
+    slow_offsets = slow_log_offsets(main, workdir)
+
+    extra_env = {'SLOW_QUERY_MS': str(args.slow_ms), 'WORKERS': str(args.workers)}
+    webhook_url = None
+    if args.webhook:
+        webhook_port = free_port()
+        webhook_url = f"http://127.0.0.1:{webhook_port}/telegram"
+        extra_env.update({'BOT_MODE': 'webhook', 'WEBHOOK_LISTEN': '127.0.0.1', 'WEBHOOK_PORT': str(webhook_port),
+                          'WEBHOOK_PATH': '/telegram', 'WEBHOOK_SECRET': WEBHOOK_SECRET, 'WEBHOOK_URL': ''})
+
+    api = FakeBotAPI(webhook_url, args.api_latency_ms)
+    api.session = ClientSession()
+    runner = web.AppRunner(api.app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', args.port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    api_url = f"http://127.0.0.1:{port}/bot"
+
+    counters = Counter()
+    process = await start_bot(workdir, api_url, extra_env)
+    reader = asyncio.create_task(pipe_lines(process.stderr, counters, args.verbose))
+
+    # Ждем, пока бот начнет принимать апдейты
+    started = time.perf_counter()
+    while not await bot_ready(api, webhook_url):
+        if process.returncode is not None or time.perf_counter() - started > 60:
+            raise SystemExit("❌ Бот не запустился, смотрите bot.log в рабочей директории")
+        await asyncio.sleep(0.1)
+    if webhook_url:
+        await check_webhook_secret(api.session, webhook_url)
+
+    rng = random.Random(args.seed)
+    stats = Stats()
+    last_user = benchmark.USER_ID_BASE + sizes['users'] - 1
+    user_ids = rng.sample(range(benchmark.WHALE_ID + 1, last_user + 1), min(args.users, sizes['users'] - 4))
+    shoppers = [Shopper(api, stats, user_id, sizes, args, random.Random(user_id)) for user_id in user_ids]
+
+    print(f"🚀 {len(shoppers)} покупателей, до {args.actions} действий, лимит {args.duration} с", flush=True)
+    run_started = time.perf_counter()
+    deadline = run_started + args.duration
+    await asyncio.gather(*(shopper.run(deadline) for shopper in shoppers))
+    wall = time.perf_counter() - run_started
+
+    drop = None
+    if args.drop:
+        print(f"🔥 Распродажа: {len(shoppers)} покупателей на {args.drop} шт.", flush=True)
+        drop = await run_drop(shoppers, workdir / main.DB_FILE, args.drop)
+
+    await stop_bot(process)
+    await reader
+    await api.session.close()
+    await runner.cleanup()
+
+    report(args, stats, counters, api, wall, slow_query_report(main, workdir, slow_offsets), drop)
+
+
+def report(args, stats: Stats, counters: Counter, api: FakeBotAPI, wall: float, slow: list, drop: dict = None):
+    completed = sum(len(values) for values in stats.latencies.values())
+    timeouts = sum(stats.timeouts.values())
+    total = completed + timeouts
+    steady = (stats.last_reply - stats.first_reply) if stats.first_reply and stats.last_reply else wall
+
+    print("=" * 72)
+    print(f"Апдейтов обработано: {completed} из {total} за {wall:.1f} с")
+    print(f"Пропускная способность: {completed / steady if steady else 0:.1f} апдейтов/с")
+    print(f"Ошибки: таймауты {timeouts}, ошибок в логе бота {counters['errors']}, "
+          f"доля {((timeouts + counters['errors']) / total * 100) if total else 0:.2f}%")
+    if api.webhook_url:
+        print(f"Ошибок доставки на webhook: {api.delivery_errors}")
+    print(f"Вызовы Bot API: {dict(api.calls)}")
+    print()
+    print(f"{'flow':<10} {'count':>8} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'max ms':>10} {'timeouts':>9}")
+    everything = []
+    for flow in ['start'] + list(FLOW_WEIGHTS) + (['drop'] if drop else []):
+        values = stats.latencies.get(flow, [])
+        everything += values
+        s = summarize(values)
+        print(f"{flow:<10} {s['count']:>8} {s['p50']:>10.1f} {s['p95']:>10.1f} {s['p99']:>10.1f} "
+              f"{s['max']:>10.1f} {stats.timeouts[flow]:>9}")
+    s = summarize(everything)
+    print(f"{'total':<10} {s['count']:>8} {s['p50']:>10.1f} {s['p95']:>10.1f} {s['p99']:>10.1f} "
+          f"{s['max']:>10.1f} {timeouts:>9}")
+    print()
+
+    if drop:
+        expected = min(drop['units'], drop['buyers'])
+        ok = drop['sold'] == expected and drop['stock'] == drop['units'] - drop['sold'] and not drop['holds']
+        print(f"{'✅' if ok else '❌'} Распродажа товара {drop['product_id']}: продано {drop['sold']} из "
+              f"{drop['units']} шт. (ожидалось {expected}), остаток {drop['stock']}, висящих броней {drop['holds']}")
+        print()
+
+    # Признаки конкуренции за блокировки SQLite
+    print(f"🔒 Ошибок 'database is locked': {counters['lock_errors']}")
+    print(f"🐢 Медленных запросов (>= {args.slow_ms:g} мс): {len(slow)}")
+    writes = [e for e in slow if e['query'].split()[0].upper() in ('INSERT', 'UPDATE', 'DELETE')]
+    if writes:
+        print(f"   из них записей: {len(writes)}, медиана {statistics.median(e['ms'] for e in writes):.1f} мс "
+              f"(долгие записи обычно означают ожидание блокировки)")
+    by_query = Counter(e['query'][:90] for e in slow)
+    for query, count in by_query.most_common(5):
+        print(f"   {count:>5} × {query}")
+    if counters['lock_errors'] or len(writes) > completed * 0.01:
+        print("⚠️  Обнаружена конкуренция за блокировки базы данных")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота через фейковый Bot API")
+    parser.add_argument('--users', type=int, default=1000, help="одновременных покупателей")
+    parser.add_argument('--actions', type=int, default=10, help="сценариев на покупателя")
+    parser.add_argument('--duration', type=float, default=300, help="ограничение по времени, с")
+    parser.add_argument('--ramp', type=float, default=5, help="разгон, с")
+    parser.add_argument('--think-ms', type=float, default=200, help="пауза покупателя между шагами")
+    parser.add_argument('--step-timeout', type=float, default=30, help="таймаут ответа бота, с")
+    parser.add_argument('--slow-ms', type=float, default=50, help="порог медленного запроса в боте")
+    parser.add_argument('--scale', type=float, default=0.05, help="объем синтетических данных")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--port', type=int, default=0, help="порт фейкового Bot API (0 - любой)")
+    parser.add_argument('--workdir', default=str(benchmark.REPO_DIR / 'bench_data' / 'loadtest'))
+    parser.add_argument('--api-latency-ms', type=float, default=30, help="задержка ответа Bot API")
+    parser.add_argument('--drop', type=int, default=0,
+                        help="после основного прогона распродать товар с таким остатком всем покупателям сразу")
+    parser.add_argument('--workers', type=int, default=1, help="число процессов-обработчиков бота")
+    parser.add_argument('--webhook', action='store_true', help="доставлять апдейты через webhook бота")
+    parser.add_argument('--regenerate', action='store_true')
+    parser.add_argument('--verbose', action='store_true', help="показывать первые ошибки бота")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main_cli()
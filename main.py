@@ -1,34 +1,55 @@
-#import asyncio
+import asyncio
 import csv
+import hmac
 import json
 import logging
+import multiprocessing
 import os
 import random
+import re
+import secrets
+import signal
 import sqlite3
+import ssl
 import string
 import time
 import sys
+import html
+import importlib.util
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Any
-from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple, Any
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
 import aiofiles
 
+import httpx
+from aiohttp import ClientError, ClientSession, web
 from dotenv import load_dotenv
 load_dotenv()
 
 # Импорты для python-telegram-bot 20.x
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
+    ApplicationBuilder,
+    BasePersistence,
+    PersistenceInput,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     filters,
     ContextTypes,
     ConversationHandler,
+    BaseUpdateProcessor,
+    ExtBot,
+    TypeHandler,
+    ApplicationHandlerStop,
 )
-from telegram.error import TelegramError
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 
 # Импорты для matplotlib
 import matplotlib
@@ -43,10 +64,42 @@ TOKEN = os.getenv('BOT_TOKEN')
 if not TOKEN:
     raise ValueError("Токен бота не найден.")
 
+# Адрес Bot API (можно указать локальный Bot API сервер)
+BOT_API_URL = os.getenv('BOT_API_URL', 'https://api.telegram.org/bot')
+
+# Сколько апдейтов обрабатывается одновременно (апдейты одного пользователя - строго по очереди)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '64'))
+# Соединений с Bot API: по одному на апдейт плюс запас для уведомлений и фоновых задач
+BOT_API_POOL_SIZE = int(os.getenv('BOT_API_POOL_SIZE', str(MAX_CONCURRENT_UPDATES + 8)))
+# Сколько секунд простаивающее соединение остается открытым (у httpx по умолчанию 5)
+BOT_API_KEEPALIVE = float(os.getenv('BOT_API_KEEPALIVE', '60'))
+# HTTP/2 к Bot API: auto - если адрес https и установлен пакет h2 (pip install "httpx[http2]")
+BOT_API_HTTP2 = os.getenv('BOT_API_HTTP2', 'auto')
+# Число процессов-обработчиков; при WORKERS > 1 апдейты делятся между ними по user_id
+WORKERS = int(os.getenv('WORKERS', '1'))
+# Как часто (сек) состояние пользователей сбрасывается в базу
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '30'))
+POLL_TIMEOUT = 10
+# Через сколько секунд бездействия брошенный мастер (ввод промокода, суммы и т.п.) сбрасывается
+WIZARD_TTL = int(os.getenv('WIZARD_TTL', '1800'))
+
+# Режим получения апдейтов: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # публичный адрес, например https://shop.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+# Секрет обязателен: его сверяют все экземпляры бота, и с ним же регистрирует webhook оператор или прокси
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+    raise ValueError("Для режима webhook задайте WEBHOOK_SECRET.")
+# Сертификат и ключ нужны, только если TLS не терминирует прокси перед ботом
+WEBHOOK_CERT = os.getenv('WEBHOOK_CERT', '')
+WEBHOOK_KEY = os.getenv('WEBHOOK_KEY', '')
+
 ADMIN_USERNAME = "@kanvylsia"
 TESTER_USERNAME = "@kanvylsia"
-ADMIN_IDS = set()
-TESTER_IDS = set()
+ADMIN_IDS = set()  # кэш таблицы admins в текущем процессе
 DB_FILE = "shop.db"
 BACKUP_DIR = "backups"
 LOG_FILE = "admin_logs.txt"
@@ -54,6 +107,71 @@ STATS_DIR = "stats"
 CURRENCY = "₪"
 REFERRAL_BONUS_NEW = 2
 REFERRAL_BONUS_INVITER = 3
+SLOW_QUERY_LOG = "slow_queries.log"
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '100'))
+SLOW_QUERY_KEEP = 50
+# Бронь единицы товара при открытии карточки (сек) и период очистки истекших броней
+STOCK_HOLD_TTL = int(os.getenv('STOCK_HOLD_TTL', '300'))
+HOLD_SWEEP_INTERVAL = 30
+# Таблицы больше этого числа строк получают новые индексы в фоне, а не при запуске
+ONLINE_INDEX_ROWS = 100_000
+# Как часто (сек) балансы сверяются с журналом операций
+LEDGER_RECONCILE_INTERVAL = 3600
+# Покупок на одной странице истории
+ORDERS_PAGE_SIZE = 10
+# Рефералов на одной странице списка и сколько уровней приглашений учитывается
+REFERRALS_PAGE_SIZE = 20
+REFERRAL_LEVELS = 3
+# Заявок на пополнение на одной странице админки
+DEPOSIT_REQUESTS_PAGE_SIZE = 10
+# Как часто (сек) процесс сверяет версию каталога: правка товаров видна покупателям не позже
+CATALOG_POLL_INTERVAL = float(os.getenv('CATALOG_POLL_INTERVAL', '2'))
+# Платежная система: manual - реквизиты и проверка админом, mock - локальный тестовый провайдер
+PAYMENT_PROVIDER = os.getenv('PAYMENT_PROVIDER', 'manual')
+# Куда провайдер присылает уведомления о платежах
+PAYMENT_LISTEN = os.getenv('PAYMENT_LISTEN', '127.0.0.1')
+PAYMENT_PORT = int(os.getenv('PAYMENT_PORT', '8081'))
+PAYMENT_CALLBACK_PATH = '/payments/callback'
+# Ключ подписи уведомлений; обязателен для провайдеров с уведомлениями, токен бота им не подменяется
+PAYMENT_SECRET = os.getenv('PAYMENT_SECRET', '')
+# Через сколько секунд тестовый провайдер "оплачивает" счет
+MOCK_PAYMENT_DELAY = float(os.getenv('MOCK_PAYMENT_DELAY', '2'))
+# Сколько сообщений помнит кеш правок: повторная правка тем же содержимым не уходит в Telegram
+EDIT_CACHE_SIZE = int(os.getenv('EDIT_CACHE_SIZE', '10000'))
+# Лимит исходящих уведомлений (сообщений в секунду на все процессы бота)
+NOTIFY_RATE = float(os.getenv('NOTIFY_RATE', '25'))
+# Уведомления ждут отправки в таблице notification_outbox и переживают перезапуск.
+# После временной ошибки повтор через 2, 4, 8... секунд (не дольше NOTIFY_RETRY_MAX),
+# после NOTIFY_MAX_ATTEMPTS неудач сообщение остается в очереди со статусом failed
+NOTIFY_MAX_ATTEMPTS = int(os.getenv('NOTIFY_MAX_ATTEMPTS', '8'))
+NOTIFY_RETRY_MAX = float(os.getenv('NOTIFY_RETRY_MAX', '600'))
+# Как часто (сек) отправщик проверяет очередь: повторы и сообщения, поставленные другими процессами
+NOTIFY_POLL_INTERVAL = float(os.getenv('NOTIFY_POLL_INTERVAL', '1'))
+# На сколько секунд процесс забирает пачку уведомлений: если он упадет, их отправит другой
+NOTIFY_LEASE = 60
+# Защита от флуда: у пользователя RATE_LIMIT_BURST действий подряд, дальше RATE_LIMIT_RATE в секунду
+# (0 - без ограничения); RATE_LIMIT_GLOBAL - апдейтов в секунду от всех пользователей вместе (0 - без общего)
+RATE_LIMIT_RATE = float(os.getenv('RATE_LIMIT_RATE', '3'))
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', '10'))
+RATE_LIMIT_GLOBAL = float(os.getenv('RATE_LIMIT_GLOBAL', '300'))
+# Штрафы: после RATE_LIMIT_STRIKES отклоненных действий бот не отвечает RATE_LIMIT_MUTE секунд
+# (каждая следующая пауза вдвое дольше), после RATE_LIMIT_BAN_AFTER пауз - бан (0 - без бана)
+RATE_LIMIT_STRIKES = int(os.getenv('RATE_LIMIT_STRIKES', '20'))
+RATE_LIMIT_MUTE = float(os.getenv('RATE_LIMIT_MUTE', '30'))
+RATE_LIMIT_BAN_AFTER = int(os.getenv('RATE_LIMIT_BAN_AFTER', '5'))
+# Через сколько секунд без нарушений счет пауз начинается заново
+RATE_LIMIT_FORGET = 3600
+# Как часто (сек) процесс перечитывает список заблокированных: /ban мог выполнить другой процесс
+BAN_POLL_INTERVAL = 10
+# Виды операций в журнале (ledger_txns.kind)
+LEDGER_KINDS = {
+    'opening': '📥 Начальный остаток',
+    'deposit': '💵 Пополнение',
+    'purchase': '🛒 Покупка',
+    'promo': '🎫 Промокод',
+    'referral_bonus': '👥 Реферальный бонус',
+    'referral_commission': '💸 Процент с покупки реферала',
+}
 
 
 # Создаем необходимые директории
@@ -71,6 +189,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Отдельный ротируемый отчет о медленных SQL-запросах
+slow_query_logger = logging.getLogger('slow_queries')
+slow_query_logger.propagate = False
+
+def open_slow_query_log(shard: Optional[int] = None):
+    """Файл отчета процесса: у каждого обработчика свой, иначе процессы портят друг другу ротацию"""
+    path = SLOW_QUERY_LOG if shard is None else SLOW_QUERY_LOG.replace('.log', f'.worker-{shard}.log')
+    for handler in list(slow_query_logger.handlers):
+        slow_query_logger.removeHandler(handler)
+        handler.close()
+    handler = RotatingFileHandler(path, maxBytes=1024 * 1024, backupCount=3, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+    slow_query_logger.addHandler(handler)
+
+def slow_query_log_files() -> List[Path]:
+    """Текущие файлы отчета всех процессов (без ротированных копий)"""
+    return sorted(Path('.').glob(SLOW_QUERY_LOG.replace('.log', '*.log')))
+
+open_slow_query_log()
+
 # ============ СИСТЕМА ЛОГИРОВАНИЯ АДМИНСКИХ ДЕЙСТВИЙ ============
 class AdminLogger:
     def __init__(self, log_file: str = LOG_FILE):
@@ -99,219 +237,1128 @@ class AdminLogger:
 admin_logger = AdminLogger()
 
 # ============ БАЗА ДАННЫХ ============
+class OperationError(Exception):
+    """Операция отклонена; текст исключения показывается пользователю"""
+
+def params_shape(params) -> str:
+    """Форма параметров запроса без самих значений (типы и длины строк)"""
+    shape = []
+    for value in params:
+        if isinstance(value, (str, bytes)):
+            shape.append(f"{type(value).__name__}[{len(value)}]")
+        else:
+            shape.append(type(value).__name__)
+    return f"({', '.join(shape)})"
+
+# ============ СХЕМА БАЗЫ ============
+# Индексы не входят в шаги миграций: недостающие строит Database.build_indexes,
+# на больших таблицах - в фоне после запуска бота
+INDEXES = [
+    ("idx_users_balance", "users", "balance"),
+    # Неявный rowid в конце индекса дает ключ (user_id, created_at, id) для страниц истории
+    ("idx_orders_user_date", "orders", "user_id, created_at"),
+    # Витрина категории отдает товары уже в порядке position, без сортировки
+    ("idx_products_category_position", "products", "category_id, is_active, position"),
+    ("idx_promocodes_code", "promocodes", "code, is_active"),
+    ("idx_users_referral", "users", "referral_code"),
+    # Графики продаж читают только этот индекс: выполненные заказы по времени с суммами
+    ("idx_orders_status_date", "orders", "status, created_at, amount"),
+    ("idx_users_last_active", "users", "last_active"),
+    # Список заблокированных для фильтра апдейтов
+    ("idx_users_banned", "users", "is_banned"),
+    ("idx_stock_holds_expires", "stock_holds", "expires_at"),
+    # Выписка пользователя и сверка балансов читают только этот индекс
+    ("idx_ledger_user", "ledger", "user_id, account, txn_id, amount"),
+    # Список рефералов страницами по (join_date, user_id)
+    ("idx_users_referred_by", "users", "referred_by, join_date"),
+    ("idx_referral_tree_descendant", "referral_tree", "descendant_id, depth"),
+    # Очередь админа: ожидающие заявки по id, провайдер проверяется прямо в индексе
+    ("idx_deposit_requests_queue", "deposit_requests", "status, id, provider"),
+    ("idx_deposit_requests_user", "deposit_requests", "user_id, status"),
+    ("idx_deposit_requests_payment", "deposit_requests", "payment_id"),
+    # Последние пользователи и график регистраций
+    ("idx_users_join_date", "users", "join_date"),
+    ("idx_products_active_created", "products", "is_active, created_at"),
+    ("idx_promocodes_created", "promocodes", "created_at"),
+    ("idx_notification_outbox_due", "notification_outbox", "status, next_attempt_at"),
+]
+
+# Шаги миграции схемы; версия базы (PRAGMA user_version) - число примененных шагов
+MIGRATIONS = []
+
+def migration(func):
+    """Регистрирует следующий шаг миграции; уже выпущенные шаги не меняются"""
+    MIGRATIONS.append(func)
+    return func
+
+@migration
+def baseline_schema(db: 'Database', conn: sqlite3.Connection):
+    """Базовая схема: таблицы, недостающие столбцы старых баз, значения по умолчанию"""
+    # Таблица пользователей
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            balance INTEGER DEFAULT 0,
+            total_deposited INTEGER DEFAULT 0,
+            total_spent INTEGER DEFAULT 0,
+            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            referral_code TEXT UNIQUE,
+            referred_by INTEGER,
+            total_referrals INTEGER DEFAULT 0,
+            referral_earnings INTEGER DEFAULT 0,
+            is_banned BOOLEAN DEFAULT 0,
+            ban_reason TEXT,
+            banned_at TIMESTAMP,
+            banned_by INTEGER,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_purchase TIMESTAMP,
+            is_tester BOOLEAN DEFAULT 0,
+            tested_products INTEGER DEFAULT 0,
+            orders_count INTEGER DEFAULT 0
+        )
+    """)
+    
+    # Таблица категорий
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            position INTEGER DEFAULT 0,
+            is_active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Таблица товаров
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT,
+            price INTEGER NOT NULL,
+            category_id INTEGER DEFAULT 1,
+            stock INTEGER DEFAULT -1,
+            is_active BOOLEAN DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            image_path TEXT,
+            position INTEGER DEFAULT 0
+        )
+    """)
+    
+    # Таблица заказов
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            product_name TEXT NOT NULL,
+            quantity INTEGER DEFAULT 1,
+            amount INTEGER NOT NULL,
+            status TEXT DEFAULT 'completed',
+            details TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Таблица промокодов
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS promocodes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT UNIQUE NOT NULL,
+            amount INTEGER NOT NULL,
+            discount_percent INTEGER DEFAULT 0,
+            min_order INTEGER DEFAULT 0,
+            max_uses INTEGER DEFAULT 1,
+            used_count INTEGER DEFAULT 0,
+            user_ids TEXT DEFAULT '',
+            is_active BOOLEAN DEFAULT 1,
+            expires_at TIMESTAMP,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Таблица настроек
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            description TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Брони товаров: забронированная единица уже вычтена из products.stock
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stock_holds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (user_id, product_id)
+        )
+    """)
+    
+    # Журнал движения средств: операция и ее проводки. Сумма проводок
+    # операции всегда 0: счет пользователя ('user') против системного счета
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ledger_txns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            reference TEXT,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            txn_id INTEGER NOT NULL REFERENCES ledger_txns(id),
+            account TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL
+        )
+    """)
+    
+    # Заявки на пополнение: pending -> approved / rejected
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS deposit_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP,
+            processed_by INTEGER,
+            provider TEXT,
+            payment_id TEXT
+        )
+    """)
+    
+    # Дерево приглашений: предок -> потомок на глубине до REFERRAL_LEVELS
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS referral_tree (
+            ancestor_id INTEGER NOT NULL,
+            descendant_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, depth, descendant_id)
+        ) WITHOUT ROWID
+    """)
+    
+    # Администраторы: общие для всех процессов бота
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Незавершенные мастера пользователей (см. ConversationStore)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            code TEXT,
+            amount INTEGER,
+            discount INTEGER,
+            uses INTEGER,
+            expires_at INTEGER NOT NULL
+        )
+    """)
+    
+    # Базы, созданные до версионирования, могут не иметь новых столбцов
+    columns_to_add = {
+        'users': [
+            ('is_tester', 'BOOLEAN DEFAULT 0'),
+            ('tested_products', 'INTEGER DEFAULT 0'),
+            ('orders_count', 'INTEGER DEFAULT 0'),
+        ],
+        'deposit_requests': [
+            ('provider', 'TEXT'),
+            ('payment_id', 'TEXT'),
+        ],
+    }
+    for table_name, columns in columns_to_add.items():
+        existing_columns = {column['name'] for column in conn.execute(f"PRAGMA table_info({table_name})")}
+        for column_name, column_type in columns:
+            if column_name in existing_columns:
+                continue
+            conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+            logger.info(f"Добавлен столбец {table_name}.{column_name}")
+            if column_name == 'orders_count':
+                # Однократно пересчитываем счетчик, дальше его ведет purchase
+                conn.execute("""
+                    UPDATE users SET orders_count = (
+                        SELECT COUNT(*) FROM orders WHERE orders.user_id = users.user_id
+                    )
+                """)
+    
+    # Состояние мастеров теперь хранится в conversation_state
+    conn.execute("DROP TABLE IF EXISTS user_data")
+    
+    # Создание дефолтных категорий
+    default_categories = [
+        (1, 'Разное', 1),
+        (2, 'Гриф - Броня', 2),
+        (3, 'Гриф - Кит', 3),
+        (4, 'Гриф - Зелье', 4),
+        (5, 'Гриф - Инструменты', 5),
+        (6, 'Анархия - Броня', 6),
+        (7, 'Анархия - Кит', 7),
+        (8, 'Анархия - Зелье', 8),
+        (9, 'Анархия - Инструменты', 9),
+    ]
+    
+    for cat_id, cat_name, pos in default_categories:
+        conn.execute("""
+            INSERT OR IGNORE INTO categories (id, name, position) 
+            VALUES (?, ?, ?)
+        """, (cat_id, cat_name, pos))
+    
+    # Дефолтные настройки: только недостающие, правки админа не перезаписываются
+    default_settings = [
+        ('shop_name', 'Мой магазин', 'Название магазина'),
+        ('welcome_message', 'Добро пожаловать в наш магазин!', 'Приветственное сообщение'),
+        ('currency', '₪', 'Валюта'),
+        ('min_deposit', '100', 'Минимальная сумма пополнения'),
+        ('max_deposit', '10000', 'Максимальная сумма пополнения'),
+        ('referral_bonus_new', '2', 'Бонус за регистрацию по реферальной ссылке'),
+        ('referral_bonus_inviter', '3', 'Бонус пригласившему'),
+        ('admin_notifications', '1', 'Уведомления администраторам'),
+        ('maintenance_mode', '0', 'Режим техобслуживания'),
+        ('support_contact', '@kanvylsia', 'Контакты поддержки'),
+        ('terms_url', '', 'Ссылка на правила'),
+        ('faq_url', '', 'Ссылка на FAQ'),
+        ('ref_percent', '10', 'Процент с покупок реферала')
+    ]
+    
+    for key, value, description in default_settings:
+        conn.execute("""
+            INSERT OR IGNORE INTO settings (key, value, description, updated_at) 
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        """, (key, value, description))
+    
+    # Приглашения, сделанные до появления дерева
+    if not conn.execute("SELECT 1 FROM referral_tree LIMIT 1").fetchone():
+        db._fill_referral_tree(conn)
+    
+    # Балансы, появившиеся до журнала, заносим в него начальными остатками
+    if not conn.execute("SELECT 1 FROM ledger LIMIT 1").fetchone():
+        db._post_opening_balances(conn)
+
+@migration
+def drop_superseded_indexes(db: 'Database', conn: sqlite3.Connection):
+    """Индексы, замененные более широкими с тем же началом ключа (их строит build_indexes)"""
+    conn.execute("DROP INDEX IF EXISTS idx_orders_status")
+    conn.execute("DROP INDEX IF EXISTS idx_products_category")
+
+# Текстовое время старых баз записано в UTC (CURRENT_TIMESTAMP), кроме сроков
+# промокодов: их писал datetime.now().isoformat() в местном времени
+LOCAL_TIME_COLUMNS = {('promocodes', 'expires_at')}
+EPOCH_DEFAULT = "(CAST(strftime('%s', 'now') AS INTEGER))"
+
+@migration
+def epoch_timestamps(db: 'Database', conn: sqlite3.Connection):
+    """Столбцы TIMESTAMP -> INTEGER с секундами Unix, чтобы отборы по времени шли по индексам.
+    SQLite не меняет тип столбца, поэтому таблица пересоздается и копируется.
+    Текст, который strftime не разбирает, стал бы NULL, поэтому такой шаг прерывается"""
+    tables = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    ).fetchall()
+    for table, sql in tables:
+        columns = [(column['name'], column['type'].upper()) for column in conn.execute(f"PRAGMA table_info({table})")]
+        if not any(column_type == 'TIMESTAMP' for _, column_type in columns):
+            continue
+        
+        for name, column_type in columns:
+            if column_type != 'TIMESTAMP':
+                continue
+            unparsed, examples = conn.execute(f"""
+                SELECT COUNT(*), group_concat(value, ', ')
+                FROM (SELECT quote({name}) AS value FROM {table}
+                      WHERE typeof({name}) = 'text' AND strftime('%s', {name}) IS NULL)
+            """).fetchone()
+            if unparsed:
+                # Транзакция миграции откатывается целиком: исходные таблицы остаются как были
+                raise ValueError(
+                    f"{table}.{name}: {unparsed} значений времени не распознано "
+                    f"(например {examples[:200]}). Исправьте их и запустите бота снова."
+                )
+        sql = re.sub(r'TIMESTAMP\s+DEFAULT\s+CURRENT_TIMESTAMP', f'INTEGER DEFAULT {EPOCH_DEFAULT}', sql, flags=re.I)
+        sql = re.sub(r'\bTIMESTAMP\b', 'INTEGER', sql, flags=re.I)
+        sql = re.sub(r'^CREATE TABLE\s+"?\w+"?', f'CREATE TABLE {table}_epoch', sql, flags=re.I)
+        conn.execute(sql)
+        
+        values = []
+        for name, column_type in columns:
+            if column_type != 'TIMESTAMP':
+                values.append(name)
+                continue
+            modifier = ", 'utc'" if (table, name) in LOCAL_TIME_COLUMNS else ""
+            values.append(f"CASE WHEN typeof({name}) = 'text' "
+                          f"THEN CAST(strftime('%s', {name}{modifier}) AS INTEGER) ELSE {name} END")
+        conn.execute(f"""
+            INSERT INTO {table}_epoch ({', '.join(name for name, _ in columns)})
+            SELECT {', '.join(values)} FROM {table}
+        """)
+        # Индексы удаляются вместе с таблицей, build_indexes строит их заново
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_epoch RENAME TO {table}")
+        logger.info(f"Время в таблице {table} переведено в секунды Unix")
+
+@migration
+def catalog_version(db: 'Database', conn: sqlite3.Connection):
+    """Счетчик версии каталога: его увеличивают триггеры на любую правку витрины
+    (и валюты, в которой показаны цены), кто бы ее ни сделал. По нему процессы бота
+    перестраивают снимок каталога"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 1)")
+    bump = "BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END"
+    for table in ('categories', 'products'):
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_catalog_insert AFTER INSERT ON {table} {bump}")
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_catalog_delete AFTER DELETE ON {table} {bump}")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS categories_catalog_update AFTER UPDATE ON categories {bump}")
+    for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS settings_catalog_{event.lower()}
+            AFTER {event} ON settings WHEN {row}.key = 'currency'
+            {bump}
+        """)
+    # Покупки и брони меняют только остаток, он в снимке не хранится. Версию меняет лишь
+    # переход между "без ограничения" (-1) и ограниченным остатком
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS products_catalog_update
+        AFTER UPDATE OF name, description, price, category_id, is_active, position, image_path ON products
+        {bump}
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS products_catalog_stock
+        AFTER UPDATE OF stock ON products WHEN (OLD.stock < 0) <> (NEW.stock < 0)
+        {bump}
+    """)
+
+@migration
+def notification_outbox(db: 'Database', conn: sqlite3.Connection):
+    """Очередь исходящих уведомлений: сообщение хранится до доставки, поэтому переживает
+    перезапуск бота и повторяется после временных ошибок Telegram"""
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            options TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL DEFAULT {EPOCH_DEFAULT},
+            last_error TEXT,
+            created_at INTEGER DEFAULT {EPOCH_DEFAULT}
+        )
+    """)
+
+@migration
+def referral_levels(db: 'Database', conn: sqlite3.Connection):
+    """Счетчики приглашенных по уровням: экран рефералов читает их, не считая дерево.
+    Поддерживаются в транзакции регистрации вместе с деревом"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS referral_levels (
+            ancestor_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, depth)
+        ) WITHOUT ROWID
+    """)
+    db._fill_referral_levels(conn)
+
+@migration
+def deposit_queue_index(db: 'Database', conn: sqlite3.Connection):
+    """Очередь заявок отбирает и по провайдеру; замена индекса строится в build_indexes"""
+    conn.execute("DROP INDEX IF EXISTS idx_deposit_requests_status")
+
+@migration
+def legacy_keys(db: 'Database', conn: sqlite3.Connection):
+    """Ключи строк, перенесенных из старых баз: повторный перенос (migrate_legacy.py --restart)
+    пропускает уже перенесенные заказы и заявки, а не дублирует их"""
+    conn.execute("ALTER TABLE orders ADD COLUMN legacy_id TEXT")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_legacy ON orders(legacy_id) WHERE legacy_id IS NOT NULL")
+    # Дубли от прошлых перезапусков переноса: остается первая копия заявки
+    removed = conn.execute("""
+        DELETE FROM deposit_requests
+        WHERE provider = 'legacy' AND id NOT IN (
+            SELECT MIN(id) FROM deposit_requests WHERE provider = 'legacy' GROUP BY payment_id
+        )
+    """).rowcount
+    if removed:
+        logger.warning(f"Удалено повторно перенесенных заявок: {removed}")
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_deposit_requests_legacy
+        ON deposit_requests(payment_id) WHERE provider = 'legacy'
+    """)
+
 class Database:
-    def __init__(self, db_file: str = DB_FILE):
+    def __init__(self, db_file: str = DB_FILE, slow_query_ms: float = SLOW_QUERY_MS):
         self.db_file = db_file
-        self._init_db()
-        self._migrate_db()
+        self.slow_query_ms = slow_query_ms
+        self.slow_queries = deque(maxlen=SLOW_QUERY_KEEP)
+        self._migrate()
+    
+    def _migrate(self):
+        """Применяет недостающие шаги MIGRATIONS; у актуальной базы это одна проверка версии"""
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                return
+            # WAL: чтение (например, графики в отдельном потоке) не блокирует запись.
+            # Режим хранится в файле базы, вне транзакции его можно включить один раз
+            conn.execute("PRAGMA journal_mode = WAL")
+        finally:
+            conn.close()
+        
+        while version < len(MIGRATIONS):
+            # Версия перечитывается под блокировкой: другой процесс мог уже применить шаг
+            with self.transaction() as conn:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    break
+                step = MIGRATIONS[version]
+                step(self, conn)
+                conn.execute(f"PRAGMA user_version = {version + 1}")
+            version += 1
+            logger.info(f"Схема базы: версия {version} ({step.__name__})")
+        
+        deferred = self.build_indexes(max_rows=ONLINE_INDEX_ROWS)
+        if deferred:
+            logger.info(f"Индексы больших таблиц будут построены в фоне: {', '.join(deferred)}")
+    
+    def build_indexes(self, max_rows: int = None) -> List[str]:
+        """Строит недостающие индексы из INDEXES; возвращает отложенные из-за размера таблицы"""
+        deferred = []
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        try:
+            existing = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            for index_name, table, columns in INDEXES:
+                if index_name in existing:
+                    continue
+                if max_rows is not None and conn.execute(
+                    f"SELECT COUNT(*) FROM (SELECT 1 FROM {table} LIMIT ?)", (max_rows + 1,)
+                ).fetchone()[0] > max_rows:
+                    deferred.append(index_name)
+                    continue
+                started = time.perf_counter()
+                # Чтение в WAL не блокируется, запись ждет окончания сборки
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table}({columns})")
+                logger.info(f"Построен индекс {index_name} за {time.perf_counter() - started:.1f} с")
+        finally:
+            # Соединение закрывается сразу: sqlite3 держит его в цикле ссылок до сборки мусора,
+            # а открытое соединение мешает внешним скриптам сменить режим журнала
+            conn.close()
+        return deferred
+    
+    def execute(self, query: str, params: tuple = ()):
+        with sqlite3.connect(self.db_file, check_same_thread=False) as conn:
+            conn.row_factory = sqlite3.Row
+            started = time.perf_counter()
+            cursor = conn.execute(query, params)
+            conn.commit()
+            self._check_slow_query(conn, query, params, started)
+            return cursor
+    
+    def fetchone(self, query: str, params: tuple = ()):
+        with sqlite3.connect(self.db_file, check_same_thread=False) as conn:
+            conn.row_factory = sqlite3.Row
+            started = time.perf_counter()
+            row = conn.execute(query, params).fetchone()
+            self._check_slow_query(conn, query, params, started)
+            return row
     
-    def _init_db(self):
-        """Инициализация базы данных"""
+    def fetchall(self, query: str, params: tuple = ()):
         with sqlite3.connect(self.db_file, check_same_thread=False) as conn:
             conn.row_factory = sqlite3.Row
+            started = time.perf_counter()
+            rows = conn.execute(query, params).fetchall()
+            self._check_slow_query(conn, query, params, started)
+            return rows
+    
+    @contextmanager
+    def transaction(self):
+        """Транзакция с блокировкой на запись с самого начала (BEGIN IMMEDIATE)"""
+        conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+    
+    def _check_slow_query(self, conn: sqlite3.Connection, query: str, params: tuple, started: float):
+        """Записывает запрос в отчет, если он выполнялся дольше порога"""
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms < self.slow_query_ms:
+            return
+        
+        try:
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+        except sqlite3.Error as e:
+            plan = [f"EXPLAIN недоступен: {e}"]
+        
+        entry = {
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'ms': round(elapsed_ms, 1),
+            'query': ' '.join(query.split()),
+            'params': params_shape(params),
+            'plan': plan,
+        }
+        self.slow_queries.append(entry)
+        slow_query_logger.warning(json.dumps(entry, ensure_ascii=False))
+    
+    def hold_stock(self, user_id: int, product_id: int, ttl: int) -> Tuple[Optional[int], Optional[int]]:
+        """Бронь единицы товара за пользователем; возвращает (время окончания брони или None, свободный остаток).
+        Товар, удаленный после снимка каталога, дает (None, None)"""
+        expires_at = int(time.time()) + ttl
+        with self.transaction() as conn:
+            held = conn.execute(
+                "UPDATE stock_holds SET expires_at = ? WHERE user_id = ? AND product_id = ?",
+                (expires_at, user_id, product_id)
+            ).rowcount
+            if not held:
+                held = conn.execute(
+                    "UPDATE products SET stock = stock - 1 WHERE id = ? AND stock > 0",
+                    (product_id,)
+                ).rowcount
+                if held:
+                    conn.execute(
+                        "INSERT INTO stock_holds (product_id, user_id, expires_at) VALUES (?, ?, ?)",
+                        (product_id, user_id, expires_at)
+                    )
+            product = conn.execute("SELECT stock FROM products WHERE id = ?", (product_id,)).fetchone()
+        if not product:
+            return None, None
+        return (expires_at if held else None), product['stock']
+    
+    def purchase(self, user_id: int, product_id: int) -> Tuple[sqlite3.Row, int]:
+        """Покупка единицы товара одной транзакцией; возвращает товар и новый баланс"""
+        with self.transaction() as conn:
+            product = conn.execute(
+                "SELECT id, name, price, stock FROM products WHERE id = ? AND is_active = 1", (product_id,)
+            ).fetchone()
+            if not product:
+                raise OperationError("❌ Товар не найден!")
             
-            conn.execute("PRAGMA foreign_keys = ON")
+            user = conn.execute("SELECT balance, referred_by FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            balance = user['balance'] if user else 0
+            if balance < product['price']:
+                raise OperationError(f"❌ Недостаточно средств! Нужно {format_price(product['price'])}")
+            
+            # Отрицательный остаток - товар без ограничения количества
+            if product['stock'] >= 0:
+                # Сначала забираем свою бронь, без нее - свободную единицу
+                taken = conn.execute(
+                    "DELETE FROM stock_holds WHERE user_id = ? AND product_id = ?", (user_id, product_id)
+                ).rowcount
+                if not taken and not conn.execute(
+                    "UPDATE products SET stock = stock - 1 WHERE id = ? AND stock > 0", (product_id,)
+                ).rowcount:
+                    raise OperationError("❌ Товар закончился!")
+            
+            order_id = conn.execute("""
+                INSERT INTO orders (user_id, product_id, product_name, amount, quantity)
+                VALUES (?, ?, ?, ?, 1)
+            """, (user_id, product['id'], product['name'], product['price'])).lastrowid
+            self._post(conn, user_id, -product['price'], 'sales', 'purchase', f"order:{order_id}")
+            conn.execute(
+                """UPDATE users SET total_spent = total_spent + ?, orders_count = orders_count + 1,
+                   last_purchase = ? WHERE user_id = ?""",
+                (product['price'], int(time.time()), user_id)
+            )
             
-            # Таблица пользователей
+            # Процент пригласившему - в той же транзакции, что и списание
+            if user['referred_by']:
+                percent = conn.execute("SELECT value FROM settings WHERE key = 'ref_percent'").fetchone()
+                commission = product['price'] * int(percent['value'] or 0) // 100 if percent else 0
+                if commission > 0 and conn.execute(
+                    "UPDATE users SET referral_earnings = referral_earnings + ? WHERE user_id = ?",
+                    (commission, user['referred_by'])
+                ).rowcount:
+                    self._post(conn, user['referred_by'], commission, 'referrals', 'referral_commission',
+                               f"order:{order_id}")
+            
+            # Оповещение о заказе фиксируется вместе с ним: без заказа не уйдет, с заказом не потеряется
+            self._enqueue_admin_alert(
+                conn, f"🛒 Заказ #{order_id}: {product['name']} за {format_price(product['price'])} от {user_id}"
+            )
+        
+        return product, balance - product['price']
+    
+    def release_expired_holds(self) -> int:
+        """Возвращает в остаток единицы из истекших броней"""
+        now = int(time.time())
+        with self.transaction() as conn:
             conn.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    balance INTEGER DEFAULT 0,
-                    total_deposited INTEGER DEFAULT 0,
-                    total_spent INTEGER DEFAULT 0,
-                    join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    referral_code TEXT UNIQUE,
-                    referred_by INTEGER,
-                    total_referrals INTEGER DEFAULT 0,
-                    referral_earnings INTEGER DEFAULT 0,
-                    is_banned BOOLEAN DEFAULT 0,
-                    ban_reason TEXT,
-                    banned_at TIMESTAMP,
-                    banned_by INTEGER,
-                    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_purchase TIMESTAMP,
-                    is_tester BOOLEAN DEFAULT 0,
-                    tested_products INTEGER DEFAULT 0
+                UPDATE products SET stock = stock + (
+                    SELECT COUNT(*) FROM stock_holds h
+                    WHERE h.product_id = products.id AND h.expires_at <= ?
                 )
-            """)
-            
-            # Таблица категорий
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS categories (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT UNIQUE NOT NULL,
-                    position INTEGER DEFAULT 0,
-                    is_active BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                WHERE id IN (SELECT product_id FROM stock_holds WHERE expires_at <= ?)
+            """, (now, now))
+            return conn.execute("DELETE FROM stock_holds WHERE expires_at <= ?", (now,)).rowcount
+    
+    def enqueue_notifications(self, messages: List[Tuple[int, str, Optional[str]]]):
+        """Ставит сообщения (chat_id, текст, параметры в JSON) в очередь уведомлений"""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO notification_outbox (chat_id, text, options) VALUES (?, ?, ?)", messages
+            )
+    
+    def enqueue_admin_alert(self, text: str, options: str = None):
+        """Уведомление всем администраторам, если они включены в настройках"""
+        with self.transaction() as conn:
+            self._enqueue_admin_alert(conn, text, options)
+    
+    def _enqueue_admin_alert(self, conn: sqlite3.Connection, text: str, options: str = None):
+        """Уведомление администраторам внутри уже открытой транзакции"""
+        conn.execute("""
+            INSERT INTO notification_outbox (chat_id, text, options)
+            SELECT user_id, ?, ? FROM admins
+            WHERE EXISTS (SELECT 1 FROM settings WHERE key = 'admin_notifications' AND value = '1')
+        """, (text, options))
+    
+    def claim_notifications(self, limit: int, lease: int) -> List[sqlite3.Row]:
+        """Забирает подошедшие уведомления; до конца аренды их не возьмет другой процесс"""
+        now = int(time.time())
+        with self.transaction() as conn:
+            rows = conn.execute("""
+                UPDATE notification_outbox SET next_attempt_at = ?
+                WHERE id IN (
+                    SELECT id FROM notification_outbox
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at
+                    LIMIT ?
                 )
-            """)
-            
-            # Таблица товаров
+                RETURNING id, chat_id, text, options, attempts
+            """, (now + lease, now, limit)).fetchall()
+        # RETURNING не сохраняет порядок, отправляем в порядке постановки
+        return sorted(rows, key=lambda row: row['id'])
+    
+    def finish_notifications(self, notification_ids: List[int]):
+        """Убирает из очереди доставленные уведомления"""
+        if not notification_ids:
+            return
+        with self.transaction() as conn:
+            conn.executemany(
+                "DELETE FROM notification_outbox WHERE id = ?", [(notification_id,) for notification_id in notification_ids]
+            )
+    
+    def postpone_notifications(self, notification_ids: List[int], retry_at: int):
+        """Переносит отправку без учета попытки (лимит Telegram, остановка бота)"""
+        if not notification_ids:
+            return
+        with self.transaction() as conn:
+            conn.executemany(
+                "UPDATE notification_outbox SET next_attempt_at = ? WHERE id = ?",
+                [(retry_at, notification_id) for notification_id in notification_ids]
+            )
+    
+    def notification_failed(self, notification_id: int, error: str, retry_at: Optional[int]):
+        """Неудачная попытка: повтор в retry_at, без него - статус failed (сообщение остается для разбора)"""
+        self.execute("""
+            UPDATE notification_outbox
+            SET attempts = attempts + 1, last_error = ?,
+                status = CASE WHEN ? IS NULL THEN 'failed' ELSE 'pending' END,
+                next_attempt_at = COALESCE(?, next_attempt_at)
+            WHERE id = ?
+        """, (error, retry_at, retry_at, notification_id))
+    
+    def due_notifications(self) -> int:
+        """Сколько уведомлений ждет отправки прямо сейчас"""
+        return self.fetchone(
+            "SELECT COUNT(*) AS count FROM notification_outbox WHERE status = 'pending' AND next_attempt_at <= ?",
+            (int(time.time()),)
+        )['count']
+    
+    def get_outbox_stats(self) -> List[sqlite3.Row]:
+        """Очередь уведомлений по статусам: всего, к отправке сейчас, самое старое"""
+        return self.fetchall("""
+            SELECT status, COUNT(*) AS count, SUM(next_attempt_at <= ?) AS due, MIN(created_at) AS oldest
+            FROM notification_outbox
+            GROUP BY status
+        """, (int(time.time()),))
+    
+    def _post(self, conn: sqlite3.Connection, user_id: int, amount: int, account: str,
+              kind: str, reference: str = None) -> int:
+        """Операция в журнале: amount на счет пользователя, -amount на системный счет; меняет баланс"""
+        txn_id = conn.execute(
+            "INSERT INTO ledger_txns (kind, reference, created_at) VALUES (?, ?, ?)",
+            (kind, reference, int(time.time()))
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO ledger (txn_id, account, user_id, amount) VALUES (?, ?, ?, ?)",
+            [(txn_id, 'user', user_id, amount), (txn_id, account, user_id, -amount)]
+        )
+        conn.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+        return txn_id
+    
+    def _credit_deposit(self, conn: sqlite3.Connection, user_id: int, amount: int, reference: str = None):
+        """Проводка пополнения внутри уже открытой транзакции"""
+        self._post(conn, user_id, amount, 'deposits', 'deposit', reference)
+        conn.execute(
+            "UPDATE users SET total_deposited = total_deposited + ? WHERE user_id = ?", (amount, user_id)
+        )
+    
+    def deposit(self, user_id: int, amount: int, reference: str = None):
+        """Зачисление пополнения на баланс"""
+        with self.transaction() as conn:
+            self._credit_deposit(conn, user_id, amount, reference)
+    
+    def create_deposit_request(self, user_id: int, amount: int, provider: str = None) -> int:
+        """Заявка на пополнение; без провайдера повторное нажатие возвращает уже ожидающую заявку"""
+        if provider:
+            # У каждого счета провайдера своя заявка
+            return self.execute(
+                "INSERT INTO deposit_requests (user_id, amount, provider) VALUES (?, ?, ?)",
+                (user_id, amount, provider)
+            ).lastrowid
+        with self.transaction() as conn:
+            pending = conn.execute(
+                "SELECT id FROM deposit_requests "
+                "WHERE user_id = ? AND status = 'pending' AND amount = ? AND provider IS NULL",
+                (user_id, amount)
+            ).fetchone()
+            if pending:
+                return pending['id']
+            return conn.execute(
+                "INSERT INTO deposit_requests (user_id, amount) VALUES (?, ?)", (user_id, amount)
+            ).lastrowid
+    
+    def get_pending_deposits(self, after_id: int = 0,
+                             limit: int = DEPOSIT_REQUESTS_PAGE_SIZE) -> Tuple[List[sqlite3.Row], bool]:
+        """Страница ожидающих заявок (старые сверху) и признак, что есть еще.
+        Только ручные и перенесенные: счет провайдера закрывает его уведомление (apply_payment)"""
+        rows = self.fetchall("""
+            SELECT r.id, r.user_id, r.amount, r.created_at, u.username, u.first_name
+            FROM deposit_requests r
+            LEFT JOIN users u ON u.user_id = r.user_id
+            WHERE r.status = 'pending' AND (r.provider IS NULL OR r.provider = 'legacy') AND r.id > ?
+            ORDER BY r.id
+            LIMIT ?
+        """, (after_id, limit + 1))
+        return rows[:limit], len(rows) > limit
+    
+    def get_pending_deposit_request(self, user_id: int, amount: int, provider: str) -> Optional[sqlite3.Row]:
+        """Ожидающая заявка пользователя на ту же сумму у того же провайдера"""
+        return self.fetchone("""
+            SELECT id, payment_id FROM deposit_requests
+            WHERE user_id = ? AND status = 'pending' AND amount = ? AND provider = ?
+            ORDER BY id DESC LIMIT 1
+        """, (user_id, amount, provider))
+    
+    def attach_payment(self, request_id: int, payment_id: str):
+        """Связывает заявку со счетом у провайдера"""
+        self.execute("UPDATE deposit_requests SET payment_id = ? WHERE id = ?", (payment_id, request_id))
+    
+    def apply_payment(self, payment_id: str, amount: int, succeeded: bool) -> Optional[sqlite3.Row]:
+        """Итог платежа от провайдера; повторное уведомление ничего не меняет.
+        Возвращает заявку, если ее статус изменился"""
+        with self.transaction() as conn:
+            request = conn.execute(
+                "SELECT id, user_id, amount, status FROM deposit_requests WHERE payment_id = ?", (payment_id,)
+            ).fetchone()
+            if not request:
+                raise OperationError(f"Неизвестный платеж {payment_id}")
+            if request['status'] != 'pending':
+                return None
+            if succeeded and amount != request['amount']:
+                # Оставляем заявку админу: зачислять сумму, которую не выставляли, нельзя
+                logger.error(f"Платеж {payment_id}: оплачено {amount} вместо {request['amount']}")
+                return None
             conn.execute("""
-                CREATE TABLE IF NOT EXISTS products (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    description TEXT,
-                    price INTEGER NOT NULL,
-                    category_id INTEGER DEFAULT 1,
-                    stock INTEGER DEFAULT -1,
-                    is_active BOOLEAN DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    image_path TEXT,
-                    position INTEGER DEFAULT 0
-                )
-            """)
-            
-            # Таблица заказов
+                UPDATE deposit_requests SET status = ?, processed_at = ?
+                WHERE id = ?
+            """, ('approved' if succeeded else 'rejected', int(time.time()), request['id']))
+            if succeeded:
+                self._credit_deposit(conn, request['user_id'], amount, f"payment:{payment_id}")
+        return request
+    
+    def settle_deposit_requests(self, first_id: int, last_id: int, approve: bool,
+                                admin_id: int) -> List[sqlite3.Row]:
+        """Подтверждение или отклонение ожидающих заявок с id в [first_id, last_id] одной транзакцией.
+        Счета провайдеров из диапазона не трогаются: их оплату подтверждает только провайдер"""
+        with self.transaction() as conn:
+            requests = conn.execute("""
+                SELECT id, user_id, amount FROM deposit_requests
+                WHERE status = 'pending' AND (provider IS NULL OR provider = 'legacy') AND id BETWEEN ? AND ?
+            """, (first_id, last_id)).fetchall()
+            if not requests:
+                return []
             conn.execute("""
-                CREATE TABLE IF NOT EXISTS orders (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    product_id INTEGER NOT NULL,
-                    product_name TEXT NOT NULL,
-                    quantity INTEGER DEFAULT 1,
-                    amount INTEGER NOT NULL,
-                    status TEXT DEFAULT 'completed',
-                    details TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+                UPDATE deposit_requests SET status = ?, processed_at = ?, processed_by = ?
+                WHERE status = 'pending' AND (provider IS NULL OR provider = 'legacy') AND id BETWEEN ? AND ?
+            """, ('approved' if approve else 'rejected', int(time.time()), admin_id, first_id, last_id))
+            if approve:
+                for request in requests:
+                    self._credit_deposit(conn, request['user_id'], request['amount'], f"request:{request['id']}")
+        return requests
+    
+    def redeem_promo(self, user_id: int, code: str) -> int:
+        """Активация промокода одной транзакцией; возвращает начисленную сумму"""
+        with self.transaction() as conn:
+            promo = conn.execute("""
+                SELECT code, amount, max_uses, used_count, is_active, expires_at
+                FROM promocodes 
+                WHERE code = ? AND is_active = 1
+            """, (code,)).fetchone()
             
-            # Таблица промокодов
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS promocodes (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    code TEXT UNIQUE NOT NULL,
-                    amount INTEGER NOT NULL,
-                    discount_percent INTEGER DEFAULT 0,
-                    min_order INTEGER DEFAULT 0,
-                    max_uses INTEGER DEFAULT 1,
-                    used_count INTEGER DEFAULT 0,
-                    user_ids TEXT DEFAULT '',
-                    is_active BOOLEAN DEFAULT 1,
-                    expires_at TIMESTAMP,
-                    created_by INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+            if not promo:
+                raise OperationError("❌ Промокод не найден или неактивен!")
             
-            # Таблица настроек
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL,
-                    description TEXT,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+            # Проверяем срок действия
+            if promo['expires_at'] and promo['expires_at'] < time.time():
+                raise OperationError("❌ Промокод истек!")
             
-            # Создание дефолтных категорий
-            default_categories = [
-                (1, 'Разное', 1),
-                (2, 'Гриф - Броня', 2),
-                (3, 'Гриф - Кит', 3),
-                (4, 'Гриф - Зелье', 4),
-                (5, 'Гриф - Инструменты', 5),
-                (6, 'Анархия - Броня', 6),
-                (7, 'Анархия - Кит', 7),
-                (8, 'Анархия - Зелье', 8),
-                (9, 'Анархия - Инструменты', 9),
-            ]
+            # Проверяем количество использований
+            if promo['max_uses'] > 0 and promo['used_count'] >= promo['max_uses']:
+                raise OperationError("❌ Промокод уже использован максимальное количество раз!")
             
-            for cat_id, cat_name, pos in default_categories:
+            conn.execute("UPDATE promocodes SET used_count = used_count + 1 WHERE code = ?", (code,))
+            self._post(conn, user_id, promo['amount'], 'promo', 'promo', code)
+        return promo['amount']
+    
+    def register_user(self, user_id: int, username: str, first_name: str, referral_code: str,
+                      referred_by: int = None):
+        """Регистрация пользователя и реферальные бонусы одной транзакцией"""
+        now = int(time.time())
+        with self.transaction() as conn:
+            conn.execute("""
+                INSERT INTO users (user_id, username, first_name, referral_code, referred_by, join_date, last_active)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (user_id, username, first_name, referral_code, referred_by, now, now))
+            
+            # Если есть реферер, начисляем бонусы
+            if referred_by:
+                self._post(conn, user_id, REFERRAL_BONUS_NEW, 'referrals', 'referral_bonus', f"referrer:{referred_by}")
+                self._post(conn, referred_by, REFERRAL_BONUS_INVITER, 'referrals', 'referral_bonus', f"referral:{user_id}")
+                conn.execute(
+                    """UPDATE users SET total_referrals = total_referrals + 1,
+                       referral_earnings = referral_earnings + ? WHERE user_id = ?""",
+                    (REFERRAL_BONUS_INVITER, referred_by)
+                )
+                # Новый пользователь становится потомком реферера и всех его предков
                 conn.execute("""
-                    INSERT OR IGNORE INTO categories (id, name, position) 
-                    VALUES (?, ?, ?)
-                """, (cat_id, cat_name, pos))
-            
-            # Дефолтные настройки
-            default_settings = [
-                ('shop_name', 'Мой магазин', 'Название магазина'),
-                ('welcome_message', 'Добро пожаловать в наш магазин!', 'Приветственное сообщение'),
-                ('currency', '₪', 'Валюта'),
-                ('min_deposit', '100', 'Минимальная сумма пополнения'),
-                ('max_deposit', '10000', 'Максимальная сумма пополнения'),
-                ('referral_bonus_new', '2', 'Бонус за регистрацию по реферальной ссылке'),
-                ('referral_bonus_inviter', '3', 'Бонус пригласившему'),
-                ('admin_notifications', '1', 'Уведомления администраторам'),
-                ('maintenance_mode', '0', 'Режим техобслуживания'),
-                ('support_contact', '@kanvylsia', 'Контакты поддержки'),
-                ('terms_url', '', 'Ссылка на правила'),
-                ('faq_url', '', 'Ссылка на FAQ'),
-                ('ref_percent', '10', 'Процент с покупок реферала')
-            ]
-            
-            for key, value, description in default_settings:
+                    INSERT INTO referral_tree (ancestor_id, descendant_id, depth)
+                    SELECT ?, ?, 1
+                    UNION ALL
+                    SELECT ancestor_id, ?, depth + 1 FROM referral_tree
+                    WHERE descendant_id = ? AND depth < ?
+                """, (referred_by, user_id, user_id, referred_by, REFERRAL_LEVELS))
+                # И попадает в счетчик каждого из них на своем уровне
                 conn.execute("""
-                    INSERT OR REPLACE INTO settings (key, value, description, updated_at) 
-                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-                """, (key, value, description))
-            
-            conn.commit()
-            logger.info("База данных успешно инициализирована")
+                    INSERT INTO referral_levels (ancestor_id, depth, total)
+                    SELECT ancestor_id, depth, 1 FROM referral_tree WHERE descendant_id = ?
+                    ON CONFLICT (ancestor_id, depth) DO UPDATE SET total = total + 1
+                """, (user_id,))
     
-    def _migrate_db(self):
-        """Добавляем новые столбцы в существующую базу"""
-        with sqlite3.connect(self.db_file, check_same_thread=False) as conn:
-            conn.row_factory = sqlite3.Row
-            
-            # Проверяем существующие столбцы
-            columns_to_add = [
-                ('is_tester', 'BOOLEAN DEFAULT 0'),
-                ('tested_products', 'INTEGER DEFAULT 0'),
-            ]
-            
-            for column_name, column_type in columns_to_add:
-                try:
-                    cursor = conn.execute(f"PRAGMA table_info(users)")
-                    existing_columns = [column[1] for column in cursor.fetchall()]
-                    
-                    if column_name not in existing_columns:
-                        conn.execute(f"ALTER TABLE users ADD COLUMN {column_name} {column_type}")
-                        logger.info(f"Добавлен столбец {column_name}")
-                except Exception as e:
-                    logger.error(f"Ошибка добавления {column_name}: {e}")
-            
-            # Создаем индексы
-            indexes = [
-                ("idx_users_balance", "users(balance)"),
-                ("idx_orders_user_date", "orders(user_id, created_at)"),
-                ("idx_products_category", "products(category_id, is_active)"),
-                ("idx_promocodes_code", "promocodes(code, is_active)"),
-                ("idx_users_referral", "users(referral_code)"),
-                ("idx_orders_status", "orders(status)"),
-                ("idx_users_last_active", "users(last_active)"),
-            ]
-            
-            for index_name, index_columns in indexes:
-                try:
-                    conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {index_columns}")
-                except Exception as e:
-                    logger.error(f"Ошибка при создании индекса {index_name}: {e}")
-            
-            conn.commit()
-            logger.info("Миграция базы данных завершена")
+    def rebuild_referral_tree(self) -> int:
+        """Заново строит дерево приглашений по users.referred_by"""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM referral_tree")
+            linked = self._fill_referral_tree(conn)
+            self._fill_referral_levels(conn)
+            return linked
     
-    def execute(self, query: str, params: tuple = ()):
-        with sqlite3.connect(self.db_file, check_same_thread=False) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.execute(query, params)
-            conn.commit()
-            return cursor
+    def _fill_referral_tree(self, conn: sqlite3.Connection) -> int:
+        return conn.execute("""
+            INSERT OR IGNORE INTO referral_tree (ancestor_id, descendant_id, depth)
+            WITH RECURSIVE tree(ancestor_id, descendant_id, depth) AS (
+                SELECT referred_by, user_id, 1 FROM users WHERE referred_by IS NOT NULL
+                UNION ALL
+                SELECT u.referred_by, t.descendant_id, t.depth + 1
+                FROM tree t JOIN users u ON u.user_id = t.ancestor_id
+                WHERE u.referred_by IS NOT NULL AND t.depth < ?
+            )
+            SELECT ancestor_id, descendant_id, depth FROM tree
+        """, (REFERRAL_LEVELS,)).rowcount
     
-    def fetchone(self, query: str, params: tuple = ()):
+    def _fill_referral_levels(self, conn: sqlite3.Connection):
+        """Пересчет счетчиков уровней по всему дереву"""
+        conn.execute("DELETE FROM referral_levels")
+        conn.execute("""
+            INSERT INTO referral_levels (ancestor_id, depth, total)
+            SELECT ancestor_id, depth, COUNT(*) FROM referral_tree GROUP BY ancestor_id, depth
+        """)
+    
+    def get_referral_levels(self, user_id: int) -> Dict[int, int]:
+        """Количество приглашенных по уровням: {глубина: человек}"""
+        rows = self.fetchall("SELECT depth, total FROM referral_levels WHERE ancestor_id = ?", (user_id,))
+        return {row['depth']: row['total'] for row in rows}
+    
+    def get_referrals_page(self, user_id: int, after_id: int = None,
+                           limit: int = REFERRALS_PAGE_SIZE) -> Tuple[List[sqlite3.Row], bool]:
+        """Страница приглашенных пользователем (новые сверху) и признак, что есть еще"""
+        if after_id is None:
+            rows = self.fetchall("""
+                SELECT user_id, username, first_name, join_date
+                FROM users
+                WHERE referred_by = ?
+                ORDER BY join_date DESC, user_id DESC
+                LIMIT ?
+            """, (user_id, limit + 1))
+        else:
+            rows = self.fetchall("""
+                SELECT user_id, username, first_name, join_date
+                FROM users
+                WHERE referred_by = ?
+                  AND (join_date, user_id) < (SELECT join_date, user_id FROM users WHERE user_id = ?)
+                ORDER BY join_date DESC, user_id DESC
+                LIMIT ?
+            """, (user_id, after_id, limit + 1))
+        return rows[:limit], len(rows) > limit
+    
+    def _ledger_mismatches(self, conn: sqlite3.Connection, limit: int = -1) -> List[sqlite3.Row]:
+        """Пользователи, у которых баланс не совпадает с суммой проводок"""
+        return conn.execute("""
+            SELECT u.user_id, u.balance, COALESCE(l.total, 0) AS ledger_balance
+            FROM users u
+            LEFT JOIN (
+                SELECT user_id, SUM(amount) AS total FROM ledger
+                WHERE account = 'user' GROUP BY user_id
+            ) l ON l.user_id = u.user_id
+            WHERE u.balance != COALESCE(l.total, 0)
+            LIMIT ?
+        """, (limit,)).fetchall()
+    
+    def post_opening_balances(self) -> int:
+        """Вносит в журнал начальные остатки для балансов, которых в нем нет"""
+        with self.transaction() as conn:
+            return self._post_opening_balances(conn)
+    
+    def _post_opening_balances(self, conn: sqlite3.Connection) -> int:
+        rows = self._ledger_mismatches(conn)
+        if not rows:
+            return 0
+        txn_id = conn.execute(
+            "INSERT INTO ledger_txns (kind, created_at) VALUES ('opening', ?)", (int(time.time()),)
+        ).lastrowid
+        entries = []
+        for row in rows:
+            diff = row['balance'] - row['ledger_balance']
+            entries += [(txn_id, 'user', row['user_id'], diff), (txn_id, 'opening', row['user_id'], -diff)]
+        conn.executemany("INSERT INTO ledger (txn_id, account, user_id, amount) VALUES (?, ?, ?, ?)", entries)
+        return len(rows)
+    
+    def reconcile_ledger(self, limit: int = 20) -> Dict[str, Any]:
+        """Сверка балансов с журналом"""
+        started = time.perf_counter()
         with sqlite3.connect(self.db_file, check_same_thread=False) as conn:
             conn.row_factory = sqlite3.Row
-            cursor = conn.execute(query, params)
-            return cursor.fetchone()
+            # Одно чтение: сверка видит согласованный снимок
+            conn.execute("BEGIN")
+            mismatches = self._ledger_mismatches(conn, limit)
+            total = conn.execute("SELECT COALESCE(SUM(amount), 0) AS total FROM ledger").fetchone()['total']
+            conn.execute("COMMIT")
+        return {
+            'mismatches': [dict(row) for row in mismatches],
+            'ledger_total': total,
+            'ms': round((time.perf_counter() - started) * 1000, 1),
+        }
     
-    def fetchall(self, query: str, params: tuple = ()):
+    def get_statement(self, user_id: int, limit: int = 10) -> List[sqlite3.Row]:
+        """Последние операции по счету пользователя"""
+        return self.fetchall("""
+            SELECT t.kind, t.reference, t.created_at, l.amount
+            FROM ledger l
+            JOIN ledger_txns t ON t.id = l.txn_id
+            WHERE l.user_id = ? AND l.account = 'user'
+            ORDER BY l.txn_id DESC
+            LIMIT ?
+        """, (user_id, limit))
+    
+    def get_catalog_version(self) -> int:
+        return self.fetchone("SELECT version FROM catalog_version WHERE id = 1")['version']
+    
+    def load_catalog(self) -> Tuple[int, List[sqlite3.Row], List[sqlite3.Row], str]:
+        """Версия каталога, все категории, активные товары и валюта для снимка.
+        Версия читается первой: правка во время чтения даст новый снимок при следующей сверке"""
+        version = self.get_catalog_version()
+        currency = self.fetchone("SELECT value FROM settings WHERE key = 'currency'")
+        categories = self.fetchall("SELECT id, name, is_active FROM categories ORDER BY position, id")
+        products = self.fetchall("""
+            SELECT p.id, p.name, p.description, p.price, p.stock, p.category_id, c.name AS category_name
+            FROM products p
+            LEFT JOIN categories c ON p.category_id = c.id
+            WHERE p.is_active = 1
+            ORDER BY p.category_id, p.position, p.id
+        """)
+        return version, categories, products, currency['value'] if currency else CURRENCY
+    
+    def get_stock(self, product_ids: List[int]) -> Dict[int, int]:
+        """Текущие остатки товаров"""
+        placeholders = ', '.join('?' * len(product_ids))
+        rows = self.fetchall(f"SELECT id, stock FROM products WHERE id IN ({placeholders})", tuple(product_ids))
+        return {row['id']: row['stock'] for row in rows}
+    
+    def get_orders_page(self, user_id: int, after_id: int = None,
+                        limit: int = ORDERS_PAGE_SIZE) -> Tuple[List[sqlite3.Row], bool]:
+        """Страница истории покупок после заказа after_id и признак, что есть более старые"""
+        if after_id is None:
+            rows = self.fetchall("""
+                SELECT id, product_name, amount, quantity, created_at
+                FROM orders
+                WHERE user_id = ?
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            """, (user_id, limit + 1))
+        else:
+            # Ключ (created_at, id) последнего показанного заказа: страница не зависит от глубины
+            rows = self.fetchall("""
+                SELECT id, product_name, amount, quantity, created_at
+                FROM orders
+                WHERE user_id = ?
+                  AND (created_at, id) < (SELECT created_at, id FROM orders WHERE id = ? AND user_id = ?)
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            """, (user_id, after_id, user_id, limit + 1))
+        return rows[:limit], len(rows) > limit
+    
+    def get_banned_ids(self) -> Set[int]:
+        """Заблокированные пользователи"""
+        return {row['user_id'] for row in self.fetchall("SELECT user_id FROM users WHERE is_banned = 1")}
+    
+    def is_admin(self, user_id: int) -> bool:
+        """Есть ли пользователь в таблице администраторов"""
+        return self.fetchone("SELECT 1 FROM admins WHERE user_id = ?", (user_id,)) is not None
+    
+    def get_admin_ids(self) -> Set[int]:
+        """Администраторы из таблицы admins"""
+        return {row['user_id'] for row in self.fetchall("SELECT user_id FROM admins")}
+    
+    def save_conversation_states(self, updated: List[tuple], dropped: List[Tuple[int]]):
+        """Запись состояний мастеров одной транзакцией"""
         with sqlite3.connect(self.db_file, check_same_thread=False) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.execute(query, params)
-            return cursor.fetchall()
+            conn.executemany("""
+                INSERT OR REPLACE INTO conversation_state
+                    (user_id, state, code, amount, discount, uses, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, updated)
+            conn.executemany("DELETE FROM conversation_state WHERE user_id = ?", dropped)
+    
+    def add_admin(self, user_id: int, username: str = None):
+        """Добавление администратора"""
+        self.execute(
+            "INSERT OR IGNORE INTO admins (user_id, username) VALUES (?, ?)",
+            (user_id, username)
+        )
     
     def get_stats(self, days: int = 30):
         """Получение статистики"""
@@ -320,7 +1367,7 @@ class Database:
         try:
             stats['total_users'] = self.fetchone("SELECT COUNT(*) as count FROM users")['count']
             stats['active_users'] = self.fetchone(
-                "SELECT COUNT(*) as count FROM users WHERE last_active > datetime('now', '-7 day')"
+                "SELECT COUNT(*) as count FROM users WHERE last_active > ?", (int(time.time()) - 7 * 86400,)
             )['count']
             stats['banned_users'] = self.fetchone(
                 "SELECT COUNT(*) as count FROM users WHERE is_banned = 1"
@@ -344,7 +1391,7 @@ class Database:
             stats['total_orders'] = self.fetchone("SELECT COUNT(*) as count FROM orders")['count']
             stats['total_revenue'] = self.fetchone("SELECT SUM(amount) as sum FROM orders WHERE status = 'completed'")['sum'] or 0
             
-            today = datetime.now().strftime('%Y-%m-%d')
+            today = datetime.now()
             
             today_stats = self.fetchone("""
                 SELECT 
@@ -352,8 +1399,8 @@ class Database:
                     SUM(amount) as revenue,
                     COUNT(DISTINCT user_id) as unique_buyers
                 FROM orders 
-                WHERE DATE(created_at) = ? AND status = 'completed'
-            """, (today,))
+                WHERE status = 'completed' AND created_at BETWEEN ? AND ?
+            """, epoch_range(today, today))
             
             if today_stats:
                 stats['today_orders'] = today_stats['orders_count'] or 0
@@ -386,6 +1433,233 @@ class Database:
 # Инициализируем базу данных
 db = Database()
 
+# ============ СОСТОЯНИЕ МАСТЕРОВ ============
+class WizardState:
+    """Шаг многошагового ввода пользователя и уже введенные значения"""
+    __slots__ = ('state', 'code', 'amount', 'discount', 'uses', 'expires_at')
+    
+    def __init__(self, state: str, code: str = None, amount: int = None, discount: int = None,
+                 uses: int = None, expires_at: int = 0):
+        self.state = state
+        self.code = code
+        self.amount = amount
+        self.discount = discount
+        self.uses = uses
+        self.expires_at = expires_at
+    
+    def pack(self, user_id: int) -> tuple:
+        """Строка таблицы conversation_state"""
+        return (user_id, self.state, self.code, self.amount, self.discount, self.uses, self.expires_at)
+
+class ConversationStore:
+    """Состояния мастеров в памяти с истечением по TTL; изменения копятся до записи в базу"""
+    
+    def __init__(self, ttl: int = WIZARD_TTL):
+        self.ttl = ttl
+        self._states: Dict[int, WizardState] = {}
+        self._dirty: set = set()
+    
+    def get(self, user_id: int) -> Optional[WizardState]:
+        wizard = self._states.get(user_id)
+        if wizard is not None and wizard.expires_at <= time.time():
+            self.clear(user_id)
+            return None
+        return wizard
+    
+    def start(self, user_id: int, state: str, ttl: int = None) -> WizardState:
+        """Начать мастер заново (незавершенный предыдущий сбрасывается)"""
+        wizard = self._states[user_id] = WizardState(state, expires_at=int(time.time()) + (ttl or self.ttl))
+        self._dirty.add(user_id)
+        return wizard
+    
+    def advance(self, user_id: int, state: str, ttl: int = None, **values):
+        """Перейти к следующему шагу, сохранив введенные значения"""
+        wizard = self._states[user_id]
+        wizard.state = state
+        for name, value in values.items():
+            setattr(wizard, name, value)
+        wizard.expires_at = int(time.time()) + (ttl or self.ttl)
+        self._dirty.add(user_id)
+    
+    def clear(self, user_id: int):
+        if self._states.pop(user_id, None) is not None:
+            self._dirty.add(user_id)
+    
+    def evict_expired(self) -> int:
+        """Сбросить брошенные мастера"""
+        now = time.time()
+        expired = [user_id for user_id, wizard in self._states.items() if wizard.expires_at <= now]
+        for user_id in expired:
+            self.clear(user_id)
+        return len(expired)
+    
+    def load(self, rows):
+        now = time.time()
+        for row in rows:
+            if row['expires_at'] > now:
+                self._states[row['user_id']] = WizardState(
+                    row['state'], row['code'], row['amount'], row['discount'], row['uses'], row['expires_at']
+                )
+    
+    def mark_changed(self, user_ids):
+        self._dirty.update(user_ids)
+    
+    def take_changes(self) -> Tuple[List[tuple], List[Tuple[int]]]:
+        """Накопленные изменения: строки для записи и id для удаления"""
+        updated, dropped = [], []
+        for user_id in self._dirty:
+            wizard = self._states.get(user_id)
+            if wizard is None:
+                dropped.append((user_id,))
+            else:
+                updated.append(wizard.pack(user_id))
+        self._dirty.clear()
+        return updated, dropped
+    
+    def __len__(self):
+        return len(self._states)
+
+conversations = ConversationStore()
+
+# ============ МАСТЕРА: МАШИНА СОСТОЯНИЙ ============
+class InvalidInput(Exception):
+    """Ввод не прошел проверку; текст исключения показывается пользователю"""
+
+class WizardStep:
+    """Состояние мастера: обработчик ввода, проверка и время ожидания"""
+    __slots__ = ('name', 'handler', 'validate', 'timeout', 'admin_only')
+    
+    def __init__(self, name: str, handler, validate, timeout: int, admin_only: bool):
+        self.name = name
+        self.handler = handler
+        self.validate = validate
+        self.timeout = timeout
+        self.admin_only = admin_only
+
+class StepMetrics:
+    """Счетчики обработки одного состояния"""
+    __slots__ = ('calls', 'rejected', 'errors', 'total_ms', 'max_ms')
+    
+    def __init__(self):
+        self.calls = 0
+        self.rejected = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+class WizardMachine:
+    """Разбор текстовых сообщений по текущему состоянию мастера пользователя"""
+    
+    def __init__(self, store: ConversationStore):
+        self.store = store
+        self.steps: Dict[str, WizardStep] = {}
+        self.metrics: Dict[str, StepMetrics] = {}
+    
+    def state(self, name: str, validate=None, timeout: int = WIZARD_TTL, admin_only: bool = False):
+        """Декоратор: регистрирует обработчик состояния name"""
+        def register(handler):
+            self.steps[name] = WizardStep(name, handler, validate, timeout, admin_only)
+            self.metrics[name] = StepMetrics()
+            return handler
+        return register
+    
+    def start(self, user_id: int, name: str):
+        self.store.start(user_id, name, self.steps[name].timeout)
+    
+    def goto(self, user_id: int, name: str, **values):
+        self.store.advance(user_id, name, self.steps[name].timeout, **values)
+    
+    def finish(self, user_id: int):
+        self.store.clear(user_id)
+    
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """Передает сообщение обработчику текущего состояния; False, если мастер не запущен"""
+        user = update.effective_user
+        wizard = self.store.get(user.id)
+        if wizard is None:
+            return False
+        
+        step = self.steps.get(wizard.state)
+        if step is None:
+            # Состояние, сохраненное предыдущей версией бота
+            self.store.clear(user.id)
+            return False
+        if step.admin_only and not await check_admin_access(user.id, user.username):
+            return False
+        
+        metrics = self.metrics[step.name]
+        started = time.perf_counter()
+        try:
+            value = update.message.text.strip()
+            if step.validate:
+                value = step.validate(value)
+            await step.handler(update, context, wizard, value)
+        except InvalidInput as e:
+            metrics.rejected += 1
+            await update.message.reply_text(str(e))
+        except Exception:
+            metrics.errors += 1
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            metrics.calls += 1
+            metrics.total_ms += elapsed_ms
+            metrics.max_ms = max(metrics.max_ms, elapsed_ms)
+        return True
+
+wizards = WizardMachine(conversations)
+
+# ============ КАТАЛОГ ============
+class CatalogSnapshot:
+    """Витрина на момент версии каталога; после создания не меняется"""
+    __slots__ = ('version', 'categories', 'category_names', 'products', 'by_category', 'currency',
+                 'keyboards')
+    
+    def __init__(self, version: int, categories: List[sqlite3.Row], products: List[sqlite3.Row],
+                 currency: str):
+        self.version = version
+        self.currency = currency
+        # Активные категории в порядке показа; имена нужны и для скрытых
+        self.categories = tuple(category for category in categories if category['is_active'])
+        self.category_names = {category['id']: category['name'] for category in categories}
+        self.products = {product['id']: product for product in products}
+        by_category = defaultdict(list)
+        for product in products:
+            by_category[product['category_id']].append(product)
+        self.by_category = {category_id: tuple(items) for category_id, items in by_category.items()}
+        # Клавиатуры витрины строятся при первом показе и живут, пока жив снимок
+        self.keyboards: Dict[Any, InlineKeyboardMarkup] = {}
+
+class Catalog:
+    """Снимок каталога в памяти процесса: просмотр витрины не обращается к базе.
+    При смене версии в базе снимок строится заново и подменяется одной ссылкой"""
+    
+    def __init__(self, database: Database):
+        self.db = database
+        self.snapshot: Optional[CatalogSnapshot] = None
+        self.rebuilds = 0
+    
+    def current(self) -> CatalogSnapshot:
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = self.reload()
+        return snapshot
+    
+    def reload(self) -> CatalogSnapshot:
+        snapshot = CatalogSnapshot(*self.db.load_catalog())
+        self.snapshot = snapshot
+        self.rebuilds += 1
+        return snapshot
+    
+    def refresh(self) -> bool:
+        """Перестраивает снимок, если каталог в базе изменился"""
+        if self.snapshot is not None and self.db.get_catalog_version() == self.snapshot.version:
+            return False
+        self.reload()
+        return True
+
+catalog = Catalog(db)
+
 # ============ ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ============
 def generate_promo_code(length: int = 8) -> str:
     chars = string.ascii_uppercase + string.digits
@@ -401,30 +1675,37 @@ def generate_referral_code() -> str:
 
 def format_price(amount: int) -> str:
     try:
-        currency = db.fetchone("SELECT value FROM settings WHERE key = 'currency'")
-        currency_symbol = currency['value'] if currency else CURRENCY
-        return f"{amount:,}{currency_symbol}".replace(",", " ")
+        return f"{amount:,}{catalog.current().currency}".replace(",", " ")
     except:
         return f"{amount}{CURRENCY}"
 
-def format_datetime(dt_str: str) -> str:
+def format_datetime(timestamp: Optional[int]) -> str:
+    """Время в секундах Unix в местном формате"""
     try:
-        if not dt_str:
+        if not timestamp:
             return "нет данных"
-        if isinstance(dt_str, str):
-            dt_str = dt_str.replace('Z', '+00:00')
-        dt = datetime.fromisoformat(dt_str)
-        return dt.strftime('%d.%m.%Y %H:%M')
-    except:
-        return str(dt_str)[:16]
+        return datetime.fromtimestamp(timestamp).strftime('%d.%m.%Y %H:%M')
+    except (TypeError, ValueError, OverflowError, OSError):
+        return str(timestamp)[:16]
+
+def epoch_range(first_day: datetime, last_day: datetime) -> Tuple[int, int]:
+    """Границы дней [first_day, last_day] по местному времени в секундах Unix, для BETWEEN"""
+    start = first_day.replace(hour=0, minute=0, second=0, microsecond=0)
+    end = last_day.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    return int(start.timestamp()), int(end.timestamp()) - 1
 
 async def check_admin_access(user_id: int, username: str = None) -> bool:
     """Проверка прав администратора"""
+    if user_id in ADMIN_IDS:
+        return True
+    
     if username and str(username).lower() == ADMIN_USERNAME.lower().replace('@', ''):
+        db.add_admin(user_id, username)
         ADMIN_IDS.add(user_id)
         return True
     
-    if user_id in ADMIN_IDS:
+    if db.is_admin(user_id):
+        ADMIN_IDS.add(user_id)
         return True
     
     user = db.fetchone("SELECT username, is_tester FROM users WHERE user_id = ?", (user_id,))
@@ -432,31 +1713,406 @@ async def check_admin_access(user_id: int, username: str = None) -> bool:
         return True
     
     if user and user['username'] and user['username'].lower() == ADMIN_USERNAME.lower().replace('@', ''):
+        db.add_admin(user_id, user['username'])
         ADMIN_IDS.add(user_id)
         return True
     
     return False
 
-def get_main_menu(user_id: int = None) -> InlineKeyboardMarkup:
-    """Главное меню"""
-    keyboard = [
-        [InlineKeyboardButton("🛍️ Магазин", callback_data="shop")],
-        [InlineKeyboardButton("💰 Баланс", callback_data="balance"),
-         InlineKeyboardButton("👤 Профиль", callback_data="profile")],
-        [InlineKeyboardButton("🎫 Промокод", callback_data="promo"),
-         InlineKeyboardButton("👥 Рефералы", callback_data="referrals")],
-        [InlineKeyboardButton("📦 Мои покупки", callback_data="my_orders"),
-         InlineKeyboardButton("📞 Поддержка", callback_data="support")],
-        [InlineKeyboardButton("ℹ️ Помощь", callback_data="help")]
-    ]
+# ============ ШАБЛОНЫ СООБЩЕНИЙ ============
+# Предел длины сообщения Telegram в UTF-16 единицах
+MESSAGE_LIMIT = 4096
+
+def _escape(value) -> str:
+    if type(value) is not str:
+        return str(value)
+    if '<' in value or '>' in value or '&' in value:
+        return html.escape(value, quote=False)
+    return value
+
+# Фильтры полей шаблона: {amount:price}, {created_at:date}, {block:html}
+TEMPLATE_FILTERS = {
+    '': _escape,
+    'price': format_price,
+    'date': format_datetime,
+    'html': str,
+}
+
+class Template:
+    """Шаблон сообщения, скомпилированный один раз при загрузке модуля.
+    Значения полей экранируются для HTML, если фильтр не говорит иного.
+    
+    render(values, **extra) - values это словарь или строка sqlite3.Row,
+    extra дополняет и перекрывает их; render_list(rows) склеивает строки списка"""
+    __slots__ = ('source', 'fields', 'render', '_render_row')
     
-    # Проверяем, является ли пользователь админом
+    def __init__(self, source: str):
+        self.source = source
+        namespace, pieces, row_pieces, fields = {}, [], [], []
+        for literal, name, spec, conversion in string.Formatter().parse(source):
+            if literal:
+                pieces.append(repr(literal))
+                row_pieces.append(repr(literal))
+            if name is None:
+                continue
+            if not name.isidentifier() or conversion:
+                raise ValueError(f"Поле шаблона должно быть именем без !r/!s: {source[:40]!r}")
+            convert = TEMPLATE_FILTERS.get(spec)
+            if convert is None:
+                convert = lambda value, spec=spec: _escape(format(value, spec))
+            function = f'convert_{len(fields)}'
+            namespace[function] = convert
+            pieces.append(f'f"{{{function}(extra[{name!r}] if {name!r} in extra else values[{name!r}])}}"')
+            row_pieces.append(f'f"{{{function}(values[{name!r}])}}"')
+            fields.append(name)
+        self.fields = tuple(fields)
+        
+        # Шаблон превращается в одну f-строку: соседние литералы Python склеивает
+        # при компиляции, и рендер стоит столько же, сколько написанная вручную f-строка
+        code = (
+            "def render(values=None, /, **extra):\n"
+            "    if values is None:\n"
+            "        values = extra\n"
+            f"    return ({' '.join(pieces) or repr('')})\n"
+            "def render_row(values):\n"
+            f"    return ({' '.join(row_pieces) or repr('')})\n"
+        )
+        exec(compile(code, '<template>', 'exec'), namespace)
+        self.render = namespace['render']
+        self._render_row = namespace['render_row']
+    
+    def render_list(self, rows, separator: str = '') -> str:
+        return separator.join(map(self._render_row, rows))
+
+def _utf16_len(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+def _cut_line(line: str, limit: int) -> List[str]:
+    """Режет строку длиннее лимита, не разрывая тег или HTML-сущность"""
+    pieces = []
+    while _utf16_len(line) > limit:
+        end = limit
+        # Символы вне BMP занимают две единицы: отступаем на величину перебора
+        while _utf16_len(line[:end]) > limit:
+            end -= _utf16_len(line[:end]) - limit
+        head = line[:end]
+        for opener, closer in (('<', '>'), ('&', ';')):
+            position = head.rfind(opener)
+            if position > 0 and closer not in head[position:]:
+                end = position
+                head = line[:end]
+        pieces.append(head)
+        line = line[end:]
+    pieces.append(line)
+    return pieces
+
+def _pack(pieces: List[str], separator: str, limit: int) -> List[str]:
+    chunks, current = [], None
+    for piece in pieces:
+        candidate = piece if current is None else current + separator + piece
+        if _utf16_len(candidate) <= limit:
+            current = candidate
+            continue
+        if current is not None:
+            chunks.append(current)
+        current = piece
+    if current is not None:
+        chunks.append(current)
+    return chunks
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Делит текст на сообщения по абзацам, затем по строкам.
+    Теги в шаблонах закрываются в той же строке, поэтому разметка не рвется"""
+    if _utf16_len(text) <= limit:
+        return [text]
+    paragraphs = []
+    for paragraph in text.split('\n\n'):
+        if _utf16_len(paragraph) <= limit:
+            paragraphs.append(paragraph)
+            continue
+        lines = []
+        for line in paragraph.split('\n'):
+            lines.extend(_cut_line(line, limit))
+        paragraphs.extend(_pack(lines, '\n', limit))
+    return _pack(paragraphs, '\n\n', limit)
+
+async def edit_long_text(query, text: str, reply_markup: InlineKeyboardMarkup = None):
+    """Правит сообщение коллбэка; не поместившееся уходит следующими сообщениями,
+    клавиатура остается под последней частью"""
+    chunks = split_message(text)
+    last = len(chunks) - 1
+    await query.edit_message_text(chunks[0], parse_mode='HTML',
+                                  reply_markup=reply_markup if last == 0 else None)
+    for i, chunk in enumerate(chunks[1:], 1):
+        await query.message.reply_text(chunk, parse_mode='HTML',
+                                        reply_markup=reply_markup if i == last else None)
+
+async def send_long_text(message, text: str, reply_markup: InlineKeyboardMarkup = None):
+    """Ответ на сообщение с разбиением по лимиту Telegram"""
+    chunks = split_message(text)
+    last = len(chunks) - 1
+    for i, chunk in enumerate(chunks):
+        await message.reply_text(chunk, parse_mode='HTML', reply_markup=reply_markup if i == last else None)
+
+WELCOME_TEMPLATE = Template(
+    "\n🎉 <b>Добро пожаловать!</b>\n\n"
+    "👋 Привет, {first_name}!\n"
+    "🆔 Ваш ID: <code>{user_id}</code>\n"
+    "{role}\n\n"
+    "Выберите действие:\n"
+)
+
+STATS_TEMPLATE = Template(
+    "📊 <b>Статистика магазина</b>\n\n"
+    "👥 <b>Всего пользователей:</b> {total_users}\n"
+    "🟢 <b>Активных (7 дней):</b> {active_users}\n"
+    "🔴 <b>Заблокированных:</b> {banned_users}\n"
+    "🧪 <b>Тестеров:</b> {testers_count}\n\n"
+    "💰 <b>Общий баланс пользователей:</b> {total_balance:price}\n\n"
+    "📦 <b>Товаров:</b> {total_products}\n"
+    "📁 <b>Категорий:</b> {total_categories}\n\n"
+    "🛒 <b>Всего заказов:</b> {total_orders}\n"
+    "💵 <b>Общая выручка:</b> {total_revenue:price}\n\n"
+    "📈 <b>Сегодня:</b>\n"
+    "• Заказов: {today_orders}\n"
+    "• Выручка: {today_revenue:price}\n"
+    "• Покупателей: {today_buyers}\n\n"
+    "👥 <b>Реферальная система:</b>\n"
+    "• Всего рефералов: {total_referrals}\n"
+    "• Заработано рефералами: {total_ref_earnings:price}"
+)
+
+# Общая часть профиля и карточки пользователя для админа
+ACCOUNT_TEMPLATE = Template(
+    "💰 <b>Баланс:</b> {balance:price}\n"
+    "💵 <b>Всего пополнено:</b> {total_deposited:price}\n"
+    "🛒 <b>Всего потрачено:</b> {total_spent:price}\n\n"
+    "👥 <b>Реферальная система:</b>\n"
+    "• Код: <code>{referral_code}</code>\n"
+    "• Приглашено: {total_referrals} чел.\n"
+    "• Заработано: {referral_earnings:price}\n\n"
+    "📊 <b>Активность:</b>\n"
+    "• Заказов: {orders_count}\n"
+    "• Регистрация: {join_date:date}\n"
+    "• Последняя активность: {last_active:date}\n"
+    "• Последняя покупка: {last_purchase}"
+)
+
+def render_account(user_info) -> str:
+    """Балансы, рефералы и активность пользователя"""
+    last_purchase = format_datetime(user_info['last_purchase']) if user_info['last_purchase'] else "нет покупок"
+    return ACCOUNT_TEMPLATE.render(user_info, last_purchase=last_purchase)
+
+PROFILE_TEMPLATE = Template(
+    "👤 <b>Ваш профиль</b>\n\n"
+    "📛 <b>Имя:</b> {first_name}\n"
+    "👤 <b>Username:</b> @{username}\n"
+    "🆔 <b>ID:</b> <code>{user_id}</code>\n\n"
+    "{admin_status}\n"
+    "🏷️ <b>Статус:</b> {tester_status}\n"
+    "🛡️ <b>Статус аккаунта:</b> {ban_status}\n\n"
+    "{account:html}"
+)
+
+USER_INFO_TEMPLATE = Template(
+    "👤 <b>Информация о пользователе</b>\n\n"
+    "🆔 <b>ID:</b> <code>{user_id}</code>\n"
+    "👤 <b>Имя:</b> {first_name}\n"
+    "📛 <b>Username:</b> @{username}\n"
+    "🏷️ <b>Статус:</b> {tester_status}\n"
+    "🛡️ <b>Статус аккаунта:</b> {ban_status}{ban_reason}\n\n"
+    "{account:html}"
+)
+
+ADMIN_USER_ROW = Template(
+    "{status} <b>ID:</b> {user_id} | @{username}\n"
+    "👤 {first_name} | 💰 {balance:price}\n\n"
+)
+
+ADMIN_CATEGORY_ROW = Template(
+    "📁 {name}\n"
+    "🆔 {id} | 📊 {count} товаров | #️⃣ {position}\n\n"
+)
+
+ADMIN_PRODUCT_ROW = Template(
+    "🛒 <b>{name}</b>\n"
+    "💰 {price:price} | 📁 {category_name}\n"
+    "📦 {stock_text} | 🆔 {id}\n\n"
+)
+
+TESTER_ROW = Template("👤 ID: {user_id} | @{username} | {first_name}\n")
+
+PROMO_ROW = Template(
+    "{status} <b>{code}</b> - {bonus_text}\n"
+    "📊 Использовано: {uses_text}{expires_text}\n\n"
+)
+
+PROMO_STATS_TEMPLATE = Template(
+    "📊 <b>Статистика промокодов</b>\n\n"
+    "🎫 <b>Всего промокодов:</b> {total}\n"
+    "✅ <b>Активных промокодов:</b> {active}\n"
+    "🔄 <b>Использований промокодов:</b> {used}\n"
+    "💰 <b>Общая сумма выданных бонусов:</b> {amount:price}\n\n"
+    "📈 <b>Топ 5 промокодов по использованию:</b>\n"
+    "{top:html}"
+)
+
+TOP_PROMO_ROW = Template("{place}. {code} - {used_count} использований ({amount:price})\n")
+
+SETTING_ROW = Template("🔑 <b>{key}:</b> {value}\n{description}\n")
+
+LOG_ROW = Template("📄 {line}")
+
+SLOW_QUERY_ROW = Template(
+    "⏱ <b>{ms} мс</b> | {time} | {params}\n"
+    "<code>{query}</code>\n"
+    "{plan:html}\n"
+)
+
+PLAN_STEP_ROW = Template("📋 {step}\n")
+
+WIZARD_METRICS_ROW = Template(
+    "<code>{name}</code>: {calls} шт., ср. {avg_ms:.1f} мс, макс. {max_ms:.1f} мс{problems}\n"
+)
+
+OUTBOX_ROW = Template("{status}: {count} (к отправке сейчас: {due}, самое старое: {oldest:date})\n")
+
+RECONCILE_ROW = Template(
+    "🆔 <code>{user_id}</code>: баланс {balance:price}, по журналу {ledger_balance:price}\n"
+)
+
+ORDER_ROW = Template(
+    "🛒 <b>{product_name}</b>\n"
+    "💰 {amount:price}{quantity_text}\n"
+    "📅 {created_at:date}\n\n"
+)
+
+REFERRAL_ROW = Template(
+    "• {first_name} (@{username})\n"
+    "   🆔 {user_id} | 📅 {join_date:date}\n\n"
+)
+
+DEPOSIT_REQUEST_ROW = Template(
+    "#{id} | {amount:price} | {user_id} (@{username})\n"
+    "📅 {created_at:date}\n\n"
+)
+
+LEDGER_ROW = Template("{created_at:date} {kind}: <b>{sign}{amount:price}</b>\n")
+
+CATEGORY_PRODUCT_ROW = Template(
+    "📦 {name}\n"
+    "💰 {price:price} {stock_text}\n\n"
+)
+
+PRODUCT_TEMPLATE = Template(
+    "📦 <b>{name}</b>\n\n"
+    "📁 <b>Категория:</b> {category_name}\n"
+    "💰 <b>Цена:</b> {price:price}\n"
+    "{stock_text:html}\n\n"
+    "📝 <b>Описание:</b>\n{description}\n\n"
+    "🆔 <b>ID товара:</b> <code>{id}</code>"
+)
+
+PURCHASE_TEMPLATE = Template(
+    "✅ <b>Покупка успешна!</b>\n\n"
+    "📦 <b>Товар:</b> {name}\n"
+    "💰 <b>Цена:</b> {price:price}\n"
+    "💵 <b>Новый баланс:</b> {balance:price}\n\n"
+    "Детали покупки будут отправлены вам в личные сообщения."
+)
+
+RECEIPT_TEMPLATE = Template(
+    "📦 <b>Чек покупки</b>\n\n"
+    "🛒 <b>Товар:</b> {name}\n"
+    "💰 <b>Стоимость:</b> {price:price}\n"
+    "📅 <b>Дата:</b> {date:date}\n"
+    "🆔 <b>ID покупки:</b> {id}\n\n"
+    "💵 <b>Новый баланс:</b> {balance:price}"
+)
+
+PROMO_ACTIVATED_TEMPLATE = Template(
+    "✅ Промокод активирован!\n"
+    "🎫 Код: <code>{code}</code>\n"
+    "💰 Начислено: {amount:price}\n\n"
+    "💸 Ваш баланс пополнен!"
+)
+
+# ============ КЛАВИАТУРЫ ============
+# Разметка Telegram-объектов неизменяема, поэтому одну и ту же клавиатуру
+# можно отдавать всем пользователям, не собирая кнопки на каждый показ
+_MAIN_MENU_ROWS = (
+    (InlineKeyboardButton("🛍️ Магазин", callback_data="shop"),),
+    (InlineKeyboardButton("💰 Баланс", callback_data="balance"),
+     InlineKeyboardButton("👤 Профиль", callback_data="profile")),
+    (InlineKeyboardButton("🎫 Промокод", callback_data="promo"),
+     InlineKeyboardButton("👥 Рефералы", callback_data="referrals")),
+    (InlineKeyboardButton("📦 Мои покупки", callback_data="my_orders"),
+     InlineKeyboardButton("📞 Поддержка", callback_data="support")),
+    (InlineKeyboardButton("ℹ️ Помощь", callback_data="help"),),
+)
+MAIN_MENU = InlineKeyboardMarkup(_MAIN_MENU_ROWS)
+MAIN_MENU_ADMIN = InlineKeyboardMarkup(
+    _MAIN_MENU_ROWS + ((InlineKeyboardButton("👑 Админ-панель", callback_data="admin_panel"),),)
+)
+
+ADMIN_PANEL = InlineKeyboardMarkup((
+    (InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
+     InlineKeyboardButton("👥 Пользователи", callback_data="admin_users")),
+    (InlineKeyboardButton("📦 Товары", callback_data="admin_products"),
+     InlineKeyboardButton("📁 Категории", callback_data="admin_categories")),
+    (InlineKeyboardButton("🎫 Промокоды", callback_data="admin_promocodes"),
+     InlineKeyboardButton("📈 Графики", callback_data="admin_charts")),
+    (InlineKeyboardButton("💾 Бэкап", callback_data="admin_backup"),
+     InlineKeyboardButton("⚙️ Настройки", callback_data="admin_settings")),
+    (InlineKeyboardButton("📝 Логи", callback_data="admin_logs"),
+     InlineKeyboardButton("💳 Заявки", callback_data="admin_deposits")),
+    (InlineKeyboardButton("🔙 Назад", callback_data="main_menu"),),
+))
+
+EMPTY_CATEGORY = InlineKeyboardMarkup((
+    (InlineKeyboardButton("🛍️ В магазин", callback_data="shop"),),
+    (InlineKeyboardButton("🔙 Назад", callback_data="main_menu"),),
+))
+
+# Товаров на странице категории
+CATEGORY_PAGE_SIZE = 20
+
+def get_main_menu(user_id: int = None) -> InlineKeyboardMarkup:
+    """Главное меню; от пользователя зависит только строка админ-панели"""
     if user_id:
         user = db.fetchone("SELECT username, is_tester FROM users WHERE user_id = ?", (user_id,))
         if user and (user['username'] == ADMIN_USERNAME.replace('@', '') or user['is_tester']):
-            keyboard.append([InlineKeyboardButton("👑 Админ-панель", callback_data="admin_panel")])
-    
-    return InlineKeyboardMarkup(keyboard)
+            return MAIN_MENU_ADMIN
+    return MAIN_MENU
+
+def shop_keyboard(snapshot: CatalogSnapshot) -> InlineKeyboardMarkup:
+    """Список категорий для версии каталога"""
+    markup = snapshot.keyboards.get('shop')
+    if markup is None:
+        keyboard = [
+            [InlineKeyboardButton(f"📁 {category['name']}", callback_data=f"category_{category['id']}")]
+            for category in snapshot.categories
+        ]
+        keyboard.append([InlineKeyboardButton("🔍 Поиск товаров", callback_data="search_products")])
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="main_menu")])
+        markup = snapshot.keyboards['shop'] = InlineKeyboardMarkup(keyboard)
+    return markup
+
+def category_keyboard(snapshot: CatalogSnapshot, category_id: int) -> InlineKeyboardMarkup:
+    """Кнопки товаров категории для версии каталога; остаток в них не показывается"""
+    key = ('category', category_id)
+    markup = snapshot.keyboards.get(key)
+    if markup is None:
+        keyboard = [
+            [InlineKeyboardButton(
+                f"🛒 {product['name']} - {format_price(product['price'])}",
+                callback_data=f"view_product_{product['id']}"
+            )]
+            for product in snapshot.by_category.get(category_id, ())[:CATEGORY_PAGE_SIZE]
+        ]
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="shop")])
+        markup = snapshot.keyboards[key] = InlineKeyboardMarkup(keyboard)
+    return markup
 
 # ============ ФУНКЦИИ ДЛЯ СОЗДАНИЯ ПРОМОКОДОВ ============
 def generate_smart_promo_code():
@@ -492,7 +2148,9 @@ async def create_smart_promo(update: Update, context: ContextTypes.DEFAULT_TYPE,
             amount = min(smart_amounts, key=lambda x: abs(x - avg_amount))
         
         if uses is None:
-            active_users = db.fetchone("SELECT COUNT(*) as count FROM users WHERE last_active > datetime('now', '-30 day')")['count']
+            active_users = db.fetchone(
+                "SELECT COUNT(*) as count FROM users WHERE last_active > ?", (int(time.time()) - 30 * 86400,)
+            )['count']
             if active_users > 100:
                 uses = 50
             elif active_users > 50:
@@ -511,7 +2169,7 @@ async def create_smart_promo(update: Update, context: ContextTypes.DEFAULT_TYPE,
         # Создаем дату истечения
         expires_at = None
         if expires_days and expires_days > 0:
-            expires_at = (datetime.now() + timedelta(days=expires_days)).isoformat()
+            expires_at = int(time.time()) + expires_days * 86400
         
         # Создаем промокод в базе данных
         db.execute("""
@@ -543,28 +2201,48 @@ async def create_smart_promo(update: Update, context: ContextTypes.DEFAULT_TYPE,
         raise
 
 # ============ ФУНКЦИИ ДЛЯ ГРАФИКОВ ============
+# pyplot не потокобезопасен, поэтому все графики рисуются в одном отдельном потоке,
+# не блокируя обработку апдейтов других пользователей
+chart_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='charts')
+
+async def run_chart(builder, *args):
+    """Запускает построение графика в потоке графиков"""
+    return await asyncio.get_running_loop().run_in_executor(chart_executor, builder, *args)
+
 async def generate_sales_chart(days: int = 30):
+    """Генерирует график продаж за указанное количество дней"""
+    return await run_chart(build_sales_chart, days)
+
+async def generate_users_chart(days: int = 30):
+    """Генерирует график регистрации пользователей"""
+    return await run_chart(build_users_chart, days)
+
+async def generate_top_products_chart():
+    """Генерирует график топ товаров"""
+    return await run_chart(build_top_products_chart)
+
+async def generate_weekdays_chart():
+    """Генерация графика дохода по дням недели"""
+    return await run_chart(build_weekdays_chart)
+
+def build_sales_chart(days: int = 30):
     """Генерирует график продаж за указанное количество дней"""
     try:
         # Получаем данные о продажах за последние N дней
         end_date = datetime.now()
         start_date = end_date - timedelta(days=days)
         
-        # Форматируем даты для SQL запроса
-        start_str = start_date.strftime('%Y-%m-%d')
-        end_str = end_date.strftime('%Y-%m-%d')
-        
-        # Получаем данные о продажах по дням
+        # Получаем данные о продажах по дням: диапазон по индексу (status, created_at)
         sales_data = db.fetchall("""
-            SELECT DATE(created_at) as date, 
+            SELECT DATE(created_at, 'unixepoch', 'localtime') as date, 
                    COUNT(*) as orders_count,
                    SUM(amount) as revenue
             FROM orders 
-            WHERE DATE(created_at) BETWEEN ? AND ? 
-            AND status = 'completed'
-            GROUP BY DATE(created_at)
+            WHERE status = 'completed'
+            AND created_at BETWEEN ? AND ? 
+            GROUP BY date
             ORDER BY date
-        """, (start_str, end_str))
+        """, epoch_range(start_date, end_date))
         
         if not sales_data:
             return None
@@ -614,25 +2292,22 @@ async def generate_sales_chart(days: int = 30):
         logger.error(f"Ошибка при создании графика продаж: {e}")
         return None
 
-async def generate_users_chart(days: int = 30):
+def build_users_chart(days: int = 30):
     """Генерирует график регистрации пользователей"""
     try:
         # Получаем данные о пользователях за последние N дней
         end_date = datetime.now()
         start_date = end_date - timedelta(days=days)
         
-        start_str = start_date.strftime('%Y-%m-%d')
-        end_str = end_date.strftime('%Y-%m-%d')
-        
         # Получаем данные о регистрациях по дням
         users_data = db.fetchall("""
-            SELECT DATE(join_date) as date, 
+            SELECT DATE(join_date, 'unixepoch', 'localtime') as date, 
                    COUNT(*) as users_count
             FROM users 
-            WHERE DATE(join_date) BETWEEN ? AND ?
-            GROUP BY DATE(join_date)
+            WHERE join_date BETWEEN ? AND ?
+            GROUP BY date
             ORDER BY date
-        """, (start_str, end_str))
+        """, epoch_range(start_date, end_date))
         
         if not users_data:
             return None
@@ -670,7 +2345,7 @@ async def generate_users_chart(days: int = 30):
         logger.error(f"Ошибка при создании графика пользователей: {e}")
         return None
 
-async def generate_top_products_chart():
+def build_top_products_chart():
     """Генерирует график топ товаров"""
     try:
         # Получаем топ 10 товаров по продажам
@@ -730,19 +2405,19 @@ async def generate_top_products_chart():
         logger.error(f"Ошибка при создании графика топ товаров: {e}")
         return None
 
-async def generate_weekdays_chart():
+def build_weekdays_chart():
     """Генерация графика дохода по дням недели"""
     try:
         # Получаем данные о доходах по дням недели
         weekdays_data = db.fetchall("""
             SELECT 
-                strftime('%w', created_at) as weekday,
-                strftime('%w', created_at) as weekday_num,
+                strftime('%w', created_at, 'unixepoch', 'localtime') as weekday,
+                strftime('%w', created_at, 'unixepoch', 'localtime') as weekday_num,
                 COUNT(*) as orders_count,
                 SUM(amount) as revenue
             FROM orders 
             WHERE status = 'completed'
-            GROUP BY strftime('%w', created_at)
+            GROUP BY weekday_num
             ORDER BY weekday_num
         """)
         
@@ -816,25 +2491,7 @@ async def show_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         stats = db.get_stats()
         
-        message = (
-            "📊 <b>Статистика магазина</b>\n\n"
-            f"👥 <b>Всего пользователей:</b> {stats['total_users']}\n"
-            f"🟢 <b>Активных (7 дней):</b> {stats['active_users']}\n"
-            f"🔴 <b>Заблокированных:</b> {stats['banned_users']}\n"
-            f"🧪 <b>Тестеров:</b> {stats['testers_count']}\n\n"
-            f"💰 <b>Общий баланс пользователей:</b> {format_price(stats['total_balance'])}\n\n"
-            f"📦 <b>Товаров:</b> {stats['total_products']}\n"
-            f"📁 <b>Категорий:</b> {stats['total_categories']}\n\n"
-            f"🛒 <b>Всего заказов:</b> {stats['total_orders']}\n"
-            f"💵 <b>Общая выручка:</b> {format_price(stats['total_revenue'])}\n\n"
-            f"📈 <b>Сегодня:</b>\n"
-            f"• Заказов: {stats['today_orders']}\n"
-            f"• Выручка: {format_price(stats['today_revenue'])}\n"
-            f"• Покупателей: {stats['today_buyers']}\n\n"
-            f"👥 <b>Реферальная система:</b>\n"
-            f"• Всего рефералов: {stats['total_referrals']}\n"
-            f"• Заработано рефералами: {format_price(stats['total_ref_earnings'])}"
-        )
+        message = STATS_TEMPLATE.render(stats)
         
         keyboard = [
             [InlineKeyboardButton("🔄 Обновить", callback_data="admin_stats")],
@@ -870,13 +2527,11 @@ async def show_admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
             LIMIT 20
         """)
         
-        users_text = "👥 <b>Последние 20 пользователей</b>\n\n"
-        
-        for user_info in users:
-            status = "🔴" if user_info['is_banned'] else "🟢"
-            username = user_info['username'] or "нет"
-            users_text += f"{status} <b>ID:</b> {user_info['user_id']} | @{username}\n"
-            users_text += f"👤 {user_info['first_name']} | 💰 {format_price(user_info['balance'])}\n\n"
+        users_text = "👥 <b>Последние 20 пользователей</b>\n\n" + ''.join(
+            ADMIN_USER_ROW.render(user_info, status="🔴" if user_info['is_banned'] else "🟢",
+                                  username=user_info['username'] or "нет")
+            for user_info in users
+        )
         
         keyboard = [
             [InlineKeyboardButton("🔍 Поиск пользователя", callback_data="admin_search_user")],
@@ -884,11 +2539,7 @@ async def show_admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
         ]
         
-        await query.edit_message_text(
-            users_text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        await edit_long_text(query, users_text, InlineKeyboardMarkup(keyboard))
         
     except Exception as e:
         logger.error(f"Error in show_admin_users: {e}")
@@ -914,13 +2565,10 @@ async def show_admin_products(update: Update, context: ContextTypes.DEFAULT_TYPE
             LIMIT 15
         """)
         
-        products_text = "📦 <b>Последние 15 товаров</b>\n\n"
-        
-        for product in products:
-            stock_text = f"{product['stock']} шт." if product['stock'] > 0 else "∞"
-            products_text += f"🛒 <b>{product['name']}</b>\n"
-            products_text += f"💰 {format_price(product['price'])} | 📁 {product['category_name']}\n"
-            products_text += f"📦 {stock_text} | 🆔 {product['id']}\n\n"
+        products_text = "📦 <b>Последние 15 товаров</b>\n\n" + ''.join(
+            ADMIN_PRODUCT_ROW.render(product, stock_text=f"{product['stock']} шт." if product['stock'] > 0 else "∞")
+            for product in products
+        )
         
         keyboard = [
             [InlineKeyboardButton("➕ Добавить товар", callback_data="admin_add_product")],
@@ -928,11 +2576,7 @@ async def show_admin_products(update: Update, context: ContextTypes.DEFAULT_TYPE
             [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
         ]
         
-        await query.edit_message_text(
-            products_text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        await edit_long_text(query, products_text, InlineKeyboardMarkup(keyboard))
         
     except Exception as e:
         logger.error(f"Error in show_admin_products: {e}")
@@ -948,16 +2592,16 @@ async def show_admin_categories(update: Update, context: ContextTypes.DEFAULT_TY
         return
     
     try:
-        # Показать список категорий
-        categories = db.fetchall("SELECT id, name, position FROM categories WHERE is_active = 1 ORDER BY position")
-        
-        categories_text = "📁 <b>Категории товаров</b>\n\n"
+        # Показать список категорий; число товаров считается по индексу одним запросом
+        categories = db.fetchall("""
+            SELECT id, name, position,
+                   (SELECT COUNT(*) FROM products WHERE category_id = categories.id) as count
+            FROM categories
+            WHERE is_active = 1
+            ORDER BY position
+        """)
         
-        for category in categories:
-            products_count = db.fetchone("SELECT COUNT(*) as count FROM products WHERE category_id = ?", (category['id'],))
-            count = products_count['count'] if products_count else 0
-            categories_text += f"📁 {category['name']}\n"
-            categories_text += f"🆔 {category['id']} | 📊 {count} товаров | #️⃣ {category['position']}\n\n"
+        categories_text = "📁 <b>Категории товаров</b>\n\n" + ADMIN_CATEGORY_ROW.render_list(categories)
         
         keyboard = [
             [InlineKeyboardButton("➕ Добавить категорию", callback_data="admin_add_category")],
@@ -965,11 +2609,7 @@ async def show_admin_categories(update: Update, context: ContextTypes.DEFAULT_TY
             [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
         ]
         
-        await query.edit_message_text(
-            categories_text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        await edit_long_text(query, categories_text, InlineKeyboardMarkup(keyboard))
         
     except Exception as e:
         logger.error(f"Error in show_admin_categories: {e}")
@@ -1014,13 +2654,13 @@ async def show_admin_settings(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Получаем настройки из базы данных
         settings = db.fetchall("SELECT key, value, description FROM settings ORDER BY key")
         
-        settings_text = "⚙️ <b>Настройки магазина</b>\n\n"
-        
-        for setting in settings:
-            settings_text += f"🔑 <b>{setting['key']}:</b> {setting['value']}\n"
-            if setting['description']:
-                settings_text += f"📝 {setting['description']}\n"
-            settings_text += "\n"
+        settings_text = "⚙️ <b>Настройки магазина</b>\n\n" + ''.join(
+            SETTING_ROW.render(
+                setting,
+                description=f"📝 {setting['description']}\n" if setting['description'] else ""
+            )
+            for setting in settings
+        )
         
         keyboard = [
             [InlineKeyboardButton("✏️ Изменить настройки", callback_data="edit_settings")],
@@ -1028,11 +2668,7 @@ async def show_admin_settings(update: Update, context: ContextTypes.DEFAULT_TYPE
             [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
         ]
         
-        await query.edit_message_text(
-            settings_text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        await edit_long_text(query, settings_text, InlineKeyboardMarkup(keyboard))
         
     except Exception as e:
         logger.error(f"Error in show_admin_settings: {e}")
@@ -1057,10 +2693,9 @@ async def show_admin_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Берем последние 20 строк
             recent_logs = logs[-20:] if len(logs) > 20 else logs
             
-            logs_text = "📝 <b>Последние 20 действий администраторов</b>\n\n"
-            
-            for log in recent_logs:
-                logs_text += f"📄 {log}"
+            logs_text = "📝 <b>Последние 20 действий администраторов</b>\n\n" + ''.join(
+                LOG_ROW.render(line=log) for log in recent_logs
+            )
             
             # Если логи пустые
             if not logs_text:
@@ -1077,11 +2712,7 @@ async def show_admin_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
             [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
         ]
         
-        await query.edit_message_text(
-            logs_text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        await edit_long_text(query, logs_text, InlineKeyboardMarkup(keyboard))
         
     except Exception as e:
         logger.error(f"Error in show_admin_logs: {e}")
@@ -1200,15 +2831,6 @@ async def show_admin_promo_stats(update: Update, context: ContextTypes.DEFAULT_T
         used_promos = db.fetchone("SELECT SUM(used_count) as total_used FROM promocodes")['total_used'] or 0
         total_amount = db.fetchone("SELECT SUM(amount * used_count) as total_amount FROM promocodes")['total_amount'] or 0
         
-        stats_text = (
-            "📊 <b>Статистика промокодов</b>\n\n"
-            f"🎫 <b>Всего промокодов:</b> {total_promos}\n"
-            f"✅ <b>Активных промокодов:</b> {active_promos}\n"
-            f"🔄 <b>Использований промокодов:</b> {used_promos}\n"
-            f"💰 <b>Общая сумма выданных бонусов:</b> {format_price(total_amount)}\n\n"
-            f"📈 <b>Топ 5 промокодов по использованию:</b>\n"
-        )
-        
         # Получаем топ промокодов
         top_promos = db.fetchall("""
             SELECT code, used_count, amount 
@@ -1217,19 +2839,20 @@ async def show_admin_promo_stats(update: Update, context: ContextTypes.DEFAULT_T
             LIMIT 5
         """)
         
-        for i, promo in enumerate(top_promos, 1):
-            stats_text += f"{i}. {promo['code']} - {promo['used_count']} использований ({format_price(promo['amount'])})\n"
+        stats_text = PROMO_STATS_TEMPLATE.render(
+            total=total_promos,
+            active=active_promos,
+            used=used_promos,
+            amount=total_amount,
+            top=''.join(TOP_PROMO_ROW.render(promo, place=i) for i, promo in enumerate(top_promos, 1))
+        )
         
         keyboard = [
             [InlineKeyboardButton("🔄 Обновить", callback_data="admin_promo_stats")],
             [InlineKeyboardButton("🔙 Назад", callback_data="admin_promocodes")]
         ]
         
-        await query.edit_message_text(
-            stats_text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        await edit_long_text(query, stats_text, InlineKeyboardMarkup(keyboard))
         
     except Exception as e:
         logger.error(f"Error in show_admin_promo_stats: {e}")
@@ -1277,33 +2900,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     if referrer:
                         referred_by = referrer['user_id']
                 
-                db.execute("""
-                    INSERT INTO users (user_id, username, first_name, referral_code, referred_by, join_date, last_active)
-                    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-                """, (user.id, user.username, user.first_name, referral_code, referred_by))
-                
-                # Если есть реферер, начисляем бонусы
-                if referred_by:
-                    db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", 
-                             (REFERRAL_BONUS_NEW, user.id))
-                    db.execute("UPDATE users SET balance = balance + ?, total_referrals = total_referrals + 1 WHERE user_id = ?", 
-                             (REFERRAL_BONUS_INVITER, referred_by))
+                # Регистрация и бонусы за приглашение
+                db.register_user(user.id, user.username, user.first_name, referral_code, referred_by)
             
             # Обновляем время последней активности
-            db.execute("UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE user_id = ?", (user.id,))
+            db.execute("UPDATE users SET last_active = ? WHERE user_id = ?", (int(time.time()), user.id))
             
             # Проверяем админские права
             is_admin = await check_admin_access(user.id, user.username)
             
-            welcome_text = f"""
-🎉 <b>Добро пожаловать!</b>
-
-👋 Привет, {user.first_name}!
-🆔 Ваш ID: <code>{user.id}</code>
-{'👑 Вы администратор' if is_admin else '👤 Вы покупатель'}
-
-Выберите действие:
-"""
+            welcome_text = WELCOME_TEMPLATE.render(
+                first_name=user.first_name,
+                user_id=user.id,
+                role='👑 Вы администратор' if is_admin else '👤 Вы покупатель'
+            )
             await update.message.reply_text(
                 welcome_text,
                 parse_mode='HTML',
@@ -1338,25 +2948,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         stats = db.get_stats()
         
-        message = (
-            "📊 <b>Статистика магазина</b>\n\n"
-            f"👥 <b>Всего пользователей:</b> {stats['total_users']}\n"
-            f"🟢 <b>Активных (7 дней):</b> {stats['active_users']}\n"
-            f"🔴 <b>Заблокированных:</b> {stats['banned_users']}\n"
-            f"🧪 <b>Тестеров:</b> {stats['testers_count']}\n\n"
-            f"💰 <b>Общий баланс пользователей:</b> {format_price(stats['total_balance'])}\n\n"
-            f"📦 <b>Товаров:</b> {stats['total_products']}\n"
-            f"📁 <b>Категорий:</b> {stats['total_categories']}\n\n"
-            f"🛒 <b>Всего заказов:</b> {stats['total_orders']}\n"
-            f"💵 <b>Общая выручка:</b> {format_price(stats['total_revenue'])}\n\n"
-            f"📈 <b>Сегодня:</b>\n"
-            f"• Заказов: {stats['today_orders']}\n"
-            f"• Выручка: {format_price(stats['today_revenue'])}\n"
-            f"• Покупателей: {stats['today_buyers']}\n\n"
-            f"👥 <b>Реферальная система:</b>\n"
-            f"• Всего рефералов: {stats['total_referrals']}\n"
-            f"• Заработано рефералами: {format_price(stats['total_ref_earnings'])}"
-        )
+        message = STATS_TEMPLATE.render(stats)
         
         await update.message.reply_text(message, parse_mode='HTML')
         
@@ -1379,16 +2971,190 @@ async def testers_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("📝 Список тестеров пуст")
             return
         
-        message = "🧪 <b>Список тестеров:</b>\n\n"
-        for tester in testers:
-            message += f"👤 ID: {tester['user_id']} | @{tester['username'] or 'нет'} | {tester['first_name']}\n"
+        message = "🧪 <b>Список тестеров:</b>\n\n" + ''.join(
+            TESTER_ROW.render(tester, username=tester['username'] or 'нет') for tester in testers
+        )
         
-        await update.message.reply_text(message, parse_mode='HTML')
+        await send_long_text(update.message, message)
         
     except Exception as e:
         logger.error(f"Error in testers_command: {e}")
         await update.message.reply_text("❌ Ошибка при получении списка тестеров")
 
+async def slow_queries_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отчет о медленных SQL-запросах"""
+    try:
+        user = update.effective_user
+        
+        if not await check_admin_access(user.id, user.username):
+            await update.message.reply_text("❌ У вас нет прав для этой команды!")
+            return
+        
+        if not db.slow_queries:
+            await update.message.reply_text(
+                f"✅ Медленных запросов не зафиксировано (порог: {db.slow_query_ms:g} мс)"
+            )
+        else:
+            message = f"🐢 <b>Медленные запросы</b> (порог: {db.slow_query_ms:g} мс)\n\n" + ''.join(
+                SLOW_QUERY_ROW.render(
+                    entry,
+                    query=entry['query'][:300],
+                    plan=''.join(PLAN_STEP_ROW.render(step=step) for step in entry['plan'][:4])
+                )
+                for entry in list(db.slow_queries)[-5:]
+            )
+            
+            await send_long_text(update.message, message)
+        
+        # Полный отчет отправляем файлами: в многопроцессном режиме у каждого обработчика свой
+        for path in slow_query_log_files():
+            if path.stat().st_size > 0:
+                with open(path, 'rb') as f:
+                    await update.message.reply_document(document=f, filename=path.name)
+        
+    except Exception as e:
+        logger.error(f"Error in slow_queries_command: {e}")
+        await update.message.reply_text("❌ Ошибка при получении отчета")
+
+async def wizard_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Время обработки шагов мастеров"""
+    try:
+        user = update.effective_user
+        
+        if not await check_admin_access(user.id, user.username):
+            await update.message.reply_text("❌ У вас нет прав для этой команды!")
+            return
+        
+        message = f"🧭 <b>Мастера</b> (активных: {len(wizards.store)})\n\n" + ''.join(
+            WIZARD_METRICS_ROW.render(
+                name=name,
+                calls=metrics.calls,
+                avg_ms=metrics.total_ms / metrics.calls,
+                max_ms=metrics.max_ms,
+                problems=(f", отклонено {metrics.rejected}, ошибок {metrics.errors}"
+                          if metrics.rejected or metrics.errors else "")
+            )
+            for name, metrics in wizards.metrics.items() if metrics.calls
+        )
+        
+        await send_long_text(update.message, message)
+        
+    except Exception as e:
+        logger.error(f"Error in wizard_stats_command: {e}")
+        await update.message.reply_text("❌ Ошибка при получении отчета")
+
+async def edit_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сколько правок сообщений пропущено без обращения к Telegram"""
+    try:
+        user = update.effective_user
+        
+        if not await check_admin_access(user.id, user.username):
+            await update.message.reply_text("❌ У вас нет прав для этой команды!")
+            return
+        
+        checked = edit_cache.hits + edit_cache.misses
+        hit_rate = edit_cache.hits * 100 / checked if checked else 0.0
+        await update.message.reply_text(
+            f"✏️ <b>Правки сообщений</b>\n\n"
+            f"Проверено: {checked}\n"
+            f"Пропущено без запроса: {edit_cache.hits} ({hit_rate:.1f}%)\n"
+            f"Отклонено Telegram как неизмененные: {edit_cache.not_modified}\n"
+            f"Сообщений в кеше: {len(edit_cache.hashes)} из {edit_cache.size}",
+            parse_mode='HTML'
+        )
+        
+    except Exception as e:
+        logger.error(f"Error in edit_stats_command: {e}")
+        await update.message.reply_text("❌ Ошибка при получении отчета")
+
+OUTBOX_STATUSES = {'pending': '⏳ Ждут отправки', 'failed': '❌ Не доставлены'}
+
+async def outbox_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Очередь уведомлений: сколько ждет отправки и сколько не доставлено"""
+    try:
+        user = update.effective_user
+        
+        if not await check_admin_access(user.id, user.username):
+            await update.message.reply_text("❌ У вас нет прав для этой команды!")
+            return
+        
+        stats = db.get_outbox_stats()
+        text = "📬 <b>Очередь уведомлений</b>\n\n" + ''.join(
+            OUTBOX_ROW.render(row, status=OUTBOX_STATUSES.get(row['status'], row['status'])) for row in stats
+        )
+        if not stats:
+            text += "Очередь пуста\n"
+        text += (
+            f"\nЭтим процессом с запуска: отправлено {notifier.sent}, "
+            f"отложено для повтора {notifier.retried}, не доставлено {notifier.failed}"
+        )
+        await send_long_text(update.message, text)
+        
+    except Exception as e:
+        logger.error(f"Error in outbox_command: {e}")
+        await update.message.reply_text("❌ Ошибка при получении отчета")
+
+async def flood_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Защита от флуда: сколько действий пропущено и отклонено"""
+    try:
+        user = update.effective_user
+        
+        if not await check_admin_access(user.id, user.username):
+            await update.message.reply_text("❌ У вас нет прав для этой команды!")
+            return
+        
+        verdicts = flood_guard.verdicts
+        now = time.monotonic()
+        muted = sum(1 for state in flood_guard.users.values() if state.muted_until > now)
+        limits = (
+            f"{flood_guard.rate:g}/с, подряд до {flood_guard.burst:g}; всего {flood_guard.global_rate:g}/с"
+            if flood_guard.enabled else "выключены"
+        )
+        await update.message.reply_text(
+            f"🛡 <b>Защита от флуда</b>\n\n"
+            f"Лимиты: {limits}\n"
+            f"Пропущено: {verdicts['pass']}\n"
+            f"Отклонено за частоту: {verdicts['limited']}\n"
+            f"Отклонено при перегрузке: {verdicts['overloaded']}\n"
+            f"Пауз назначено: {verdicts['mute']}, отброшено на паузе: {verdicts['muted']}\n"
+            f"Заблокировано за флуд: {verdicts['ban']}, отброшено от заблокированных: {verdicts['banned']}\n\n"
+            f"Пользователей в учете: {len(flood_guard.users)}, сейчас на паузе: {muted}\n"
+            f"Заблокированных: {len(flood_guard.banned)}",
+            parse_mode='HTML'
+        )
+        
+    except Exception as e:
+        logger.error(f"Error in flood_stats_command: {e}")
+        await update.message.reply_text("❌ Ошибка при получении отчета")
+
+async def reconcile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сверка балансов пользователей с журналом операций"""
+    try:
+        user = update.effective_user
+        
+        if not await check_admin_access(user.id, user.username):
+            await update.message.reply_text("❌ У вас нет прав для этой команды!")
+            return
+        
+        result = await asyncio.to_thread(db.reconcile_ledger)
+        
+        if not result['mismatches'] and not result['ledger_total']:
+            await update.message.reply_text(
+                f"✅ Балансы совпадают с журналом (сверка заняла {result['ms']} мс)"
+            )
+            return
+        
+        message = f"⚠️ <b>Расхождения с журналом</b> (сверка заняла {result['ms']} мс)\n\n"
+        if result['ledger_total']:
+            message += f"❗ Сумма всех проводок: {result['ledger_total']} (должна быть 0)\n\n"
+        message += RECONCILE_ROW.render_list(result['mismatches'])
+        
+        await send_long_text(update.message, message)
+        
+    except Exception as e:
+        logger.error(f"Error in reconcile_command: {e}")
+        await update.message.reply_text("❌ Ошибка при сверке")
+
 # ============ ПРОФИЛЬ ПОЛЬЗОВАТЕЛЯ ============
 async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать профиль пользователя"""
@@ -1398,58 +3164,24 @@ async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         # Получаем информацию о пользователе
         user_info = db.fetchone("""
-            SELECT u.*, 
-                   (SELECT COUNT(*) FROM orders WHERE user_id = u.user_id) as orders_count,
-                   (SELECT SUM(amount) FROM orders WHERE user_id = u.user_id) as total_spent_amount
-            FROM users u 
-            WHERE u.user_id = ?
+            SELECT * FROM users WHERE user_id = ?
         """, (user.id,))
         
         if not user_info:
             await query.answer("❌ Пользователь не найден!", show_alert=True)
             return
         
-        # Форматируем даты
-        join_date = format_datetime(user_info['join_date'])
-        last_active = format_datetime(user_info['last_active'])
-        last_purchase = format_datetime(user_info['last_purchase']) if user_info['last_purchase'] else "нет покупок"
-        
-        # Статус бана
-        ban_status = "🔴 Заблокирован" if user_info['is_banned'] else "🟢 Активен"
-        
-        # Статус тестера
-        tester_status = "🧪 Тестер" if user_info['is_tester'] else "👤 Обычный"
-        
         # Проверяем, является ли пользователь админом
         is_admin = await check_admin_access(user.id, user_info['username'])
-        admin_status = "👑 Администратор" if is_admin else ""
         
-        message = f"""
-👤 <b>Ваш профиль</b>
-
-📛 <b>Имя:</b> {user_info['first_name']}
-👤 <b>Username:</b> @{user_info['username'] or 'не установлен'}
-🆔 <b>ID:</b> <code>{user_info['user_id']}</code>
-
-{admin_status}
-🏷️ <b>Статус:</b> {tester_status}
-🛡️ <b>Статус аккаунта:</b> {ban_status}
-
-💰 <b>Баланс:</b> {format_price(user_info['balance'])}
-💵 <b>Всего пополнено:</b> {format_price(user_info['total_deposited'])}
-🛒 <b>Всего потрачено:</b> {format_price(user_info['total_spent_amount'] or 0)}
-
-👥 <b>Реферальная система:</b>
-• Код: <code>{user_info['referral_code']}</code>
-• Приглашено: {user_info['total_referrals']} чел.
-• Заработано: {format_price(user_info['referral_earnings'])}
-
-📊 <b>Активность:</b>
-• Заказов: {user_info['orders_count']}
-• Регистрация: {join_date}
-• Последняя активность: {last_active}
-• Последняя покупка: {last_purchase}
-"""
+        message = PROFILE_TEMPLATE.render(
+            user_info,
+            username=user_info['username'] or 'не установлен',
+            admin_status="👑 Администратор" if is_admin else "",
+            tester_status="🧪 Тестер" if user_info['is_tester'] else "👤 Обычный",
+            ban_status="🔴 Заблокирован" if user_info['is_banned'] else "🟢 Активен",
+            account=render_account(user_info)
+        )
         
         keyboard = [
             [InlineKeyboardButton("💰 Пополнить баланс", callback_data="deposit")],
@@ -1478,24 +3210,11 @@ async def admin_commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ У вас нет прав для этой команды!")
             return
         
-        keyboard = [
-            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
-             InlineKeyboardButton("👥 Пользователи", callback_data="admin_users")],
-            [InlineKeyboardButton("📦 Товары", callback_data="admin_products"),
-             InlineKeyboardButton("📁 Категории", callback_data="admin_categories")],
-            [InlineKeyboardButton("🎫 Промокоды", callback_data="admin_promocodes"),
-             InlineKeyboardButton("📈 Графики", callback_data="admin_charts")],
-            [InlineKeyboardButton("💾 Бэкап", callback_data="admin_backup"),
-             InlineKeyboardButton("⚙️ Настройки", callback_data="admin_settings")],
-            [InlineKeyboardButton("📝 Логи", callback_data="admin_logs"),
-             InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
-        ]
-        
         await update.message.reply_text(
             "👑 <b>Административная панель</b>\n\n"
             "Выберите раздел для управления:",
             parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=ADMIN_PANEL
         )
         
     except Exception as e:
@@ -1510,32 +3229,92 @@ async def admin_panel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.answer("❌ Доступ запрещен!", show_alert=True)
         return
     
-    keyboard = [
-        [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
-         InlineKeyboardButton("👥 Пользователи", callback_data="admin_users")],
-        [InlineKeyboardButton("📦 Товары", callback_data="admin_products"),
-         InlineKeyboardButton("📁 Категории", callback_data="admin_categories")],
-        [InlineKeyboardButton("🎫 Промокоды", callback_data="admin_promocodes"),
-             InlineKeyboardButton("📈 Графики", callback_data="admin_charts")],
-        [InlineKeyboardButton("💾 Бэкап", callback_data="admin_backup"),
-         InlineKeyboardButton("⚙️ Настройки", callback_data="admin_settings")],
-        [InlineKeyboardButton("📝 Логи", callback_data="admin_logs"),
-         InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
-    ]
-    
     await query.edit_message_text(
         "👑 <b>Административная панель</b>\n\n"
         "Выберите раздел для управления:",
         parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=ADMIN_PANEL
     )
 
-async def add_balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Добавить баланс пользователю"""
+async def show_deposit_requests(update: Update, context: ContextTypes.DEFAULT_TYPE, after_id: int = 0):
+    """Страница ожидающих заявок на пополнение"""
+    query = update.callback_query
+    
     try:
-        user = update.effective_user
+        requests, has_more = db.get_pending_deposits(after_id)
+        pending = db.fetchone("""
+            SELECT COUNT(*) AS total FROM deposit_requests
+            WHERE status = 'pending' AND (provider IS NULL OR provider = 'legacy')
+        """)['total']
+        
+        text = f"💳 <b>Заявки на пополнение</b> (ожидают: {pending})\n\n" + ''.join(
+            DEPOSIT_REQUEST_ROW.render(request, username=request['username'] or 'нет') for request in requests
+        )
+        keyboard = []
+        for request in requests:
+            keyboard.append([
+                InlineKeyboardButton(f"✅ #{request['id']}", callback_data=f"dep_ok_{request['id']}_{request['id']}_{after_id}"),
+                InlineKeyboardButton(f"❌ #{request['id']}", callback_data=f"dep_no_{request['id']}_{request['id']}_{after_id}")
+            ])
+        if not requests:
+            text += "Новых заявок нет."
+        
+        if len(requests) > 1:
+            # Вся страница одним действием: заявки с id в диапазоне показанных
+            first_id, last_id = requests[0]['id'], requests[-1]['id']
+            keyboard.append([
+                InlineKeyboardButton("✅ Все на странице", callback_data=f"dep_ok_{first_id}_{last_id}_{after_id}"),
+                InlineKeyboardButton("❌ Все на странице", callback_data=f"dep_no_{first_id}_{last_id}_{after_id}")
+            ])
+        if has_more:
+            keyboard.append([InlineKeyboardButton("⬇️ Далее", callback_data=f"admin_deposits_after_{requests[-1]['id']}")])
+        if after_id:
+            keyboard.append([InlineKeyboardButton("⏫ В начало", callback_data="admin_deposits")])
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")])
         
-        if not await check_admin_access(user.id, user.username):
+        await edit_long_text(query, text, InlineKeyboardMarkup(keyboard))
+        
+    except Exception as e:
+        logger.error(f"Error in show_deposit_requests: {e}")
+        await query.edit_message_text("❌ Ошибка при получении заявок")
+
+async def settle_deposit_requests_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Подтверждение или отклонение заявок: dep_ok|no_<первая>_<последняя>_<страница>"""
+    query = update.callback_query
+    user = update.effective_user
+    
+    _, action, first_id, last_id, after_id = query.data.split("_")
+    approve = action == "ok"
+    requests = db.settle_deposit_requests(int(first_id), int(last_id), approve, user.id)
+    
+    for request in requests:
+        if approve:
+            notifier.send(
+                request['user_id'],
+                f"✅ Заявка #{request['id']}: баланс пополнен на {format_price(request['amount'])}!"
+            )
+        else:
+            notifier.send(
+                request['user_id'],
+                f"❌ Заявка #{request['id']} на {format_price(request['amount'])} отклонена.\n"
+                f"Если вы оплатили, напишите {ADMIN_USERNAME}"
+            )
+    
+    if requests:
+        total = sum(request['amount'] for request in requests)
+        admin_logger.log_action(
+            user.id, "approve_deposits" if approve else "reject_deposits",
+            f"requests:{first_id}-{last_id}", f"count:{len(requests)} amount:{total}"
+        )
+    
+    await show_deposit_requests(update, context, int(after_id))
+
+async def add_balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Добавить баланс пользователю"""
+    try:
+        user = update.effective_user
+        
+        if not await check_admin_access(user.id, user.username):
             await update.message.reply_text("❌ У вас нет прав для этой команды!")
             return
         
@@ -1562,8 +3341,7 @@ async def add_balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE
                 return
             
             # Добавляем баланс
-            db.execute("UPDATE users SET balance = balance + ?, total_deposited = total_deposited + ? WHERE user_id = ?", 
-                     (amount, amount, target_user_id))
+            db.deposit(target_user_id, amount, f"admin:{user.id}")
             
             # Логируем действие
             admin_logger.log_action(user.id, "add_balance", f"user:{target_user_id}", f"amount:{amount}")
@@ -1573,13 +3351,7 @@ async def add_balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             
             # Уведомляем пользователя
-            try:
-                await context.bot.send_message(
-                    target_user_id,
-                    f"🎉 Ваш баланс пополнен администратором на {format_price(amount)}!"
-                )
-            except:
-                pass
+            notifier.send(target_user_id, f"🎉 Ваш баланс пополнен администратором на {format_price(amount)}!")
             
         except ValueError:
             await update.message.reply_text("❌ Неверный формат! ID и сумма должны быть числами.")
@@ -1622,9 +3394,11 @@ async def ban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Баним пользователя
             db.execute("""
                 UPDATE users 
-                SET is_banned = 1, ban_reason = ?, banned_at = CURRENT_TIMESTAMP, banned_by = ?
+                SET is_banned = 1, ban_reason = ?, banned_at = ?, banned_by = ?
                 WHERE user_id = ?
-            """, (reason, user.id, target_user_id))
+            """, (reason, int(time.time()), user.id, target_user_id))
+            
+            flood_guard.banned.add(target_user_id)
             
             # Логируем действие
             admin_logger.log_action(user.id, "ban_user", f"user:{target_user_id}", f"reason:{reason}")
@@ -1678,6 +3452,8 @@ async def unban_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 WHERE user_id = ?
             """, (target_user_id,))
             
+            flood_guard.forgive(target_user_id)
+            
             # Логируем действие
             admin_logger.log_action(user.id, "unban_user", f"user:{target_user_id}")
             
@@ -1713,48 +3489,20 @@ async def user_info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Получаем информацию о пользователе
         user_info = db.fetchone("""
-            SELECT u.*, 
-                   (SELECT COUNT(*) FROM orders WHERE user_id = u.user_id) as orders_count,
-                   (SELECT SUM(amount) FROM orders WHERE user_id = u.user_id) as total_spent_amount
-            FROM users u 
-            WHERE u.user_id = ?
+            SELECT * FROM users WHERE user_id = ?
         """, (target_user_id,))
         
         if not user_info:
             await update.message.reply_text("❌ Пользователь не найден!")
             return
         
-        # Форматируем даты
-        join_date = format_datetime(user_info['join_date'])
-        last_active = format_datetime(user_info['last_active'])
-        last_purchase = format_datetime(user_info['last_purchase']) if user_info['last_purchase'] else "нет покупок"
-        
-        # Статус бана
-        ban_status = "🔴 Заблокирован" if user_info['is_banned'] else "🟢 Активен"
-        ban_reason = f"\n📝 Причина: {user_info['ban_reason']}" if user_info['is_banned'] and user_info['ban_reason'] else ""
-        
-        # Статус тестера
-        tester_status = "🧪 Тестер" if user_info['is_tester'] else "👤 Обычный"
-        
-        message = (
-            f"👤 <b>Информация о пользователе</b>\n\n"
-            f"🆔 <b>ID:</b> <code>{user_info['user_id']}</code>\n"
-            f"👤 <b>Имя:</b> {user_info['first_name']}\n"
-            f"📛 <b>Username:</b> @{user_info['username'] or 'нет'}\n"
-            f"🏷️ <b>Статус:</b> {tester_status}\n"
-            f"🛡️ <b>Статус аккаунта:</b> {ban_status}{ban_reason}\n\n"
-            f"💰 <b>Баланс:</b> {format_price(user_info['balance'])}\n"
-            f"💵 <b>Всего пополнено:</b> {format_price(user_info['total_deposited'])}\n"
-            f"🛒 <b>Всего потрачено:</b> {format_price(user_info['total_spent_amount'] or 0)}\n\n"
-            f"👥 <b>Реферальная система:</b>\n"
-            f"• Код: <code>{user_info['referral_code']}</code>\n"
-            f"• Приглашено: {user_info['total_referrals']} чел.\n"
-            f"• Заработано: {format_price(user_info['referral_earnings'])}\n\n"
-            f"📊 <b>Активность:</b>\n"
-            f"• Заказов: {user_info['orders_count']}\n"
-            f"• Регистрация: {join_date}\n"
-            f"• Последняя активность: {last_active}\n"
-            f"• Последняя покупка: {last_purchase}"
+        message = USER_INFO_TEMPLATE.render(
+            user_info,
+            username=user_info['username'] or 'нет',
+            tester_status="🧪 Тестер" if user_info['is_tester'] else "👤 Обычный",
+            ban_status="🔴 Заблокирован" if user_info['is_banned'] else "🟢 Активен",
+            ban_reason=f"\n📝 Причина: {user_info['ban_reason']}" if user_info['is_banned'] and user_info['ban_reason'] else "",
+            account=render_account(user_info)
         )
         
         await update.message.reply_text(message, parse_mode='HTML')
@@ -1789,30 +3537,25 @@ async def show_promocodes_list(update: Update, context: ContextTypes.DEFAULT_TYP
             )
             return
         
-        promos_text = "🎫 <b>Последние 20 промокодов</b>\n\n"
-        
+        rows = []
         for promo in promocodes:
-            status = "✅" if promo['is_active'] else "❌"
-            uses_text = f"{promo['used_count']}/{promo['max_uses']}" if promo['max_uses'] > 0 else f"{promo['used_count']}/∞"
-            
             bonus_text = ""
             if promo['amount'] > 0:
-                bonus_text = f"{format_price(promo['amount'])}"
+                bonus_text = format_price(promo['amount'])
             if promo['discount_percent'] > 0:
                 if bonus_text:
                     bonus_text += f" + {promo['discount_percent']}%"
                 else:
                     bonus_text = f"{promo['discount_percent']}%"
             
-            expires_text = ""
-            if promo['expires_at']:
-                expires_at = format_datetime(promo['expires_at'])
-                expires_text = f"\n📅 Истекает: {expires_at}"
-            
-            promos_text += (
-                f"{status} <b>{promo['code']}</b> - {bonus_text}\n"
-                f"📊 Использовано: {uses_text}{expires_text}\n\n"
-            )
+            rows.append(PROMO_ROW.render(
+                promo,
+                status="✅" if promo['is_active'] else "❌",
+                uses_text=f"{promo['used_count']}/{promo['max_uses'] if promo['max_uses'] > 0 else '∞'}",
+                bonus_text=bonus_text,
+                expires_text=f"\n📅 Истекает: {format_datetime(promo['expires_at'])}" if promo['expires_at'] else ""
+            ))
+        promos_text = "🎫 <b>Последние 20 промокодов</b>\n\n" + ''.join(rows)
         
         keyboard = [
             [
@@ -1829,11 +3572,7 @@ async def show_promocodes_list(update: Update, context: ContextTypes.DEFAULT_TYP
             ]
         ]
         
-        await query.edit_message_text(
-            promos_text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        await edit_long_text(query, promos_text, InlineKeyboardMarkup(keyboard))
     except Exception as e:
         logger.error(f"Error in show_promocodes_list: {e}")
 
@@ -1881,8 +3620,7 @@ async def create_custom_name_promo(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     
     try:
-        context.user_data['awaiting_custom_promo_name'] = True
-        context.user_data['promo_step'] = 1
+        wizards.start(query.from_user.id, 'custom_promo_name')
         
         await query.edit_message_text(
             "✏️ <b>Создание промокода с вашим названием</b>\n\n"
@@ -1905,8 +3643,7 @@ async def create_full_promo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     
     try:
-        context.user_data['awaiting_full_promo'] = True
-        context.user_data['promo_step'] = 1
+        wizards.start(query.from_user.id, 'full_promo_name')
         
         await query.edit_message_text(
             "⚙️ <b>Полная настройка промокода</b>\n\n"
@@ -2336,20 +4073,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await show_profile(update, context)
         
         elif data == "shop":
-            categories = db.fetchall("SELECT id, name FROM categories WHERE is_active = 1 ORDER BY position")
-            
-            keyboard = []
-            for category in categories:
-                keyboard.append([InlineKeyboardButton(f"📁 {category['name']}", callback_data=f"category_{category['id']}")])
-            
-            keyboard.append([InlineKeyboardButton("🔍 Поиск товаров", callback_data="search_products")])
-            keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="main_menu")])
-            
             await query.edit_message_text(
                 "🛍️ <b>Магазин</b>\n\n"
                 "Выберите категорию:",
                 parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=shop_keyboard(catalog.current())
             )
         
         elif data == "balance":
@@ -2370,7 +4098,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         
         elif data == "promo":
-            context.user_data['awaiting_promo'] = True
+            wizards.start(user.id, 'promo')
             await query.edit_message_text(
                 "🎫 <b>Активация промокода</b>\n\n"
                 "Введите промокод в чат:\n\n"
@@ -2388,6 +4116,10 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 bot_username = context.bot.username
                 referral_link = f"https://t.me/{bot_username}?start={user_info['referral_code']}"
                 
+                levels = db.get_referral_levels(user.id)
+                deeper = sum(total for depth, total in levels.items() if depth > 1)
+                percent = db.fetchone("SELECT value FROM settings WHERE key = 'ref_percent'")
+                
                 keyboard = [
                     [InlineKeyboardButton("📋 Скопировать ссылку", callback_data=f"copy_ref_{user_info['referral_code']}")],
                     [InlineKeyboardButton("👥 Мои рефералы", callback_data="my_referrals")],
@@ -2398,12 +4130,14 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"👥 <b>Реферальная система</b>\n\n"
                     f"📊 <b>Статистика:</b>\n"
                     f"• Приглашено: {user_info['total_referrals']} чел.\n"
+                    f"• Пришло по их ссылкам: {deeper} чел.\n"
                     f"• Заработано: {format_price(user_info['referral_earnings'])}\n\n"
                     f"🔗 <b>Ваша реферальная ссылка:</b>\n"
                     f"<code>{referral_link}</code>\n\n"
                     f"🎁 <b>Бонусы:</b>\n"
                     f"• Новый пользователь: {format_price(REFERRAL_BONUS_NEW)}\n"
-                    f"• Вам за приглашение: {format_price(REFERRAL_BONUS_INVITER)}\n\n"
+                    f"• Вам за приглашение: {format_price(REFERRAL_BONUS_INVITER)}\n"
+                    f"• С каждой покупки реферала: {percent['value'] if percent else 0}%\n\n"
                     f"💡 <b>Как работает:</b>\n"
                     f"1. Отправьте ссылку другу\n"
                     f"2. Он переходит и регистрируется\n"
@@ -2418,25 +4152,22 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             referral_link = f"https://t.me/{bot_username}?start={ref_code}"
             
             # Копируем в буфер обмена
-            await context.bot.send_message(
-                user.id,
-                f"🔗 Ваша реферальная ссылка:\n\n"
-                f"<code>{referral_link}</code>\n\n"
-                f"📋 Ссылка скопирована! Отправьте ее другу.",
-                parse_mode='HTML'
+            await asyncio.gather(
+                context.bot.send_message(
+                    user.id,
+                    f"🔗 Ваша реферальная ссылка:\n\n"
+                    f"<code>{referral_link}</code>\n\n"
+                    f"📋 Ссылка скопирована! Отправьте ее другу.",
+                    parse_mode='HTML'
+                ),
+                query.answer("✅ Ссылка скопирована!", show_alert=True)
             )
-            await query.answer("✅ Ссылка скопирована!", show_alert=True)
         
-        elif data == "my_orders":
-            orders = db.fetchall("""
-                SELECT product_name, amount, quantity, created_at 
-                FROM orders 
-                WHERE user_id = ? 
-                ORDER BY created_at DESC 
-                LIMIT 10
-            """, (user.id,))
+        elif data == "my_orders" or data.startswith("my_orders_after_"):
+            after_id = int(data.split("_")[-1]) if data != "my_orders" else None
+            orders, has_more = db.get_orders_page(user.id, after_id)
             
-            if not orders:
+            if not orders and after_id is None:
                 await query.edit_message_text(
                     "📦 <b>История покупок</b>\n\n"
                     "У вас еще нет покупок.",
@@ -2448,40 +4179,37 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
             
-            total_spent = sum(order['amount'] for order in orders)
-            
-            orders_text = "📦 <b>Последние 10 покупок</b>\n\n"
-            for order in orders:
-                order_date = format_datetime(order['created_at'])
-                orders_text += f"🛒 <b>{order['product_name']}</b>\n"
-                orders_text += f"💰 {format_price(order['amount'])}"
-                if order['quantity'] > 1:
-                    orders_text += f" (×{order['quantity']})"
-                orders_text += f"\n📅 {order_date}\n\n"
+            # Итоги ведутся в users при каждой покупке, заказы не пересчитываются
+            totals = db.fetchone("SELECT orders_count, total_spent FROM users WHERE user_id = ?", (user.id,))
             
-            orders_text += f"💵 <b>Всего потрачено:</b> {format_price(total_spent)}"
+            orders_text = (
+                f"📦 <b>История покупок</b> (всего: {totals['orders_count']})\n\n"
+                + ''.join(
+                    ORDER_ROW.render(order, quantity_text=f" (×{order['quantity']})" if order['quantity'] > 1 else "")
+                    for order in orders
+                )
+                + ("" if orders else "Более старых покупок нет.\n\n")
+                + f"💵 <b>Всего потрачено:</b> {format_price(totals['total_spent'])}"
+            )
             
-            keyboard = [
-                [InlineKeyboardButton("🔄 Обновить", callback_data="my_orders")],
+            keyboard = []
+            if has_more:
+                keyboard.append([InlineKeyboardButton("⬇️ Более старые", callback_data=f"my_orders_after_{orders[-1]['id']}")])
+            if after_id is not None:
+                keyboard.append([InlineKeyboardButton("⏫ К последним", callback_data="my_orders")])
+            keyboard += [
+                [InlineKeyboardButton("🔄 Обновить", callback_data=data)],
                 [InlineKeyboardButton("🛍️ В магазин", callback_data="shop")],
                 [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
             ]
             
-            await query.edit_message_text(
-                orders_text,
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            await edit_long_text(query, orders_text, InlineKeyboardMarkup(keyboard))
         
-        elif data == "my_referrals":
-            referrals = db.fetchall("""
-                SELECT user_id, username, first_name, join_date 
-                FROM users 
-                WHERE referred_by = ? 
-                ORDER BY join_date DESC
-            """, (user.id,))
+        elif data == "my_referrals" or data.startswith("my_referrals_after_"):
+            after_id = int(data.split("_")[-1]) if data != "my_referrals" else None
+            referrals, has_more = db.get_referrals_page(user.id, after_id)
             
-            if not referrals:
+            if not referrals and after_id is None:
                 await query.edit_message_text(
                     "👥 <b>Мои рефералы</b>\n\n"
                     "У вас еще нет рефералов.\n\n"
@@ -2494,23 +4222,28 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
             
-            refs_text = f"👥 <b>Мои рефералы ({len(referrals)})</b>\n\n"
+            levels = db.get_referral_levels(user.id)
+            refs_text = f"👥 <b>Мои рефералы ({levels.get(1, 0)})</b>\n"
+            for depth in range(2, REFERRAL_LEVELS + 1):
+                if levels.get(depth):
+                    refs_text += f"• {depth}-й уровень: {levels[depth]} чел.\n"
+            refs_text += "\n"
             
-            for i, ref in enumerate(referrals, 1):
-                join_date = format_datetime(ref['join_date'])
-                refs_text += f"{i}. {ref['first_name']} (@{ref['username'] or 'нет'})\n"
-                refs_text += f"   🆔 {ref['user_id']} | 📅 {join_date}\n\n"
+            refs_text += ''.join(REFERRAL_ROW.render(ref, username=ref['username'] or 'нет') for ref in referrals)
+            if not referrals:
+                refs_text += "Больше рефералов нет."
             
-            keyboard = [
+            keyboard = []
+            if has_more:
+                keyboard.append([InlineKeyboardButton("⬇️ Далее", callback_data=f"my_referrals_after_{referrals[-1]['user_id']}")])
+            if after_id is not None:
+                keyboard.append([InlineKeyboardButton("⏫ В начало", callback_data="my_referrals")])
+            keyboard += [
                 [InlineKeyboardButton("👥 Рефералы", callback_data="referrals")],
                 [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
             ]
             
-            await query.edit_message_text(
-                refs_text,
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            await edit_long_text(query, refs_text, InlineKeyboardMarkup(keyboard))
         
         elif data == "support":
             keyboard = [
@@ -2568,7 +4301,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             amount_str = data.split("_")[1]
             
             if amount_str == "custom":
-                context.user_data['awaiting_deposit_amount'] = True
+                wizards.start(user.id, 'deposit_amount')
                 await query.edit_message_text(
                     "💵 Введите сумму для пополнения:\n\n"
                     "Примеры:\n"
@@ -2588,49 +4321,39 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     await query.answer("❌ Минимальная сумма - 100₪!", show_alert=True)
                     return
                 
-                # Здесь должна быть интеграция с платежной системой
-                # Покажем временные реквизиты
-                payment_info = (
-                    f"💰 <b>Пополнение на {format_price(amount)}</b>\n\n"
-                    f"🆔 Ваш ID: <code>{user.id}</code>\n"
-                    f"💵 Сумма: {format_price(amount)}\n\n"
-                    f"📋 <b>Реквизиты для оплаты:</b>\n"
-                    f"• Карта: 1234 5678 9012 3456\n"
-                    f"• Получатель: Иван Иванов\n"
-                    f"• Комментарий: <code>{user.id}</code>\n\n"
-                    f"💡 <b>Инструкция:</b>\n"
-                    f"1. Переведите {format_price(amount)} на указанные реквизиты\n"
-                    f"2. В комментарии укажите ваш ID: {user.id}\n"
-                    f"3. Ожидайте зачисления (до 15 минут)\n\n"
-                    f"📞 При проблемах: {ADMIN_USERNAME}"
-                )
-                
-                keyboard = [
-                    [InlineKeyboardButton("✅ Я оплатил", callback_data=f"confirm_payment_{amount}")],
-                    [InlineKeyboardButton("🔙 Назад", callback_data="deposit")]
-                ]
-                
+                payment_info, reply_markup = await deposit_offer(user.id, amount)
                 await query.edit_message_text(
                     payment_info,
                     parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=reply_markup
                 )
                 
             except ValueError:
                 await query.answer("❌ Неверная сумма!", show_alert=True)
         
         elif data.startswith("confirm_payment_"):
-            amount_str = data.split("_")[2]
-            amount = int(amount_str)
+            amount = int(data.split("_")[2])
+            if amount < 100:
+                await query.answer("❌ Минимальная сумма - 100₪!", show_alert=True)
+                return
+            request_id = db.create_deposit_request(user.id, amount)
+            
+            notifier.send_admins(
+                f"💳 Заявка #{request_id}: {format_price(amount)} от {user.id} (@{user.username or 'нет'})",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("📋 Заявки", callback_data="admin_deposits")]
+                ])
+            )
             
             keyboard = [
-                [InlineKeyboardButton("🔄 Проверить статус", callback_data=f"check_payment_{amount}")],
+                [InlineKeyboardButton("🔄 Проверить статус", callback_data=f"check_payment_{request_id}")],
                 [InlineKeyboardButton("📞 Поддержка", callback_data="support")],
                 [InlineKeyboardButton("🔙 Назад", callback_data="deposit")]
             ]
             
             await query.edit_message_text(
                 f"✅ <b>Запрос на пополнение принят!</b>\n\n"
+                f"🧾 Заявка: #{request_id}\n"
                 f"💰 Сумма: {format_price(amount)}\n"
                 f"🆔 Ваш ID: {user.id}\n\n"
                 f"⏳ Платеж проверяется администратором.\n"
@@ -2640,17 +4363,61 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
         
+        elif data.startswith("check_payment_"):
+            request_id = int(data.split("_")[2])
+            request = db.fetchone(
+                "SELECT amount, status FROM deposit_requests WHERE id = ? AND user_id = ?", (request_id, user.id)
+            )
+            if not request:
+                await query.answer("❌ Заявка не найдена!", show_alert=True)
+                return
+            
+            statuses = {
+                'pending': "⏳ Ожидает проверки",
+                'approved': "✅ Зачислено",
+                'rejected': "❌ Отклонено",
+            }
+            await query.answer(
+                f"Заявка #{request_id} на {format_price(request['amount'])}: {statuses[request['status']]}",
+                show_alert=True
+            )
+        
+        elif data == "admin_deposits" or data.startswith("admin_deposits_after_"):
+            if await check_admin_access(user.id, user.username):
+                after_id = int(data.split("_")[-1]) if data != "admin_deposits" else 0
+                await show_deposit_requests(update, context, after_id)
+            else:
+                await query.answer("❌ Доступ запрещен!", show_alert=True)
+        
+        elif data.startswith("dep_ok_") or data.startswith("dep_no_"):
+            if await check_admin_access(user.id, user.username):
+                await settle_deposit_requests_handler(update, context)
+            else:
+                await query.answer("❌ Доступ запрещен!", show_alert=True)
+        
         elif data == "balance_history":
             # Покажем историю операций
-            user_info = db.fetchone("SELECT total_deposited, total_spent FROM users WHERE user_id = ?", (user.id,))
+            user_info = db.fetchone("SELECT balance, total_deposited, total_spent FROM users WHERE user_id = ?", (user.id,))
             
             history_text = (
                 f"📊 <b>История операций</b>\n\n"
                 f"💵 <b>Всего пополнено:</b> {format_price(user_info['total_deposited'])}\n"
                 f"🛒 <b>Всего потрачено:</b> {format_price(user_info['total_spent'])}\n"
-                f"💰 <b>Текущий баланс:</b> {format_price(user_info['total_deposited'] - user_info['total_spent'])}\n\n"
-                f"📈 <b>Детальная история:</b>\n"
-                f"Здесь будет детальная история операций..."
+                f"💰 <b>Текущий баланс:</b> {format_price(user_info['balance'])}\n\n"
+                f"📈 <b>Последние операции:</b>\n"
+            )
+            
+            statement = db.get_statement(user.id)
+            if not statement:
+                history_text += "Операций пока нет"
+            history_text += ''.join(
+                LEDGER_ROW.render(
+                    entry,
+                    kind=LEDGER_KINDS.get(entry['kind'], entry['kind']),
+                    sign="+" if entry['amount'] > 0 else "−",
+                    amount=abs(entry['amount'])
+                )
+                for entry in statement
             )
             
             keyboard = [
@@ -2658,169 +4425,116 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 [InlineKeyboardButton("🔙 Назад", callback_data="balance")]
             ]
             
-            await query.edit_message_text(
-                history_text,
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            await edit_long_text(query, history_text, InlineKeyboardMarkup(keyboard))
         
         elif data.startswith("category_"):
             category_id = int(data.split("_")[1])
             
             # Получаем товары из категории
-            products = db.fetchall("""
-                SELECT id, name, price, stock 
-                FROM products 
-                WHERE category_id = ? AND is_active = 1 
-                ORDER BY position
-                LIMIT 20
-            """, (category_id,))
+            snapshot = catalog.current()
+            products = snapshot.by_category.get(category_id, ())[:CATEGORY_PAGE_SIZE]
             
             if not products:
                 await query.edit_message_text(
                     "📦 <b>Товары не найдены</b>\n\n"
                     "В этой категории пока нет товаров.",
                     parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🛍️ В магазин", callback_data="shop")],
-                        [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
-                    ])
+                    reply_markup=EMPTY_CATEGORY
                 )
                 return
             
-            category = db.fetchone("SELECT name FROM categories WHERE id = ?", (category_id,))
-            category_name = category['name'] if category else "Категория"
-            
-            products_text = f"🛍️ <b>{category_name}</b>\n\n"
+            category_name = snapshot.category_names.get(category_id, "Категория")
+            # Ограниченный остаток меняется с каждой покупкой, поэтому он берется из базы
+            limited = [product['id'] for product in products if product['stock'] >= 0]
+            stocks = db.get_stock(limited) if limited else {}
             
-            keyboard = []
+            rows = []
             for product in products:
-                stock_text = f"({product['stock']} шт.)" if product['stock'] > 0 else "✔️ В наличии"
-                products_text += f"📦 {product['name']}\n"
-                products_text += f"💰 {format_price(product['price'])} {stock_text}\n\n"
-                
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f"🛒 {product['name']} - {format_price(product['price'])}", 
-                        callback_data=f"view_product_{product['id']}"
-                    )
-                ])
+                stock = stocks.get(product['id'], product['stock'])
+                rows.append(CATEGORY_PRODUCT_ROW.render(
+                    product, stock_text=f"({stock} шт.)" if stock > 0 else "✔️ В наличии"
+                ))
+            products_text = f"🛍️ <b>{html.escape(category_name, quote=False)}</b>\n\n" + ''.join(rows)
             
-            keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="shop")])
-            
-            await query.edit_message_text(
-                products_text,
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            await edit_long_text(query, products_text, category_keyboard(snapshot, category_id))
         
         elif data.startswith("view_product_"):
             product_id = int(data.split("_")[2])
             
-            product = db.fetchone("""
-                SELECT p.*, c.name as category_name 
-                FROM products p 
-                LEFT JOIN categories c ON p.category_id = c.id 
-                WHERE p.id = ? AND p.is_active = 1
-            """, (product_id,))
+            product = catalog.current().products.get(product_id)
             
             if not product:
                 await query.answer("❌ Товар не найден!", show_alert=True)
                 return
             
-            stock_text = f"📦 <b>Остаток:</b> {product['stock']} шт." if product['stock'] > 0 else "✅ <b>В наличии</b>"
-            if product['stock'] == 0:
-                stock_text = "❌ <b>Нет в наличии</b>"
+            # Товар с ограниченным остатком бронируем, пока пользователь решает
+            stock = product['stock']
+            held_until = None
+            if stock >= 0:
+                held_until, stock = db.hold_stock(user.id, product_id, STOCK_HOLD_TTL)
+                if stock is None:
+                    await query.answer("❌ Товар не найден!", show_alert=True)
+                    return
             
-            description = product['description'] or "Описание отсутствует"
+            stock_text = f"📦 <b>Остаток:</b> {stock} шт." if stock > 0 else "✅ <b>В наличии</b>"
+            if stock == 0:
+                stock_text = "❌ <b>Нет в наличии</b>"
+            if held_until:
+                stock_text = (
+                    f"📦 <b>Остаток:</b> {stock + 1} шт.\n"
+                    f"🔒 <b>Одна штука забронирована за вами до "
+                    f"{datetime.fromtimestamp(held_until).strftime('%H:%M')}</b>"
+                )
             
-            product_text = (
-                f"📦 <b>{product['name']}</b>\n\n"
-                f"📁 <b>Категория:</b> {product['category_name']}\n"
-                f"💰 <b>Цена:</b> {format_price(product['price'])}\n"
-                f"{stock_text}\n\n"
-                f"📝 <b>Описание:</b>\n{description}\n\n"
-                f"🆔 <b>ID товара:</b> <code>{product['id']}</code>"
+            product_text = PRODUCT_TEMPLATE.render(
+                product,
+                stock_text=stock_text,
+                description=product['description'] or "Описание отсутствует"
             )
             
             keyboard = []
-            if product['stock'] != 0:
+            if stock != 0 or held_until:
                 keyboard.append([InlineKeyboardButton("🛒 Купить", callback_data=f"buy_product_{product['id']}")])
             
             keyboard.append([InlineKeyboardButton("🔙 Назад в магазин", callback_data="shop")])
             
-            await query.edit_message_text(
-                product_text,
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            await edit_long_text(query, product_text, InlineKeyboardMarkup(keyboard))
         
         elif data.startswith("buy_product_"):
             product_id = int(data.split("_")[2])
             
-            product = db.fetchone("SELECT id, name, price, stock FROM products WHERE id = ? AND is_active = 1", (product_id,))
-            
-            if not product:
-                await query.answer("❌ Товар не найден!", show_alert=True)
-                return
-            
-            user_info = db.fetchone("SELECT balance FROM users WHERE user_id = ?", (user.id,))
-            balance = user_info['balance'] if user_info else 0
-            
-            if balance < product['price']:
-                await query.answer(f"❌ Недостаточно средств! Нужно {format_price(product['price'])}", show_alert=True)
-                return
-            
-            if product['stock'] == 0:
-                await query.answer("❌ Товар закончился!", show_alert=True)
+            # Проверки, списание, остаток и заказ - одной транзакцией
+            try:
+                product, new_balance = db.purchase(user.id, product_id)
+            except OperationError as e:
+                await query.answer(str(e), show_alert=True)
                 return
             
-            # Покупка товара
-            db.execute("UPDATE users SET balance = balance - ?, total_spent = total_spent + ? WHERE user_id = ?", 
-                     (product['price'], product['price'], user.id))
-            
-            if product['stock'] > 0:
-                db.execute("UPDATE products SET stock = stock - 1 WHERE id = ?", (product['id'],))
-            
-            db.execute("""
-                INSERT INTO orders (user_id, product_id, product_name, amount, quantity)
-                VALUES (?, ?, ?, ?, 1)
-            """, (user.id, product['id'], product['name'], product['price']))
-            
-            # Обновляем время последней покупки
-            db.execute("UPDATE users SET last_purchase = CURRENT_TIMESTAMP WHERE user_id = ?", (user.id,))
-            
-            await query.answer(f"✅ Товар '{product['name']}' куплен!", show_alert=True)
-            
-            # Возвращаем в магазин
-            await query.edit_message_text(
-                f"✅ <b>Покупка успешна!</b>\n\n"
-                f"📦 <b>Товар:</b> {product['name']}\n"
-                f"💰 <b>Цена:</b> {format_price(product['price'])}\n"
-                f"💵 <b>Новый баланс:</b> {format_price(balance - product['price'])}\n\n"
-                f"Детали покупки будут отправлены вам в личные сообщения.",
-                parse_mode='HTML',
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🛍️ Продолжить покупки", callback_data="shop")],
-                    [InlineKeyboardButton("📦 Мои покупки", callback_data="my_orders")],
-                    [InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")]
-                ])
+            # Чек ставится в очередь сразу: покупка уже проведена, что бы ни случилось с ответом
+            notifier.send(
+                user.id,
+                RECEIPT_TEMPLATE.render(product, balance=new_balance, date=int(time.time())),
+                parse_mode='HTML'
             )
             
-            # Отправляем детали покупки
-            try:
-                await context.bot.send_message(
-                    user.id,
-                    f"📦 <b>Чек покупки</b>\n\n"
-                    f"🛒 <b>Товар:</b> {product['name']}\n"
-                    f"💰 <b>Стоимость:</b> {format_price(product['price'])}\n"
-                    f"📅 <b>Дата:</b> {datetime.now().strftime('%d.%m.%Y %H:%M')}\n"
-                    f"🆔 <b>ID покупки:</b> {product['id']}\n\n"
-                    f"💵 <b>Новый баланс:</b> {format_price(balance - product['price'])}",
-                    parse_mode='HTML'
-                )
-            except:
-                pass
+            # Ответ покупателю - двумя независимыми запросами параллельно. Ошибки только
+            # логируются: экран об успехе нельзя подменять сообщением об ошибке
+            results = await asyncio.gather(
+                query.answer(f"✅ Товар '{product['name']}' куплен!", show_alert=True),
+                query.edit_message_text(
+                    PURCHASE_TEMPLATE.render(product, balance=new_balance),
+                    parse_mode='HTML',
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("🛍️ Продолжить покупки", callback_data="shop")],
+                        [InlineKeyboardButton("📦 Мои покупки", callback_data="my_orders")],
+                        [InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")]
+                    ])
+                ),
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"Error in buy_product reply: {result}")
         
         else:
             logger.warning(f"Unknown callback data: {data}")
@@ -2866,475 +4580,349 @@ async def share_promo_to_chat(update: Update, context: ContextTypes.DEFAULT_TYPE
             f"🎁 Успейте воспользоваться!"
         )
         
-        await context.bot.send_message(
-            query.message.chat_id,
-            share_text,
-            parse_mode='HTML',
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🎫 Активировать промокод", callback_data="promo")],
-                [InlineKeyboardButton("🛍️ Перейти в магазин", callback_data="shop")]
-            ])
+        await asyncio.gather(
+            context.bot.send_message(
+                query.message.chat_id,
+                share_text,
+                parse_mode='HTML',
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🎫 Активировать промокод", callback_data="promo")],
+                    [InlineKeyboardButton("🛍️ Перейти в магазин", callback_data="shop")]
+                ])
+            ),
+            query.answer("✅ Промокод отправлен в чат!", show_alert=True)
         )
         
-        await query.answer("✅ Промокод отправлен в чат!", show_alert=True)
-        
     except Exception as e:
         logger.error(f"Error in share_promo_to_chat: {e}")
         await query.answer("❌ Ошибка при отправке!", show_alert=True)
 
 # ============ ОБРАБОТКА ТЕКСТОВЫХ СООБЩЕНИЙ ============
-async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик текстовых сообщений"""
+def promo_name_input(text: str) -> str:
+    """Проверка названия нового промокода"""
+    promo_code = text.upper()
+    
+    # Проверяем формат
+    if not all(c.isalnum() for c in promo_code):
+        raise InvalidInput("❌ Используйте только латинские буквы и цифры!")
+    
+    if len(promo_code) < 4 or len(promo_code) > 20:
+        raise InvalidInput("❌ Длина кода должна быть от 4 до 20 символов!")
+    
+    # Проверяем, не занят ли код
+    existing = db.fetchone("SELECT id FROM promocodes WHERE code = ?", (promo_code,))
+    if existing:
+        raise InvalidInput(f"❌ Промокод {promo_code} уже существует!")
+    
+    return promo_code
+
+def number_input(error: str, minimum: int = 0, maximum: int = None):
+    """Проверка целого числа в диапазоне; error - сообщение при выходе за диапазон"""
+    def validate(text: str) -> int:
+        try:
+            value = int(text)
+        except ValueError:
+            raise InvalidInput("❌ Введите число!")
+        if value < minimum or (maximum is not None and value > maximum):
+            raise InvalidInput(error)
+        return value
+    return validate
+
+@wizards.state('promo', timeout=600)
+async def promo_activation_step(update: Update, context: ContextTypes.DEFAULT_TYPE, wizard: WizardState, text: str):
+    """Активация промокода пользователем"""
+    user = update.effective_user
+    wizards.finish(user.id)
+    
+    # Проверка и начисление - одной транзакцией
     try:
-        user = update.effective_user
-        text = update.message.text.strip()
+        amount = db.redeem_promo(user.id, text.upper())
+    except OperationError as e:
+        await update.message.reply_text(
+            str(e),
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
+            ])
+        )
+        return
+    
+    await update.message.reply_text(
+        PROMO_ACTIVATED_TEMPLATE.render(code=text.upper(), amount=amount),
+        parse_mode='HTML',
+        reply_markup=get_main_menu(user.id)
+    )
+
+# Создание промокода с собственным названием
+@wizards.state('custom_promo_name', validate=promo_name_input, admin_only=True)
+async def custom_promo_name_step(update: Update, context: ContextTypes.DEFAULT_TYPE, wizard: WizardState, promo_code: str):
+    wizards.goto(update.effective_user.id, 'custom_promo_amount', code=promo_code)
+    
+    await update.message.reply_text(
+        "✅ Название промокода принято!\n\n"
+        "Шаг 2/4: Введите сумму промокода:\n\n"
+        "💡 Примеры:\n"
+        "• 100 - промокод на 100₪\n"
+        "• 500 - промокод на 500₪\n"
+        "• 0 - промокод только на скидку\n\n"
+        "Введите число:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
+        ])
+    )
+
+@wizards.state('custom_promo_amount', validate=number_input("❌ Сумма не может быть отрицательной!"),
+               admin_only=True)
+async def custom_promo_amount_step(update: Update, context: ContextTypes.DEFAULT_TYPE, wizard: WizardState, amount: int):
+    wizards.goto(update.effective_user.id, 'custom_promo_uses', amount=amount)
+    
+    await update.message.reply_text(
+        "✅ Сумма принята!\n\n"
+        "Шаг 3/4: Введите количество использований:\n\n"
+        "💡 Примеры:\n"
+        "• 1 - одноразовый промокод\n"
+        "• 10 - 10 использований\n"
+        "• 0 - без ограничений\n\n"
+        "Введите число:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
+        ])
+    )
+
+@wizards.state('custom_promo_uses', validate=number_input("❌ Количество не может быть отрицательным!"),
+               admin_only=True)
+async def custom_promo_uses_step(update: Update, context: ContextTypes.DEFAULT_TYPE, wizard: WizardState, uses: int):
+    wizards.goto(update.effective_user.id, 'custom_promo_days', uses=uses)
+    
+    await update.message.reply_text(
+        "✅ Количество использований принято!\n\n"
+        "Шаг 4/4: Введите срок действия в днях:\n\n"
+        "💡 Примеры:\n"
+        "• 7 - на 7 дней\n"
+        "• 30 - на 30 дней\n"
+        "• 0 - без срока\n\n"
+        "Введите число:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
+        ])
+    )
+
+@wizards.state('custom_promo_days', validate=number_input("❌ Срок не может быть отрицательным!"),
+               admin_only=True)
+async def custom_promo_days_step(update: Update, context: ContextTypes.DEFAULT_TYPE, wizard: WizardState, days: int):
+    user = update.effective_user
+    promo_code, amount, uses = wizard.code, wizard.amount, wizard.uses
+    wizards.finish(user.id)
+    
+    try:
+        # Создаем промокод
+        expires_at = None
+        if days > 0:
+            expires_at = int(time.time()) + days * 86400
         
-        # Проверяем, ожидаем ли мы промокод от пользователя
-        if context.user_data.get('awaiting_promo'):
-            context.user_data['awaiting_promo'] = False
-            
-            # Проверяем промокод
-            promo = db.fetchone("""
-                SELECT code, amount, max_uses, used_count, is_active, expires_at
-                FROM promocodes 
-                WHERE code = ? AND is_active = 1
-            """, (text.upper(),))
-            
-            if not promo:
-                await update.message.reply_text(
-                    "❌ Промокод не найден или неактивен!",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
-                    ])
-                )
-                return
-            
-            # Проверяем срок действия
-            if promo['expires_at']:
-                expires_at = datetime.fromisoformat(promo['expires_at'].replace('Z', '+00:00'))
-                if expires_at < datetime.now():
-                    await update.message.reply_text(
-                        "❌ Промокод истек!",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
-                        ])
-                    )
-                    return
-            
-            # Проверяем количество использований
-            if promo['max_uses'] > 0 and promo['used_count'] >= promo['max_uses']:
-                await update.message.reply_text(
-                    "❌ Промокод уже использован максимальное количество раз!",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
-                    ])
-                )
-                return
-            
-            # Активируем промокод
-            db.execute("UPDATE promocodes SET used_count = used_count + 1 WHERE code = ?", (text.upper(),))
-            db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", 
-                     (promo['amount'], user.id))
-            
-            await update.message.reply_text(
-                f"✅ Промокод активирован!\n"
-                f"🎫 Код: <code>{text.upper()}</code>\n"
-                f"💰 Начислено: {format_price(promo['amount'])}\n\n"
-                f"💸 Ваш баланс пополнен!",
-                parse_mode='HTML',
-                reply_markup=get_main_menu(user.id)
-            )
-            return
+        db.execute("""
+            INSERT INTO promocodes (code, amount, max_uses, created_by, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (promo_code, amount, uses, user.id, expires_at))
         
-        # Обработка создания промокода с собственным названием
-        elif context.user_data.get('awaiting_custom_promo_name') and await check_admin_access(user.id, user.username):
-            step = context.user_data.get('promo_step', 1)
-            
-            if step == 1:  # Название промокода
-                promo_code = text.upper()
-                
-                # Проверяем формат
-                if not all(c.isalnum() for c in promo_code):
-                    await update.message.reply_text("❌ Используйте только латинские буквы и цифры!")
-                    return
-                
-                if len(promo_code) < 4 or len(promo_code) > 20:
-                    await update.message.reply_text("❌ Длина кода должна быть от 4 до 20 символов!")
-                    return
-                
-                # Проверяем, не занят ли код
-                existing = db.fetchone("SELECT id FROM promocodes WHERE code = ?", (promo_code,))
-                if existing:
-                    await update.message.reply_text(f"❌ Промокод {promo_code} уже существует!")
-                    return
-                
-                context.user_data['promo_code'] = promo_code
-                context.user_data['promo_step'] = 2
-                
-                await update.message.reply_text(
-                    "✅ Название промокода принято!\n\n"
-                    "Шаг 2/4: Введите сумму промокода:\n\n"
-                    "💡 Примеры:\n"
-                    "• 100 - промокод на 100₪\n"
-                    "• 500 - промокод на 500₪\n"
-                    "• 0 - промокод только на скидку\n\n"
-                    "Введите число:",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
-                    ])
-                )
-            
-            elif step == 2:  # Сумма
-                try:
-                    amount = int(text)
-                    if amount < 0:
-                        await update.message.reply_text("❌ Сумма не может быть отрицательной!")
-                        return
-                    
-                    context.user_data['promo_amount'] = amount
-                    context.user_data['promo_step'] = 3
-                    
-                    await update.message.reply_text(
-                        "✅ Сумма принята!\n\n"
-                        "Шаг 3/4: Введите количество использований:\n\n"
-                        "💡 Примеры:\n"
-                        "• 1 - одноразовый промокод\n"
-                        "• 10 - 10 использований\n"
-                        "• 0 - без ограничений\n\n"
-                        "Введите число:",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
-                        ])
-                    )
-                except ValueError:
-                    await update.message.reply_text("❌ Введите число!")
-            
-            elif step == 3:  # Количество использований
-                try:
-                    uses = int(text)
-                    if uses < 0:
-                        await update.message.reply_text("❌ Количество не может быть отрицательным!")
-                        return
-                    
-                    context.user_data['promo_uses'] = uses
-                    context.user_data['promo_step'] = 4
-                    
-                    await update.message.reply_text(
-                        "✅ Количество использований принято!\n\n"
-                        "Шаг 4/4: Введите срок действия в днях:\n\n"
-                        "💡 Примеры:\n"
-                        "• 7 - на 7 дней\n"
-                        "• 30 - на 30 дней\n"
-                        "• 0 - без срока\n\n"
-                        "Введите число:",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
-                        ])
-                    )
-                except ValueError:
-                    await update.message.reply_text("❌ Введите число!")
-            
-            elif step == 4:  # Срок действия
-                try:
-                    days = int(text)
-                    if days < 0:
-                        await update.message.reply_text("❌ Срок не может быть отрицательным!")
-                        return
-                    
-                    # Получаем данные
-                    promo_code = context.user_data['promo_code']
-                    amount = context.user_data['promo_amount']
-                    uses = context.user_data['promo_uses']
-                    
-                    # Очищаем временные данные
-                    for key in ['awaiting_custom_promo_name', 'promo_step', 'promo_code', 'promo_amount', 'promo_uses']:
-                        if key in context.user_data:
-                            del context.user_data[key]
-                    
-                    # Создаем промокод
-                    expires_at = None
-                    if days > 0:
-                        expires_at = (datetime.now() + timedelta(days=days)).isoformat()
-                    
-                    db.execute("""
-                        INSERT INTO promocodes (code, amount, max_uses, created_by, expires_at)
-                        VALUES (?, ?, ?, ?, ?)
-                    """, (promo_code, amount, uses, user.id, expires_at))
-                    
-                    admin_logger.log_action(user.id, "create_custom_promo", promo_code, 
-                                          f"amount:{amount}, uses:{uses}, expires:{days}days")
-                    
-                    uses_text = "бесконечно" if uses == 0 else f"{uses} использований"
-                    expires_text = f"\n📅 Срок действия: {days} дней" if days else ""
-                    
-                    message = (
-                        f"✅ <b>Промокод успешно создан!</b>\n\n"
-                        f"🎫 <b>Код:</b> <code>{promo_code}</code>\n"
-                        f"💰 <b>Сумма:</b> {format_price(amount)}\n"
-                        f"📊 <b>Использований:</b> {uses_text}"
-                        f"{expires_text}"
-                    )
-                    
-                    keyboard = [
-                        [
-                            InlineKeyboardButton("📋 Скопировать код", callback_data=f"copy_promo_{promo_code}"),
-                            InlineKeyboardButton("📢 Отправить в чат", callback_data=f"share_promo_{promo_code}")
-                        ],
-                        [
-                            InlineKeyboardButton("🎫 Создать еще", callback_data="create_custom_name_promo"),
-                            InlineKeyboardButton("📊 Посмотреть все", callback_data="admin_promocodes")
-                        ],
-                        [InlineKeyboardButton("🔙 В меню", callback_data="create_promo_menu")]
-                    ]
-                    
-                    await update.message.reply_text(
-                        message,
-                        parse_mode='HTML',
-                        reply_markup=InlineKeyboardMarkup(keyboard)
-                    )
-                    
-                except ValueError:
-                    await update.message.reply_text("❌ Введите число!")
-                except Exception as e:
-                    logger.error(f"Ошибка при создании промокода: {e}")
-                    await update.message.reply_text("❌ Не удалось создать промокод. Попробуйте позже.")
-        
-        # Обработка полного создания промокода
-        elif context.user_data.get('awaiting_full_promo') and await check_admin_access(user.id, user.username):
-            step = context.user_data.get('promo_step', 1)
-            
-            if step == 1:  # Название промокода
-                promo_code = text.upper()
-                
-                # Проверяем формат
-                if not all(c.isalnum() for c in promo_code):
-                    await update.message.reply_text("❌ Используйте только латинские буквы и цифры!")
-                    return
-                
-                if len(promo_code) < 4 or len(promo_code) > 20:
-                    await update.message.reply_text("❌ Длина кода должна быть от 4 до 20 символов!")
-                    return
-                
-                # Проверяем, не занят ли код
-                existing = db.fetchone("SELECT id FROM promocodes WHERE code = ?", (promo_code,))
-                if existing:
-                    await update.message.reply_text(f"❌ Промокод {promo_code} уже существует!")
-                    return
-                
-                context.user_data['promo_code'] = promo_code
-                context.user_data['promo_step'] = 2
-                
-                await update.message.reply_text(
-                    "✅ Название промокода принято!\n\n"
-                    "Шаг 2/5: Введите сумму промокода:\n\n"
-                    "💡 Примеры:\n"
-                    "• 100 - промокод на 100₪\n"
-                    "• 500 - промокод на 500₪\n"
-                    "• 0 - промокод только на скидку\n\n"
-                    "Введите число:",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
-                    ])
-                )
-            
-            elif step == 2:  # Сумма
-                try:
-                    amount = int(text)
-                    if amount < 0:
-                        await update.message.reply_text("❌ Сумма не может быть отрицательной!")
-                        return
-                    
-                    context.user_data['promo_amount'] = amount
-                    context.user_data['promo_step'] = 3
-                    
-                    await update.message.reply_text(
-                        "✅ Сумма принята!\n\n"
-                        "Шаг 3/5: Введите процент скидки (0 если только сумма):\n\n"
-                        "💡 Примеры:\n"
-                        "• 0 - без скидки\n"
-                        "• 10 - 10% скидка\n"
-                        "• 50 - 50% скидка\n\n"
-                        "Введите число от 0 до 100:",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
-                        ])
-                    )
-                except ValueError:
-                    await update.message.reply_text("❌ Введите число!")
-            
-            elif step == 3:  # Процент скидки
-                try:
-                    discount = int(text)
-                    if discount < 0 or discount > 100:
-                        await update.message.reply_text("❌ Процент скидки должен быть от 0 до 100!")
-                        return
-                    
-                    context.user_data['promo_discount'] = discount
-                    context.user_data['promo_step'] = 4
-                    
-                    await update.message.reply_text(
-                        "✅ Процент скидки принят!\n\n"
-                        "Шаг 4/5: Введите количество использований:\n\n"
-                        "💡 Примеры:\n"
-                        "• 1 - одноразовый промокод\n"
-                        "• 10 - 10 использований\n"
-                        "• 0 - без ограничений\n\n"
-                        "Введите число:",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
-                        ])
-                    )
-                except ValueError:
-                    await update.message.reply_text("❌ Введите число!")
-            
-            elif step == 4:  # Количество использований
-                try:
-                    uses = int(text)
-                    if uses < 0:
-                        await update.message.reply_text("❌ Количество не может быть отрицательным!")
-                        return
-                    
-                    context.user_data['promo_uses'] = uses
-                    context.user_data['promo_step'] = 5
-                    
-                    await update.message.reply_text(
-                        "✅ Количество использований принято!\n\n"
-                        "Шаг 5/5: Введите срок действия в днях:\n\n"
-                        "💡 Примеры:\n"
-                        "• 7 - на 7 дней\n"
-                        "• 30 - на 30 дней\n"
-                        "• 0 - без срока\n\n"
-                        "Введите число:",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
-                        ])
-                    )
-                except ValueError:
-                    await update.message.reply_text("❌ Введите число!")
-            
-            elif step == 5:  # Срок действия
-                try:
-                    days = int(text)
-                    if days < 0:
-                        await update.message.reply_text("❌ Срок не может быть отрицательным!")
-                        return
-                    
-                    # Получаем данные
-                    promo_code = context.user_data['promo_code']
-                    amount = context.user_data['promo_amount']
-                    discount = context.user_data['promo_discount']
-                    uses = context.user_data['promo_uses']
-                    
-                    # Очищаем временные данные
-                    for key in ['awaiting_full_promo', 'promo_step', 'promo_code', 'promo_amount', 'promo_discount', 'promo_uses']:
-                        if key in context.user_data:
-                            del context.user_data[key]
-                    
-                    # Создаем промокод
-                    expires_at = None
-                    if days > 0:
-                        expires_at = (datetime.now() + timedelta(days=days)).isoformat()
-                    
-                    db.execute("""
-                        INSERT INTO promocodes (code, amount, discount_percent, max_uses, created_by, expires_at)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    """, (promo_code, amount, discount, uses, user.id, expires_at))
-                    
-                    admin_logger.log_action(user.id, "create_full_promo", promo_code, 
-                                          f"amount:{amount}, discount:{discount}%, uses:{uses}, expires:{days}days")
-                    
-                    uses_text = "бесконечно" if uses == 0 else f"{uses} использований"
-                    expires_text = f"\n📅 Срок действия: {days} дней" if days else ""
-                    
-                    bonus_text = ""
-                    if amount > 0:
-                        bonus_text = f"{format_price(amount)}"
-                    if discount > 0:
-                        if bonus_text:
-                            bonus_text += f" + {discount}% скидка"
-                        else:
-                            bonus_text = f"{discount}% скидка"
-                    
-                    message = (
-                        f"✅ <b>Промокод успешно создан!</b>\n\n"
-                        f"🎫 <b>Код:</b> <code>{promo_code}</code>\n"
-                        f"🎁 <b>Бонус:</b> {bonus_text}\n"
-                        f"📊 <b>Использований:</b> {uses_text}"
-                        f"{expires_text}"
-                    )
-                    
-                    keyboard = [
-                        [
-                            InlineKeyboardButton("📋 Скопировать код", callback_data=f"copy_promo_{promo_code}"),
-                            InlineKeyboardButton("📢 Отправить в чат", callback_data=f"share_promo_{promo_code}")
-                        ],
-                        [
-                            InlineKeyboardButton("🎫 Создать еще", callback_data="create_full_promo"),
-                            InlineKeyboardButton("📊 Посмотреть все", callback_data="admin_promocodes")
-                        ],
-                        [InlineKeyboardButton("🔙 В меню", callback_data="create_promo_menu")]
-                    ]
-                    
-                    await update.message.reply_text(
-                        message,
-                        parse_mode='HTML',
-                        reply_markup=InlineKeyboardMarkup(keyboard)
-                    )
-                    
-                except ValueError:
-                    await update.message.reply_text("❌ Введите число!")
-                except Exception as e:
-                    logger.error(f"Ошибка при создании промокода: {e}")
-                    await update.message.reply_text("❌ Не удалось создать промокод. Попробуйте позже.")
+        admin_logger.log_action(user.id, "create_custom_promo", promo_code, 
+                              f"amount:{amount}, uses:{uses}, expires:{days}days")
         
-        # Обработка кастомной суммы пополнения
-        elif context.user_data.get('awaiting_deposit_amount'):
-            context.user_data['awaiting_deposit_amount'] = False
-            
-            try:
-                amount = int(text)
-                if amount < 100:
-                    await update.message.reply_text("❌ Минимальная сумма - 100₪!")
-                    return
-                
-                # Показываем реквизиты для оплаты
-                payment_info = (
-                    f"💰 <b>Пополнение на {format_price(amount)}</b>\n\n"
-                    f"🆔 Ваш ID: <code>{user.id}</code>\n"
-                    f"💵 Сумма: {format_price(amount)}\n\n"
-                    f"📋 <b>Реквизиты для оплаты:</b>\n"
-                    f"• Карта: 1234 5678 9012 3456\n"
-                    f"• Получатель: Иван Иванов\n"
-                    f"• Комментарий: <code>{user.id}</code>\n\n"
-                    f"💡 <b>Инструкция:</b>\n"
-                    f"1. Переведите {format_price(amount)} на указанные реквизиты\n"
-                    f"2. В комментарии укажите ваш ID: {user.id}\n"
-                    f"3. Ожидайте зачисления (до 15 минут)\n\n"
-                    f"📞 При проблемах: {ADMIN_USERNAME}"
-                )
-                
-                keyboard = [
-                    [InlineKeyboardButton("✅ Я оплатил", callback_data=f"confirm_payment_{amount}")],
-                    [InlineKeyboardButton("🔙 Назад", callback_data="deposit")]
-                ]
-                
-                await update.message.reply_text(
-                    payment_info,
-                    parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-                
-            except ValueError:
-                await update.message.reply_text("❌ Введите число!")
+        uses_text = "бесконечно" if uses == 0 else f"{uses} использований"
+        expires_text = f"\n📅 Срок действия: {days} дней" if days else ""
         
-        else:
-            # Если сообщение не обработано, показываем главное меню
-            await update.message.reply_text(
-                "🏠 <b>Главное меню</b>\n\n"
-                "Выберите действие:",
-                parse_mode='HTML',
-                reply_markup=get_main_menu(user.id)
-            )
+        message = (
+            f"✅ <b>Промокод успешно создан!</b>\n\n"
+            f"🎫 <b>Код:</b> <code>{promo_code}</code>\n"
+            f"💰 <b>Сумма:</b> {format_price(amount)}\n"
+            f"📊 <b>Использований:</b> {uses_text}"
+            f"{expires_text}"
+        )
+        
+        keyboard = [
+            [
+                InlineKeyboardButton("📋 Скопировать код", callback_data=f"copy_promo_{promo_code}"),
+                InlineKeyboardButton("📢 Отправить в чат", callback_data=f"share_promo_{promo_code}")
+            ],
+            [
+                InlineKeyboardButton("🎫 Создать еще", callback_data="create_custom_name_promo"),
+                InlineKeyboardButton("📊 Посмотреть все", callback_data="admin_promocodes")
+            ],
+            [InlineKeyboardButton("🔙 В меню", callback_data="create_promo_menu")]
+        ]
+        
+        await update.message.reply_text(
+            message,
+            parse_mode='HTML',
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при создании промокода: {e}")
+        await update.message.reply_text("❌ Не удалось создать промокод. Попробуйте позже.")
+
+# Полное создание промокода
+@wizards.state('full_promo_name', validate=promo_name_input, admin_only=True)
+async def full_promo_name_step(update: Update, context: ContextTypes.DEFAULT_TYPE, wizard: WizardState, promo_code: str):
+    wizards.goto(update.effective_user.id, 'full_promo_amount', code=promo_code)
+    
+    await update.message.reply_text(
+        "✅ Название промокода принято!\n\n"
+        "Шаг 2/5: Введите сумму промокода:\n\n"
+        "💡 Примеры:\n"
+        "• 100 - промокод на 100₪\n"
+        "• 500 - промокод на 500₪\n"
+        "• 0 - промокод только на скидку\n\n"
+        "Введите число:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
+        ])
+    )
+
+@wizards.state('full_promo_amount', validate=number_input("❌ Сумма не может быть отрицательной!"),
+               admin_only=True)
+async def full_promo_amount_step(update: Update, context: ContextTypes.DEFAULT_TYPE, wizard: WizardState, amount: int):
+    wizards.goto(update.effective_user.id, 'full_promo_discount', amount=amount)
+    
+    await update.message.reply_text(
+        "✅ Сумма принята!\n\n"
+        "Шаг 3/5: Введите процент скидки (0 если только сумма):\n\n"
+        "💡 Примеры:\n"
+        "• 0 - без скидки\n"
+        "• 10 - 10% скидка\n"
+        "• 50 - 50% скидка\n\n"
+        "Введите число от 0 до 100:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
+        ])
+    )
+
+@wizards.state('full_promo_discount', validate=number_input("❌ Процент скидки должен быть от 0 до 100!", maximum=100),
+               admin_only=True)
+async def full_promo_discount_step(update: Update, context: ContextTypes.DEFAULT_TYPE, wizard: WizardState, discount: int):
+    wizards.goto(update.effective_user.id, 'full_promo_uses', discount=discount)
+    
+    await update.message.reply_text(
+        "✅ Процент скидки принят!\n\n"
+        "Шаг 4/5: Введите количество использований:\n\n"
+        "💡 Примеры:\n"
+        "• 1 - одноразовый промокод\n"
+        "• 10 - 10 использований\n"
+        "• 0 - без ограничений\n\n"
+        "Введите число:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
+        ])
+    )
+
+@wizards.state('full_promo_uses', validate=number_input("❌ Количество не может быть отрицательным!"),
+               admin_only=True)
+async def full_promo_uses_step(update: Update, context: ContextTypes.DEFAULT_TYPE, wizard: WizardState, uses: int):
+    wizards.goto(update.effective_user.id, 'full_promo_days', uses=uses)
+    
+    await update.message.reply_text(
+        "✅ Количество использований принято!\n\n"
+        "Шаг 5/5: Введите срок действия в днях:\n\n"
+        "💡 Примеры:\n"
+        "• 7 - на 7 дней\n"
+        "• 30 - на 30 дней\n"
+        "• 0 - без срока\n\n"
+        "Введите число:",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Отмена", callback_data="create_promo_menu")]
+        ])
+    )
+
+@wizards.state('full_promo_days', validate=number_input("❌ Срок не может быть отрицательным!"),
+               admin_only=True)
+async def full_promo_days_step(update: Update, context: ContextTypes.DEFAULT_TYPE, wizard: WizardState, days: int):
+    user = update.effective_user
+    promo_code, amount, discount, uses = wizard.code, wizard.amount, wizard.discount, wizard.uses
+    wizards.finish(user.id)
+    
+    try:
+        # Создаем промокод
+        expires_at = None
+        if days > 0:
+            expires_at = int(time.time()) + days * 86400
+        
+        db.execute("""
+            INSERT INTO promocodes (code, amount, discount_percent, max_uses, created_by, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (promo_code, amount, discount, uses, user.id, expires_at))
+        
+        admin_logger.log_action(user.id, "create_full_promo", promo_code, 
+                              f"amount:{amount}, discount:{discount}%, uses:{uses}, expires:{days}days")
+        
+        uses_text = "бесконечно" if uses == 0 else f"{uses} использований"
+        expires_text = f"\n📅 Срок действия: {days} дней" if days else ""
+        
+        bonus_text = ""
+        if amount > 0:
+            bonus_text = f"{format_price(amount)}"
+        if discount > 0:
+            if bonus_text:
+                bonus_text += f" + {discount}% скидка"
+            else:
+                bonus_text = f"{discount}% скидка"
+        
+        message = (
+            f"✅ <b>Промокод успешно создан!</b>\n\n"
+            f"🎫 <b>Код:</b> <code>{promo_code}</code>\n"
+            f"🎁 <b>Бонус:</b> {bonus_text}\n"
+            f"📊 <b>Использований:</b> {uses_text}"
+            f"{expires_text}"
+        )
+        
+        keyboard = [
+            [
+                InlineKeyboardButton("📋 Скопировать код", callback_data=f"copy_promo_{promo_code}"),
+                InlineKeyboardButton("📢 Отправить в чат", callback_data=f"share_promo_{promo_code}")
+            ],
+            [
+                InlineKeyboardButton("🎫 Создать еще", callback_data="create_full_promo"),
+                InlineKeyboardButton("📊 Посмотреть все", callback_data="admin_promocodes")
+            ],
+            [InlineKeyboardButton("🔙 В меню", callback_data="create_promo_menu")]
+        ]
+        
+        await update.message.reply_text(
+            message,
+            parse_mode='HTML',
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при создании промокода: {e}")
+        await update.message.reply_text("❌ Не удалось создать промокод. Попробуйте позже.")
+
+@wizards.state('deposit_amount', validate=number_input("❌ Минимальная сумма - 100₪!", minimum=100), timeout=600)
+async def deposit_amount_step(update: Update, context: ContextTypes.DEFAULT_TYPE, wizard: WizardState, amount: int):
+    """Кастомная сумма пополнения"""
+    user = update.effective_user
+    wizards.finish(user.id)
+    
+    # Показываем реквизиты для оплаты
+    payment_info, reply_markup = await deposit_offer(user.id, amount)
+    await update.message.reply_text(
+        payment_info,
+        parse_mode='HTML',
+        reply_markup=reply_markup
+    )
+
+async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик текстовых сообщений"""
+    try:
+        user = update.effective_user
+        
+        # Ввод для запущенного мастера (промокод, сумма пополнения, создание промокода)
+        if await wizards.dispatch(update, context):
+            return
+        
+        # Если сообщение не обработано, показываем главное меню
+        await update.message.reply_text(
+            "🏠 <b>Главное меню</b>\n\n"
+            "Выберите действие:",
+            parse_mode='HTML',
+            reply_markup=get_main_menu(user.id)
+        )
             
     except Exception as e:
         logger.error(f"Error in handle_text_message: {e}")
@@ -3406,7 +4994,7 @@ async def create_promo_command(update: Update, context: ContextTypes.DEFAULT_TYP
             
             expires_at = None
             if expires_days and expires_days > 0:
-                expires_at = (datetime.now() + timedelta(days=expires_days)).isoformat()
+                expires_at = int(time.time()) + expires_days * 86400
             
             db.execute("""
                 INSERT INTO promocodes (code, amount, max_uses, created_by, expires_at)
@@ -3436,11 +5024,1012 @@ async def create_promo_command(update: Update, context: ContextTypes.DEFAULT_TYP
     except Exception as e:
         logger.error(f"Error in create_promo_command: {e}")
 
+# ============ ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА АПДЕЙТОВ ============
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает апдейты разных пользователей параллельно, а одного пользователя - по очереди"""
+    
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._user_locks: Dict[int, asyncio.Lock] = {}
+        self._user_pending: Dict[int, int] = defaultdict(int)
+    
+    @staticmethod
+    def serialization_key(update: object) -> Optional[int]:
+        """Ключ очереди: пользователь, а если его нет - чат"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+    
+    async def process_update(self, update: object, coroutine) -> None:
+        key = self.serialization_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        
+        # Сначала очередь пользователя, потом слот семафора: апдейты одного
+        # пользователя, ожидающие своей очереди, не занимают слоты других
+        lock = self._user_locks.get(key)
+        if lock is None:
+            lock = self._user_locks[key] = asyncio.Lock()
+        self._user_pending[key] += 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self._user_pending[key] -= 1
+            if not self._user_pending[key]:
+                del self._user_pending[key]
+                del self._user_locks[key]
+    
+    async def do_process_update(self, update: object, coroutine) -> None:
+        await coroutine
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+
+# ============ СОЕДИНЕНИЯ С BOT API ============
+def bot_api_http2() -> bool:
+    """HTTP/2 согласуется только через TLS; без пакета h2 httpx его не поддерживает"""
+    if BOT_API_HTTP2 == 'auto':
+        return BOT_API_URL.startswith('https://') and importlib.util.find_spec('h2') is not None
+    return BOT_API_HTTP2.lower() in ('1', 'true', 'yes')
+
+class BotApiRequest(HTTPXRequest):
+    """Пул соединений к Bot API с долгим keep-alive и HTTP/2, если сервер его поддерживает"""
+    
+    def __init__(self, pool_size: int, keepalive: float = BOT_API_KEEPALIVE, http2: bool = False, **kwargs):
+        # _build_client вызывается из родительского __init__, поэтому поля задаются до него
+        self.limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive,
+        )
+        self.http2 = http2
+        super().__init__(connection_pool_size=pool_size, **kwargs)
+    
+    def _build_client(self) -> httpx.AsyncClient:
+        # HTTP/1.1 остается разрешенным: без ALPN (локальный Bot API по http) httpx откатится на него
+        return httpx.AsyncClient(**{**self._client_kwargs, 'limits': self.limits,
+                                    'http1': True, 'http2': self.http2})
+
+# ============ ПРАВКИ СООБЩЕНИЙ ============
+class EditCache:
+    """Хеш содержимого последней правки каждого сообщения (LRU по EDIT_CACHE_SIZE)"""
+    
+    def __init__(self, size: int):
+        self.size = size
+        self.hashes: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+    
+    def unchanged(self, key, digest: int) -> bool:
+        if self.hashes.get(key) == digest:
+            self.hashes.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+    
+    def remember(self, key, digest: int):
+        self.hashes[key] = digest
+        self.hashes.move_to_end(key)
+        if len(self.hashes) > self.size:
+            self.hashes.popitem(last=False)
+    
+    def forget(self, key):
+        self.hashes.pop(key, None)
+
+edit_cache = EditCache(EDIT_CACHE_SIZE)
+
+def _message_key(chat_id, message_id, inline_message_id):
+    return inline_message_id if inline_message_id else (chat_id, message_id)
+
+class ShopBot(ExtBot):
+    """Бот, который не отправляет правку, если сообщение уже выглядит так же.
+    Все правки проходят через него, поэтому кеш знает текущее содержимое сообщения"""
+    
+    async def edit_message_text(self, text, chat_id=None, message_id=None, inline_message_id=None,
+                                parse_mode=None, disable_web_page_preview=None, reply_markup=None,
+                                entities=None, **kwargs):
+        key = _message_key(chat_id, message_id, inline_message_id)
+        digest = None
+        if not entities:
+            digest = hash((text, parse_mode, disable_web_page_preview, reply_markup))
+            if edit_cache.unchanged(key, digest):
+                return True
+        try:
+            result = await super().edit_message_text(
+                text, chat_id=chat_id, message_id=message_id, inline_message_id=inline_message_id,
+                parse_mode=parse_mode, disable_web_page_preview=disable_web_page_preview,
+                reply_markup=reply_markup, entities=entities, **kwargs
+            )
+        except BadRequest as e:
+            # Кеш пуст после перезапуска: Telegram сам сообщает, что правка ничего не меняет
+            if digest is not None and 'message is not modified' in str(e).lower():
+                edit_cache.not_modified += 1
+                edit_cache.remember(key, digest)
+                return True
+            edit_cache.forget(key)
+            raise
+        except TelegramError:
+            edit_cache.forget(key)
+            raise
+        if digest is None:
+            edit_cache.forget(key)
+        else:
+            edit_cache.remember(key, digest)
+        return result
+    
+    async def edit_message_reply_markup(self, chat_id=None, message_id=None, inline_message_id=None,
+                                        *args, **kwargs):
+        edit_cache.forget(_message_key(chat_id, message_id, inline_message_id))
+        return await super().edit_message_reply_markup(chat_id, message_id, inline_message_id, *args, **kwargs)
+    
+    async def edit_message_caption(self, chat_id=None, message_id=None, inline_message_id=None,
+                                   *args, **kwargs):
+        edit_cache.forget(_message_key(chat_id, message_id, inline_message_id))
+        return await super().edit_message_caption(chat_id, message_id, inline_message_id, *args, **kwargs)
+    
+    async def edit_message_media(self, media, chat_id=None, message_id=None, inline_message_id=None,
+                                 *args, **kwargs):
+        edit_cache.forget(_message_key(chat_id, message_id, inline_message_id))
+        return await super().edit_message_media(media, chat_id, message_id, inline_message_id, *args, **kwargs)
+    
+    async def delete_message(self, chat_id, message_id, *args, **kwargs):
+        edit_cache.forget((chat_id, message_id))
+        return await super().delete_message(chat_id, message_id, *args, **kwargs)
+
+# ============ ХРАНЕНИЕ СОСТОЯНИЯ ПОЛЬЗОВАТЕЛЕЙ ============
+class SQLitePersistence(BasePersistence):
+    """Сохраняет состояния мастеров (ConversationStore) в таблицу conversation_state"""
+    
+    def __init__(self, database: Database, store: ConversationStore, shard: int = 0, shards: int = 1,
+                 update_interval: float = PERSISTENCE_INTERVAL):
+        # bot_data сам по себе не нужен: PTB вызывает update_bot_data на каждом проходе
+        # сохранения, этот вызов и используется для пакетной записи состояний
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.database = database
+        self.store = store
+        self.shard = shard
+        self.shards = shards
+    
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        # Процесс загружает только пользователей своего шарда
+        self.store.load(self.database.fetchall(
+            "SELECT * FROM conversation_state WHERE user_id % ? = ?",
+            (self.shards, self.shard)
+        ))
+        return {}
+    
+    async def update_bot_data(self, data) -> None:
+        self.store.evict_expired()
+        self._write_changes()
+    
+    async def flush(self) -> None:
+        self._write_changes()
+    
+    def _write_changes(self):
+        """Запись накопленных изменений одной транзакцией"""
+        updated, dropped = self.store.take_changes()
+        if not updated and not dropped:
+            return
+        try:
+            self.database.save_conversation_states(updated, dropped)
+        except sqlite3.Error as e:
+            logger.error(f"Error in SQLitePersistence: {e}")
+            # Запишем на следующем проходе
+            self.store.mark_changed(row[0] for row in updated + dropped)
+    
+    # Остальные данные бот не хранит
+    async def get_user_data(self) -> Dict[int, Any]:
+        return {}
+    
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+    
+    async def get_callback_data(self) -> None:
+        return None
+    
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+    
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+    
+    async def update_user_data(self, user_id: int, data) -> None:
+        pass
+    
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+    
+    async def update_callback_data(self, data) -> None:
+        pass
+    
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+    
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+    
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        pass
+    
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+    
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+# ============ УВЕДОМЛЕНИЯ ============
+class NotificationSender:
+    """Отправка уведомлений из очереди notification_outbox: не быстрее rate сообщений в секунду,
+    с повторами после временных ошибок. Неотправленное переживает перезапуск бота"""
+    
+    # Сколько уведомлений процесс забирает из очереди за раз
+    batch = 20
+    
+    def __init__(self, database: Database, rate: float):
+        self.db = database
+        self.interval = 1 / rate
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.in_flight = 0
+        self._wake = asyncio.Event()
+    
+    def send(self, chat_id: int, text: str, **kwargs):
+        """Ставит сообщение в очередь, не дожидаясь отправки"""
+        self.db.enqueue_notifications([(chat_id, text, self._dump_options(kwargs))])
+        self._wake.set()
+    
+    def send_admins(self, text: str, **kwargs):
+        """Уведомление администраторам (если включено в настройках)"""
+        self.db.enqueue_admin_alert(text, self._dump_options(kwargs))
+        self._wake.set()
+    
+    @staticmethod
+    def _dump_options(kwargs: dict) -> Optional[str]:
+        """Параметры send_message в JSON; из объектов Telegram в уведомлениях бывает только клавиатура"""
+        if not kwargs:
+            return None
+        if 'reply_markup' in kwargs:
+            kwargs['reply_markup'] = kwargs['reply_markup'].to_dict()
+        return json.dumps(kwargs, ensure_ascii=False)
+    
+    @staticmethod
+    def _load_options(options: Optional[str]) -> dict:
+        kwargs = json.loads(options) if options else {}
+        if 'reply_markup' in kwargs:
+            kwargs['reply_markup'] = InlineKeyboardMarkup.de_json(kwargs['reply_markup'], None)
+        return kwargs
+    
+    async def run(self, bot: Bot):
+        """Цикл отправки (фоновая задача)"""
+        while True:
+            self._wake.clear()
+            try:
+                claimed = await self._dispatch(bot)
+            except Exception as e:
+                logger.error(f"Error in NotificationSender: {e}")
+                claimed = 0
+            # Полная пачка - в очереди, скорее всего, есть еще
+            if claimed < self.batch:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), NOTIFY_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+    
+    async def _dispatch(self, bot: Bot) -> int:
+        """Отправляет пачку подошедших уведомлений; возвращает ее размер"""
+        rows = self.db.claim_notifications(self.batch, NOTIFY_LEASE)
+        unsent = deque(row['id'] for row in rows)
+        finished = []
+        self.in_flight = len(rows)
+        try:
+            for row in rows:
+                unsent.popleft()
+                try:
+                    await bot.send_message(row['chat_id'], row['text'], **self._load_options(row['options']))
+                except RetryAfter as e:
+                    # Лимит общий на бота: вся пачка ждет столько, сколько сказал Telegram
+                    self.db.postpone_notifications([row['id'], *unsent], int(time.time() + e.retry_after))
+                    unsent.clear()
+                    await asyncio.sleep(e.retry_after)
+                    break
+                except Forbidden:
+                    # Пользователь заблокировал бота, повторять бесполезно
+                    finished.append(row['id'])
+                    self.failed += 1
+                except BadRequest as e:
+                    self._record_failure(row, e, retry=False)
+                except TelegramError as e:
+                    self._record_failure(row, e, retry=True)
+                else:
+                    finished.append(row['id'])
+                    self.sent += 1
+                await asyncio.sleep(self.interval)
+        finally:
+            self.db.finish_notifications(finished)
+            # Остановка посреди пачки: неотправленное сразу возвращается в очередь, не дожидаясь аренды
+            self.db.postpone_notifications(list(unsent), int(time.time()))
+            self.in_flight = 0
+        return len(rows)
+    
+    def _record_failure(self, row: sqlite3.Row, error: TelegramError, retry: bool):
+        attempts = row['attempts'] + 1
+        if retry and attempts < NOTIFY_MAX_ATTEMPTS:
+            retry_at = int(time.time() + min(2 ** attempts, NOTIFY_RETRY_MAX))
+            self.retried += 1
+        else:
+            retry_at = None
+            self.failed += 1
+            logger.error(f"Error in NotificationSender: {error} (чат {row['chat_id']}, попыток: {attempts})")
+        self.db.notification_failed(row['id'], str(error), retry_at)
+    
+    async def drain(self, timeout: float):
+        """Ждет отправки подошедших уведомлений, но не дольше timeout; остальные уйдут после запуска"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.in_flight or self.db.due_notifications():
+            if loop.time() >= deadline:
+                logger.warning(
+                    f"Уведомлений в очереди при остановке: {self.db.due_notifications()}, отправятся после запуска"
+                )
+                return
+            self._wake.set()
+            await asyncio.sleep(0.05)
+
+# Лимит Telegram общий на бота, поэтому делится между процессами
+notifier = NotificationSender(db, NOTIFY_RATE / WORKERS)
+
+# ============ ПЛАТЕЖИ ============
+class PaymentIntent:
+    """Счет, выставленный провайдером"""
+    __slots__ = ('payment_id', 'url', 'text')
+    
+    def __init__(self, payment_id: Optional[str], text: str, url: str = None):
+        self.payment_id = payment_id
+        self.text = text
+        self.url = url
+
+class PaymentEvent:
+    """Уведомление провайдера об итоге платежа"""
+    __slots__ = ('payment_id', 'amount', 'succeeded')
+    
+    def __init__(self, payment_id: str, amount: int, succeeded: bool):
+        self.payment_id = payment_id
+        self.amount = amount
+        self.succeeded = succeeded
+
+class PaymentProvider:
+    """Адаптер платежной системы; без уведомлений заявки проверяет админ"""
+    name = 'manual'
+    callbacks = False
+    
+    async def resume_intent(self, request_id: int, payment_id: str, user_id: int, amount: int) -> PaymentIntent:
+        """Уже выставленный счет по ожидающей заявке (повторное нажатие той же суммы)"""
+        return await self.create_intent(request_id, user_id, amount)
+    
+    async def create_intent(self, request_id: int, user_id: int, amount: int) -> PaymentIntent:
+        return PaymentIntent(None, (
+            f"📋 <b>Реквизиты для оплаты:</b>\n"
+            f"• Карта: 1234 5678 9012 3456\n"
+            f"• Получатель: Иван Иванов\n"
+            f"• Комментарий: <code>{user_id}</code>\n\n"
+            f"💡 <b>Инструкция:</b>\n"
+            f"1. Переведите {format_price(amount)} на указанные реквизиты\n"
+            f"2. В комментарии укажите ваш ID: {user_id}\n"
+            f"3. Ожидайте зачисления (до 15 минут)"
+        ))
+    
+    def parse_callback(self, body: bytes, headers) -> PaymentEvent:
+        """Разбор и проверка подписи уведомления.
+        PermissionError - подпись не сошлась, ValueError - тело не разобрать"""
+        raise PermissionError("провайдер не присылает уведомлений")
+
+class MockPaymentProvider(PaymentProvider):
+    """Локальный провайдер для разработки: сам "оплачивает" счет и шлет подписанное уведомление"""
+    name = 'mock'
+    callbacks = True
+    
+    def __init__(self):
+        self.secret = PAYMENT_SECRET.encode()
+        self.pending: set = set()
+    
+    def sign(self, body: bytes) -> str:
+        return hmac.new(self.secret, body, 'sha256').hexdigest()
+    
+    async def create_intent(self, request_id: int, user_id: int, amount: int) -> PaymentIntent:
+        payment_id = f"mock_{request_id}_{secrets.token_hex(4)}"
+        task = asyncio.create_task(self._pay(payment_id, amount))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        return await self.resume_intent(request_id, payment_id, user_id, amount)
+    
+    async def resume_intent(self, request_id: int, payment_id: str, user_id: int, amount: int) -> PaymentIntent:
+        return PaymentIntent(payment_id, (
+            f"🧪 <b>Тестовый платеж</b> <code>{payment_id}</code>\n"
+            f"Будет оплачен автоматически через {MOCK_PAYMENT_DELAY:g} сек."
+        ))
+    
+    async def _pay(self, payment_id: str, amount: int):
+        await asyncio.sleep(MOCK_PAYMENT_DELAY)
+        body = json.dumps({'payment_id': payment_id, 'amount': amount, 'status': 'succeeded'}).encode()
+        url = f"http://127.0.0.1:{PAYMENT_PORT}{PAYMENT_CALLBACK_PATH}"
+        try:
+            async with ClientSession() as session:
+                async with session.post(url, data=body, headers={'X-Signature': self.sign(body)}) as response:
+                    if response.status != 200:
+                        logger.error(f"Mock-платеж {payment_id}: ответ {response.status}")
+        except ClientError as e:
+            logger.error(f"Error in MockPaymentProvider: {e}")
+    
+    def parse_callback(self, body: bytes, headers) -> PaymentEvent:
+        # Байты, а не строки: строку с не-ASCII символами compare_digest не сравнивает
+        if not hmac.compare_digest(headers.get('X-Signature', '').encode(), self.sign(body).encode()):
+            raise PermissionError("неверная подпись")
+        data = json.loads(body)
+        if not isinstance(data, dict):
+            raise ValueError("тело уведомления не объект JSON")
+        return PaymentEvent(data['payment_id'], int(data['amount']), data['status'] == 'succeeded')
+
+PAYMENT_PROVIDERS = {
+    'manual': PaymentProvider,
+    'mock': MockPaymentProvider,
+}
+payments = PAYMENT_PROVIDERS[PAYMENT_PROVIDER]()
+if payments.callbacks and not PAYMENT_SECRET:
+    raise ValueError(f"Для провайдера {payments.name} задайте PAYMENT_SECRET.")
+
+async def deposit_offer(user_id: int, amount: int) -> Tuple[str, InlineKeyboardMarkup]:
+    """Счет на пополнение: текст и кнопки"""
+    keyboard = []
+    if payments.callbacks:
+        # Повторное нажатие той же суммы показывает уже выставленный счет, а не плодит заявки
+        request = db.get_pending_deposit_request(user_id, amount, payments.name)
+        if request and request['payment_id']:
+            request_id = request['id']
+            intent = await payments.resume_intent(request_id, request['payment_id'], user_id, amount)
+        else:
+            request_id = request['id'] if request else db.create_deposit_request(user_id, amount, payments.name)
+            intent = await payments.create_intent(request_id, user_id, amount)
+            db.attach_payment(request_id, intent.payment_id)
+        if intent.url:
+            keyboard.append([InlineKeyboardButton("💳 Оплатить", url=intent.url)])
+        keyboard.append([InlineKeyboardButton("🔄 Проверить статус", callback_data=f"check_payment_{request_id}")])
+        footer = f"🧾 Заявка #{request_id}. Баланс пополнится автоматически сразу после оплаты."
+    else:
+        intent = await payments.create_intent(0, user_id, amount)
+        keyboard.append([InlineKeyboardButton("✅ Я оплатил", callback_data=f"confirm_payment_{amount}")])
+        footer = f"📞 При проблемах: {ADMIN_USERNAME}"
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="deposit")])
+    
+    text = (
+        f"💰 <b>Пополнение на {format_price(amount)}</b>\n\n"
+        f"🆔 Ваш ID: <code>{user_id}</code>\n"
+        f"💵 Сумма: {format_price(amount)}\n\n"
+        f"{intent.text}\n\n"
+        f"{footer}"
+    )
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def payment_callback_handler(request: web.Request) -> web.Response:
+    """Уведомление провайдера о платеже"""
+    body = await request.read()
+    try:
+        event = payments.parse_callback(body, request.headers)
+    except PermissionError as e:
+        logger.warning(f"Платежное уведомление отклонено ({e}) от {request.remote}")
+        return web.Response(status=403)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Платежное уведомление не разобрано ({e!r}) от {request.remote}")
+        return web.Response(status=400)
+    
+    try:
+        settled = await asyncio.to_thread(db.apply_payment, event.payment_id, event.amount, event.succeeded)
+    except OperationError as e:
+        logger.error(f"Error in payment_callback_handler: {e}")
+        return web.Response(status=404)
+    
+    # Повторное уведомление тоже подтверждаем, иначе провайдер будет слать его снова
+    if settled:
+        if event.succeeded:
+            notifier.send(settled['user_id'], f"✅ Баланс пополнен на {format_price(settled['amount'])}!")
+        else:
+            notifier.send(settled['user_id'], f"❌ Платеж по заявке #{settled['id']} не прошел.")
+    return web.Response()
+
+async def serve_payment_callbacks():
+    """Сервер уведомлений провайдера (фоновая задача); процессы-обработчики делят порт"""
+    web_app = web.Application()
+    web_app.router.add_post(PAYMENT_CALLBACK_PATH, payment_callback_handler)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, PAYMENT_LISTEN, PAYMENT_PORT, reuse_port=WORKERS > 1)
+        await site.start()
+        logger.info(f"💳 Уведомления {payments.name} принимаются на {PAYMENT_LISTEN}:{PAYMENT_PORT}{PAYMENT_CALLBACK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+# ============ ЗАЩИТА ОТ ФЛУДА ============
+class FloodState:
+    """Счетчики одного пользователя: ведро токенов и штрафы"""
+    __slots__ = ('tokens', 'updated', 'strikes', 'mutes', 'muted_until')
+    
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.strikes = 0
+        self.mutes = 0
+        self.muted_until = 0.0
+
+class FloodGuard:
+    """Ограничение частоты действий: ведро токенов у каждого пользователя и общее на процесс.
+    Кто продолжает жать в пустое ведро, получает паузу, а после нескольких пауз - бан"""
+    
+    def __init__(self, rate: float, burst: float, global_rate: float, strikes: int, mute: float, ban_after: int):
+        self.enabled = rate > 0
+        self.rate = rate
+        self.burst = burst
+        self.global_rate = global_rate
+        self.global_tokens = global_rate
+        self.global_updated = time.monotonic()
+        self.strikes = strikes
+        self.mute = mute
+        self.ban_after = ban_after
+        self.users: Dict[int, FloodState] = {}
+        self.banned: Set[int] = set()
+        # Админы не ограничиваются; список из таблицы admins, а не из ленивого кэша ADMIN_IDS
+        self.admins: Set[int] = set()
+        self.verdicts = defaultdict(int)
+    
+    def check(self, user_id: int) -> str:
+        """Решение по действию: pass, limited, overloaded, mute (начало паузы), muted или ban"""
+        now = time.monotonic()
+        state = self.users.get(user_id)
+        if state is None:
+            state = self.users[user_id] = FloodState(self.burst, now)
+        
+        if state.muted_until > now:
+            verdict = 'muted'
+        else:
+            state.tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+            state.updated = now
+            if state.tokens >= self.burst:
+                state.strikes = 0  # пользователь успокоился
+            if state.tokens >= 1:
+                state.tokens -= 1
+                verdict = self._take_global(now)
+            else:
+                verdict = self._strike(state, now)
+        self.verdicts[verdict] += 1
+        return verdict
+    
+    def _take_global(self, now: float) -> str:
+        """Общее ведро: при всплеске от многих пользователей лишнее отклоняется без штрафа"""
+        if not self.global_rate:
+            return 'pass'
+        self.global_tokens = min(self.global_rate, self.global_tokens + (now - self.global_updated) * self.global_rate)
+        self.global_updated = now
+        if self.global_tokens < 1:
+            return 'overloaded'
+        self.global_tokens -= 1
+        return 'pass'
+    
+    def _strike(self, state: FloodState, now: float) -> str:
+        state.strikes += 1
+        if state.strikes < self.strikes:
+            return 'limited'
+        if now - state.muted_until > RATE_LIMIT_FORGET:
+            state.mutes = 0
+        state.strikes = 0
+        state.muted_until = now + self.mute * 2 ** state.mutes
+        state.mutes += 1
+        if self.ban_after and state.mutes >= self.ban_after:
+            return 'ban'
+        return 'mute'
+    
+    def forgive(self, user_id: int):
+        """Снимает паузы и бан пользователя в этом процессе (после /unban)"""
+        self.users.pop(user_id, None)
+        self.banned.discard(user_id)
+    
+    def prune(self) -> int:
+        """Забывает успокоившихся пользователей: ведро полное, пауз давно не было"""
+        now = time.monotonic()
+        calm = [
+            user_id for user_id, state in self.users.items()
+            if state.tokens + (now - state.updated) * self.rate >= self.burst
+            and (not state.mutes or now - state.muted_until > RATE_LIMIT_FORGET)
+        ]
+        for user_id in calm:
+            del self.users[user_id]
+        return len(calm)
+
+# Лимит на пользователя точный и при нескольких процессах (апдейты пользователя идут в один процесс),
+# общий лимит делится между процессами
+flood_guard = FloodGuard(
+    RATE_LIMIT_RATE, RATE_LIMIT_BURST, RATE_LIMIT_GLOBAL / WORKERS,
+    RATE_LIMIT_STRIKES, RATE_LIMIT_MUTE, RATE_LIMIT_BAN_AFTER
+)
+
+FLOOD_NOTICES = {
+    'limited': "⏳ Слишком часто, подождите секунду",
+    'overloaded': "⏳ Бот перегружен, попробуйте через пару секунд",
+}
+
+def ban_flooder(user):
+    """Бан за флуд: та же отметка is_banned, что ставит /ban, снимается через /unban"""
+    db.execute("""
+        UPDATE users
+        SET is_banned = 1, ban_reason = ?, banned_at = ?, banned_by = NULL
+        WHERE user_id = ? AND is_banned = 0
+    """, ("Флуд (автоматически)", int(time.time()), user.id))
+    flood_guard.banned.add(user.id)
+    logger.warning(f"Пользователь {user.id} заблокирован за флуд")
+    notifier.send_admins(
+        f"🚫 Пользователь {user.id} (@{user.username or 'нет'}) заблокирован за флуд.\n"
+        f"Снять блокировку: /unban {user.id}"
+    )
+
+async def flood_guard_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Фильтр перед всеми обработчиками: заблокированные и флудящие пользователи дальше не проходят"""
+    user = update.effective_user
+    if not user or user.id in flood_guard.admins or user.id in ADMIN_IDS:
+        return
+    if user.id in flood_guard.banned:
+        flood_guard.verdicts['banned'] += 1
+        raise ApplicationHandlerStop
+    if not flood_guard.enabled or not (update.callback_query or update.message):
+        return
+    
+    verdict = flood_guard.check(user.id)
+    if verdict == 'pass':
+        return
+    
+    try:
+        if verdict == 'ban':
+            ban_flooder(user)
+        elif verdict == 'mute':
+            pause = flood_guard.users[user.id].muted_until - time.monotonic()
+            notice = f"🚫 Слишком много действий. Бот не будет отвечать вам {pause:.0f} с"
+            if update.callback_query:
+                await update.callback_query.answer(notice, show_alert=True)
+            else:
+                await update.message.reply_text(notice)
+        elif verdict in FLOOD_NOTICES and update.callback_query:
+            # Без ответа на нажатие кнопка у пользователя "крутится"; на паузе не отвечаем вовсе
+            await update.callback_query.answer(FLOOD_NOTICES[verdict])
+    except TelegramError as e:
+        logger.error(f"Error in flood_guard_handler: {e}")
+    raise ApplicationHandlerStop
+
+# ============ ФОНОВЫЕ ЗАДАЧИ ============
+background_tasks: List[asyncio.Task] = []
+
+async def sweep_stock_holds():
+    """Периодически возвращает в продажу товары из истекших броней"""
+    while True:
+        await asyncio.sleep(HOLD_SWEEP_INTERVAL)
+        try:
+            released = db.release_expired_holds()
+            if released:
+                logger.info(f"Снято истекших броней: {released}")
+        except Exception as e:
+            logger.error(f"Error in sweep_stock_holds: {e}")
+
+async def reconcile_ledger_job():
+    """Периодическая сверка балансов с журналом операций"""
+    while True:
+        await asyncio.sleep(LEDGER_RECONCILE_INTERVAL)
+        try:
+            result = await asyncio.to_thread(db.reconcile_ledger)
+            if result['mismatches'] or result['ledger_total']:
+                logger.error(
+                    f"Сверка журнала: расхождения у {len(result['mismatches'])} пользователей, "
+                    f"сумма проводок {result['ledger_total']}"
+                )
+        except Exception as e:
+            logger.error(f"Error in reconcile_ledger_job: {e}")
+
+async def watch_catalog():
+    """Сверяет версию каталога с базой и перестраивает снимок после правок"""
+    while True:
+        await asyncio.sleep(CATALOG_POLL_INTERVAL)
+        try:
+            if await asyncio.to_thread(catalog.refresh):
+                logger.info(f"Снимок каталога обновлен до версии {catalog.snapshot.version}")
+        except Exception as e:
+            logger.error(f"Error in watch_catalog: {e}")
+
+async def watch_bans():
+    """Перечитывает списки заблокированных и админов и забывает счетчики успокоившихся пользователей"""
+    while True:
+        try:
+            flood_guard.admins = await asyncio.to_thread(db.get_admin_ids)
+            banned = await asyncio.to_thread(db.get_banned_ids)
+            # /unban мог пройти в другом процессе: паузы разбаненного здесь тоже снимаются
+            for user_id in flood_guard.banned - banned:
+                flood_guard.forgive(user_id)
+            flood_guard.banned = banned
+            flood_guard.prune()
+        except Exception as e:
+            logger.error(f"Error in watch_bans: {e}")
+        await asyncio.sleep(BAN_POLL_INTERVAL)
+
+async def build_deferred_indexes():
+    """Индексы больших таблиц, отложенные при запуске: бот уже отвечает, пока они строятся"""
+    try:
+        await asyncio.to_thread(db.build_indexes)
+    except Exception as e:
+        logger.error(f"Error in build_deferred_indexes: {e}")
+
+async def start_background_jobs(application: Application):
+    """Запуск фоновых задач (post_init приложения)"""
+    # Админы известны фильтру флуда до первого апдейта, даже если в этом процессе они еще ничего не жали
+    flood_guard.admins = db.get_admin_ids()
+    background_tasks.append(asyncio.create_task(build_deferred_indexes()))
+    background_tasks.append(asyncio.create_task(watch_catalog()))
+    background_tasks.append(asyncio.create_task(watch_bans()))
+    background_tasks.append(asyncio.create_task(sweep_stock_holds()))
+    background_tasks.append(asyncio.create_task(reconcile_ledger_job()))
+    background_tasks.append(asyncio.create_task(notifier.run(application.bot)))
+    if payments.callbacks:
+        background_tasks.append(asyncio.create_task(serve_payment_callbacks()))
+
+async def stop_background_jobs(application: Application):
+    """Остановка фоновых задач (post_stop приложения)"""
+    await notifier.drain(timeout=5)
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+# ============ РЕГИСТРАЦИЯ ОБРАБОТЧИКОВ ============
+def setup_handlers(application: Application):
+    """Регистрация обработчиков команд, коллбэков и текстовых сообщений"""
+    # Фильтр флуда и банов - в группе -1, раньше всех обработчиков
+    application.add_handler(TypeHandler(Update, flood_guard_handler), group=-1)
+    
+    # Добавляем обработчики команд
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("admin", admin_commands))
+    application.add_handler(CommandHandler("addbalance", add_balance_command))
+    application.add_handler(CommandHandler("ban", ban_user_command))
+    application.add_handler(CommandHandler("unban", unban_user_command))
+    application.add_handler(CommandHandler("promo", create_promo_command))
+    application.add_handler(CommandHandler("user", user_info_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("testers", testers_command))
+    application.add_handler(CommandHandler("slowlog", slow_queries_command))
+    application.add_handler(CommandHandler("wizards", wizard_stats_command))
+    application.add_handler(CommandHandler("edits", edit_stats_command))
+    application.add_handler(CommandHandler("outbox", outbox_command))
+    application.add_handler(CommandHandler("flood", flood_stats_command))
+    application.add_handler(CommandHandler("reconcile", reconcile_command))
+    
+    # Добавляем обработчик callback-запросов
+    application.add_handler(CallbackQueryHandler(handle_callback))
+    
+    # Добавляем обработчик текстовых сообщений
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+
+def build_application(shard: int = 0, shards: int = 1) -> Application:
+    """Сборка приложения; в многопроцессном режиме апдейты приходят от входного процесса"""
+    http2 = bot_api_http2()
+    bot = ShopBot(
+        TOKEN,
+        base_url=BOT_API_URL,
+        request=BotApiRequest(BOT_API_POOL_SIZE, http2=http2),
+        get_updates_request=BotApiRequest(1, http2=http2),
+    )
+    builder = (
+        ApplicationBuilder()
+        .bot(bot)
+        .concurrent_updates(UserOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(SQLitePersistence(db, conversations, shard, shards))
+        .post_init(start_background_jobs)
+        .post_stop(stop_background_jobs)
+    )
+    if shards > 1:
+        builder = builder.updater(None)
+    
+    application = builder.build()
+    setup_handlers(application)
+    return application
+
+# ============ WEBHOOK ============
+async def webhook_handler(request: web.Request) -> web.Response:
+    """Прием апдейта от Telegram"""
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    # Байты, а не строки: compare_digest не принимает строки с не-ASCII символами
+    if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        logger.warning(f"Webhook: неверный секретный токен от {request.remote}")
+        return web.Response(status=403)
+    
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not isinstance(data, dict):
+        return web.Response(status=400)
+    
+    await request.app['dispatch'](data)
+    return web.Response()
+
+async def healthcheck_handler(request: web.Request) -> web.Response:
+    """Проверка доступности для прокси и балансировщика"""
+    return web.Response(text="ok")
+
+def stop_on_signals() -> asyncio.Event:
+    """Событие, которое выставляется по SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    return stop_event
+
+async def serve_webhook(bot: Bot, dispatch, stop_event: asyncio.Event):
+    """Встроенный aiohttp-сервер: каждый принятый апдейт передается в dispatch"""
+    web_app = web.Application()
+    web_app['dispatch'] = dispatch
+    web_app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    web_app.router.add_get('/healthz', healthcheck_handler)
+    
+    ssl_context = None
+    if WEBHOOK_CERT and WEBHOOK_KEY:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(WEBHOOK_CERT, WEBHOOK_KEY)
+    
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    
+    try:
+        site = web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT, ssl_context=ssl_context)
+        await site.start()
+        logger.info(f"🌐 Webhook слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        
+        # Секрет у всех экземпляров один, поэтому повторная регистрация ничего не ломает.
+        # Накопившиеся апдейты не сбрасываются: перезапуск экземпляра не теряет нажатия
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info(f"Webhook зарегистрирован: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        else:
+            logger.warning("WEBHOOK_URL не задан, webhook в Telegram не регистрируется")
+        
+        await stop_event.wait()
+    finally:
+        # Webhook не удаляем: его могут обслуживать другие экземпляры бота
+        await runner.cleanup()
+
+async def run_webhook(application: Application):
+    """Запуск бота в режиме webhook на встроенном aiohttp-сервере"""
+    async def dispatch(data: dict):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    
+    stop_event = stop_on_signals()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    try:
+        await serve_webhook(application.bot, dispatch, stop_event)
+    finally:
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+
+# ============ МНОГОПРОЦЕССНЫЙ РЕЖИМ ============
+def shard_of(update: Update, shards: int) -> int:
+    """Номер процесса для апдейта: все апдейты одного пользователя попадают в один процесс"""
+    key = UserOrderedUpdateProcessor.serialization_key(update)
+    return (key or 0) % shards
+
+async def poll_updates(bot: Bot, dispatch):
+    """Long polling без Updater: апдейты забирает только входной процесс"""
+    await bot.delete_webhook(drop_pending_updates=True)
+    offset = 0
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES
+            )
+        except TelegramError as e:
+            logger.error(f"Error in poll_updates: {e}")
+            await asyncio.sleep(1)
+            continue
+        
+        for update in updates:
+            offset = update.update_id + 1
+            await dispatch(update.to_dict())
+
+async def run_ingress(queues: List[multiprocessing.Queue]):
+    """Входной процесс: принимает апдейты (polling или webhook) и раздает их обработчикам"""
+    shards = len(queues)
+    stop_event = stop_on_signals()
+    
+    request = BotApiRequest(1, http2=bot_api_http2())
+    async with Bot(TOKEN, base_url=BOT_API_URL, request=request, get_updates_request=request) as bot:
+        async def dispatch(data: dict):
+            update = Update.de_json(data, bot)
+            queues[shard_of(update, shards)].put(data)
+        
+        if BOT_MODE == 'webhook':
+            await serve_webhook(bot, dispatch, stop_event)
+            return
+        
+        poller = asyncio.create_task(poll_updates(bot, dispatch))
+        await stop_event.wait()
+        poller.cancel()
+
+async def process_shard(application: Application, queue: multiprocessing.Queue):
+    """Обработчик: берет апдейты своей очереди, пока не придет None"""
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+
+def run_worker(shard: int, shards: int, queue: multiprocessing.Queue):
+    """Точка входа процесса-обработчика"""
+    # Останавливает входной процесс, присылая None: так очередь дочитывается до конца
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # Обработчик унаследовал от входного процесса открытый файл отчета, пишет в свой
+    open_slow_query_log(shard)
+    application = build_application(shard, shards)
+    logger.info(f"Обработчик {shard + 1}/{shards} запущен (pid {os.getpid()})")
+    asyncio.run(process_shard(application, queue))
+
+def run_sharded(shards: int):
+    """Запуск входного процесса и shards процессов-обработчиков"""
+    queues = [multiprocessing.Queue() for _ in range(shards)]
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(shard, shards, queue), name=f"worker-{shard}")
+        for shard, queue in enumerate(queues)
+    ]
+    for worker in workers:
+        worker.start()
+    
+    try:
+        asyncio.run(run_ingress(queues))
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+
 # ============ ОСНОВНАЯ ФУНКЦИЯ ============
 def main():
     """Основная функция запуска бота"""
     
-    if not BOT_TOKEN or BOT_TOKEN == "ВАШ_ТОКЕН_ЗДЕСЬ":
+    if not TOKEN or TOKEN == "ВАШ_ТОКЕН_ЗДЕСЬ":
         logger.error("❌ Укажите BOT_TOKEN в коде!")
         print("=" * 60)
         print("⚠️  ВНИМАНИЕ: Токен бота виден в коде!")
@@ -3457,27 +6046,6 @@ def main():
         return
     
     try:
-        from telegram.ext import ApplicationBuilder
-        application = ApplicationBuilder().token(BOT_TOKEN).build()
-        
-        # Добавляем обработчики команд
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("admin", admin_commands))
-        application.add_handler(CommandHandler("addbalance", add_balance_command))
-        application.add_handler(CommandHandler("ban", ban_user_command))
-        application.add_handler(CommandHandler("unban", unban_user_command))
-        application.add_handler(CommandHandler("promo", create_promo_command))
-        application.add_handler(CommandHandler("user", user_info_command))
-        application.add_handler(CommandHandler("stats", stats_command))
-        application.add_handler(CommandHandler("testers", testers_command))
-        
-        # Добавляем обработчик callback-запросов
-        application.add_handler(CallbackQueryHandler(handle_callback))
-        
-        # Добавляем обработчик текстовых сообщений
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
-        
         logger.info("🤖 Бот запускается...")
         print("=" * 60)
         print("✅ Бот успешно запущен!")
@@ -3485,16 +6053,26 @@ def main():
         print(f"📈 Система графиков готова!")
         print(f"👑 Администратор: {ADMIN_USERNAME}")
         print(f"📁 База данных: {DB_FILE}")
+        print(f"📡 Режим: {BOT_MODE}")
+        print(f"⚙️ Процессов-обработчиков: {WORKERS}")
         print("=" * 60)
         print("📝 Логи сохраняются в bot.log")
         print("🔄 Для остановки нажмите Ctrl+C")
         print("=" * 60)
         
         # Запуск бота
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True
-        )
+        if WORKERS > 1:
+            run_sharded(WORKERS)
+            return
+        
+        application = build_application()
+        if BOT_MODE == 'webhook':
+            asyncio.run(run_webhook(application))
+        else:
+            application.run_polling(
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=True
+            )
         
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
@@ -3504,7 +6082,7 @@ def main():
         print("=" * 60)
 
 if __name__ == "__main__":
-    if BOT_TOKEN == "8261940208:AAF31P8If9iZCmUP6mEsojgK2T61Ko7_YVA":
+    if TOKEN == "8261940208:AAF31P8If9iZCmUP6mEsojgK2T61Ko7_YVA":
         print("=" * 60)
         print("⚠️  ВНИМАНИЕ: Используется тестовый токен!")
         print("⚠️  Рекомендуется создать новый токен через @BotFather")
@@ -0,0 +1,251 @@
+"""
+Перенос данных из старых баз бота (kanfyshenstore.db и bot.db) в shop.db.
+
+Таблицы читаются порциями по rowid и пишутся executemany: одна порция -
+одна транзакция вместе с отметкой прогресса в etl_progress, поэтому
+прерванный перенос продолжается с места остановки. Заказы и заявки несут
+ключ исходной строки (orders.legacy_id, deposit_requests.payment_id) под
+уникальным индексом, поэтому и перенос заново (--restart) ничего не
+дублирует. На время переноса вторичные индексы users и orders
+снимаются (вставка вразброс по индексам в разы медленнее их сборки),
+а в конце строятся заново по списку main.INDEXES. Затем балансы заносятся
+в журнал начальными остатками и перестраивается дерево рефералов.
+Запускать при остановленном боте.
+
+Что куда переносится:
+    users (обе базы)               -> users (существующие в shop.db не трогаются)
+    admin_access                   -> admins
+    deposit_requests, deposits     -> deposit_requests (provider = 'legacy')
+    purchases                      -> orders (orders_count и total_spent пересчитываются)
+Рассылки, сообщения и журнал действий в новой схеме не хранятся.
+
+Примеры:
+    python migrate_legacy.py
+    python migrate_legacy.py --chunk 20000 --legacy old/kanfyshenstore.db
+    python migrate_legacy.py --restart           # заново, без учета прогресса
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent
+
+# Статусы старых заявок; неизвестный считаем отклоненным, чтобы его не зачислили повторно
+DEPOSIT_STATUSES = {
+    'pending': 'pending',
+    'approved': 'approved',
+    'completed': 'approved',
+    'confirmed': 'approved',
+    'rejected': 'rejected',
+    'cancelled': 'rejected',
+}
+
+# Таблицы, чьи индексы снимаются на время переноса (кроме UNIQUE)
+BULK_TABLES = ('users', 'orders')
+
+INSERT_USER = """
+    INSERT INTO users (user_id, username, first_name, balance, total_deposited, referral_code,
+                       referred_by, total_referrals, is_banned, join_date, last_active)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO NOTHING
+"""
+INSERT_ADMIN = "INSERT OR IGNORE INTO admins (user_id, username) VALUES (?, ?)"
+INSERT_DEPOSIT = """
+    INSERT INTO deposit_requests (user_id, amount, status, created_at, processed_at, processed_by,
+                                  provider, payment_id)
+    VALUES (?, ?, ?, ?, ?, ?, 'legacy', ?)
+    ON CONFLICT(payment_id) WHERE provider = 'legacy' DO NOTHING
+"""
+INSERT_ORDER = """
+    INSERT INTO orders (user_id, product_id, product_name, amount, status, details, created_at, legacy_id)
+    VALUES (?, 0, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(legacy_id) WHERE legacy_id IS NOT NULL DO NOTHING
+"""
+
+
+# ============ ПРЕОБРАЗОВАНИЕ СТРОК ============
+def legacy_ts(value):
+    """Местное ISO-время старых баз ('2026-01-15T16:00:00.230772') в секунды Unix"""
+    return int(datetime.fromisoformat(value).timestamp()) if value else None
+
+
+def money(value) -> int:
+    """REAL-суммы старых баз в целые"""
+    return int(round(value or 0))
+
+
+def legacy_user(row):
+    return (row['user_id'], row['username'], row['first_name'], money(row['balance']),
+            money(row['total_deposited']), row['referral_code'] or f"L{row['user_id']:x}",
+            row['referred_by'], row['referrals_count'] or 0, row['is_banned'] or 0,
+            legacy_ts(row['join_date']), legacy_ts(row['last_action'] or row['join_date']))
+
+
+def bot_user(row):
+    return (row['user_id'], row['username'], row['first_name'], money(row['balance']), 0,
+            f"L{row['user_id']:x}", None, 0, 0, legacy_ts(row['join_date']), legacy_ts(row['join_date']))
+
+
+def admin(row):
+    # Вход по паролю без user_id в новой схеме не нужен
+    return (row['user_id'], row['username']) if row['user_id'] else None
+
+
+def deposit(table: str):
+    def convert(row):
+        if not row['user_id']:
+            return None
+        status = DEPOSIT_STATUSES.get(row['status'] or 'pending', 'rejected')
+        return (row['user_id'], money(row['amount']), status, legacy_ts(row['created_at']),
+                legacy_ts(row['processed_at']), row['processed_by'], f"legacy:{table}:{row['id']}")
+    return convert
+
+
+def purchase(row):
+    if not row['user_id']:
+        return None
+    return (row['user_id'], row['tariff_name'] or row['tariff_id'] or "Тариф", money(row['amount']),
+            row['status'] or 'completed', row['customer_notes'], legacy_ts(row['created_at']),
+            f"legacy:purchases:{row['id']}")
+
+
+# Порядок важен: пользователи из kanfyshenstore.db полнее, при совпадении остаются они
+STEPS = [
+    ('legacy', 'users', legacy_user, INSERT_USER),
+    ('legacy', 'admin_access', admin, INSERT_ADMIN),
+    ('legacy', 'deposit_requests', deposit('deposit_requests'), INSERT_DEPOSIT),
+    ('legacy', 'deposits', deposit('deposits'), INSERT_DEPOSIT),
+    ('legacy', 'purchases', purchase, INSERT_ORDER),
+    ('bot', 'users', bot_user, INSERT_USER),
+]
+
+
+# ============ ПЕРЕНОС ============
+def copy_table(source: sqlite3.Connection, target: sqlite3.Connection, source_name: str, table: str,
+               convert, insert_sql: str, chunk: int) -> int:
+    """Переносит таблицу порциями; возвращает число прочитанных строк"""
+    exists = source.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone()
+    if not exists:
+        print(f"  {source_name}.{table}: нет в базе, пропущено")
+        return 0
+
+    progress = target.execute(
+        "SELECT last_rowid FROM etl_progress WHERE source = ? AND table_name = ?", (source_name, table)
+    ).fetchone()
+    last_rowid = progress[0] if progress else 0
+    total = source.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    done = source.execute(f"SELECT COUNT(*) FROM {table} WHERE rowid <= ?", (last_rowid,)).fetchone()[0]
+    if done:
+        print(f"  {source_name}.{table}: продолжаем с {done}/{total}")
+
+    copied = 0
+    started = time.perf_counter()
+    while True:
+        rows = source.execute(
+            f"SELECT rowid AS _rowid, * FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (last_rowid, chunk)
+        ).fetchall()
+        if not rows:
+            break
+        # None - строка без владельца, переносить ее некуда
+        values = [value for value in map(convert, rows) if value]
+        last_rowid = rows[-1]['_rowid']
+
+        with target:
+            target.executemany(insert_sql, values)
+            target.execute("""
+                INSERT INTO etl_progress (source, table_name, last_rowid) VALUES (?, ?, ?)
+                ON CONFLICT(source, table_name) DO UPDATE SET last_rowid = excluded.last_rowid
+            """, (source_name, table, last_rowid))
+
+        copied += len(rows)
+        done += len(rows)
+        elapsed = time.perf_counter() - started
+        print(f"  {source_name}.{table}: {done}/{total} ({done * 100 // max(total, 1)}%), "
+              f"{copied / elapsed if elapsed else 0:,.0f} строк/с", flush=True)
+
+    if not copied and not done:
+        print(f"  {source_name}.{table}: пусто")
+    return copied
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Перенос данных из старых баз бота в shop.db")
+    parser.add_argument('--workdir', default=str(REPO_DIR), help="каталог бота с shop.db")
+    parser.add_argument('--legacy', default='kanfyshenstore.db', help="база старого магазина")
+    parser.add_argument('--bot-db', default='bot.db', help="база старого бота")
+    parser.add_argument('--chunk', type=int, default=5000, help="строк в одной транзакции")
+    parser.add_argument('--restart', action='store_true', help="забыть прогресс прошлых запусков")
+    args = parser.parse_args()
+
+    workdir = Path(args.workdir).resolve()
+    sources = {'legacy': workdir / args.legacy, 'bot': workdir / args.bot_db}
+
+    # Схему и миграции shop.db создает сам бот
+    os.chdir(workdir)
+    os.environ.setdefault('BOT_TOKEN', '0:MIGRATION')
+    sys.path.insert(0, str(REPO_DIR))
+    import main
+
+    target = sqlite3.connect(main.DB_FILE)
+    target.execute("PRAGMA synchronous = NORMAL")
+    target.execute("""
+        CREATE TABLE IF NOT EXISTS etl_progress (
+            source TEXT NOT NULL,
+            table_name TEXT NOT NULL,
+            last_rowid INTEGER NOT NULL,
+            PRIMARY KEY (source, table_name)
+        )
+    """)
+    if args.restart:
+        with target:
+            target.execute("DELETE FROM etl_progress")
+
+    started = time.perf_counter()
+    for index_name, table, _ in main.INDEXES:
+        if table in BULK_TABLES:
+            target.execute(f"DROP INDEX IF EXISTS {index_name}")
+    copied = 0
+    for source_name, table, convert, insert_sql in STEPS:
+        path = sources[source_name]
+        if not path.exists():
+            print(f"  {path.name}: файл не найден, пропущено")
+            continue
+        source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        source.row_factory = sqlite3.Row
+        try:
+            copied += copy_table(source, target, path.name, table, convert, insert_sql, args.chunk)
+        finally:
+            source.close()
+    if copied:
+        # Итоги покупок одним проходом по orders, а не обновлением пользователя на каждую строку.
+        # Как и выручка в статистике, считаются только выполненные заказы
+        with target:
+            target.execute("""
+                UPDATE users SET orders_count = totals.orders_count, total_spent = totals.total_spent
+                FROM (
+                    SELECT user_id, COUNT(*) AS orders_count, SUM(amount) AS total_spent
+                    FROM orders WHERE status = 'completed' GROUP BY user_id
+                ) AS totals
+                WHERE users.user_id = totals.user_id
+            """)
+    target.close()
+
+    index_started = time.perf_counter()
+    main.db.build_indexes()
+    print(f"Индексы восстановлены за {time.perf_counter() - index_started:.1f} с")
+    if copied:
+        linked = main.db.rebuild_referral_tree()
+        opened = main.db.post_opening_balances()
+        print(f"Дерево рефералов: {linked} связей, начальных остатков в журнале: {opened}")
+    print(f"✅ Перенесено строк: {copied} за {time.perf_counter() - started:.1f} с")
+
+
+if __name__ == '__main__':
+    main_cli()